@@ -14,8 +14,9 @@ it helps to automate the extraction task
 '''
 
 
-from PyQt6.QtWidgets import QApplication, QWidget, QPushButton, QLabel, QGridLayout, QLineEdit, QFileDialog, QMessageBox, QCheckBox, QProgressBar, QTableWidget, QTableWidgetItem, QMainWindow, QTextBrowser
-from PyQt6.QtCore import Qt, QSize, QRect, pyqtSignal
+from PyQt6.QtWidgets import QApplication, QWidget, QPushButton, QLabel, QGridLayout, QLineEdit, QFileDialog, QMessageBox, QCheckBox, QProgressBar, QTableView, QMainWindow, QTextBrowser, QSpinBox
+from PyQt6.QtCore import Qt, QSize, QRect, pyqtSignal, QAbstractTableModel, QModelIndex, QThread, QTimer
+from PyQt6.QtGui import QColor
 from PyQt6.QtGui import QIcon, QAction, QWindow
 from PyQt6 import QtWidgets
 
@@ -23,54 +24,13 @@ import sys
 import os
 import time
 import json
-import csv
 import threading
+import multiprocessing
 
-import pymongo
-import numpy
-import radiomics
-
-
-def extractRadiomics(File_volume, File_mask, rdm_params):
-    try:
-        print(f'[1] Loading radiomics ...')
-        rmics = radiomics.featureextractor.RadiomicsFeatureExtractor()
-        print(f'[2] Loading files ...')
-        rmics.loadImage(str(File_volume), str(File_mask))
-        print(f'[3] Enable features ...')
-        rmics.enableAllFeatures()
-        rmics.loadJSONParams(  json.dumps(rdm_params)  )
-        print(f'[4] Radiomics extraction ...')
-        result = rmics.execute(File_volume, File_mask)
-        print(f'[5]Radiomics features calculated')
-        return True, result
-    except Exception as e:
-        print(f"[Error] {e}")
-        return False, None
-
-
-def formatResult( result, id_ ):
-    predoc = dict()
-    predoc['_ID_'] = str(id_)
-    print(f"Formating radiomics result...")
-    try:
-        for _key_ in result.keys().__iter__():
-            if( type(result[str(_key_)]) == str ):
-                predoc[str(_key_)] = str(result[str(_key_)])
-            elif( type(result[str(_key_)]) == dict ):
-                predoc[str(_key_)] = result[str(_key_)]
-            elif( type(result[str(_key_)]) == tuple ):
-                predoc[str(_key_)] = str(result[str(_key_)])
-            if( type(result[str(_key_)]) == numpy.float64 ):
-                predoc[str(_key_)] = float(result[str(_key_)])
-            elif( type(result[str(_key_)]) == numpy.ndarray ):
-                pre = result[str(_key_)].tolist()
-                predoc[str(_key_)] = float(pre)
-
-        return True, predoc
-    except Exception as e:
-        print(f"[Error] While triying to format radiomics result: {e}")
-        return False, predoc
+from rdmengine import defaultParams
+from rdmrunner import iterWorklist, radiomicsRunner
+from rdmprogress import progressTracker, formatDuration
+from rdmdicom import isDicomFile
 
 
 class jsonviewer(QWidget):
@@ -100,10 +60,98 @@ class jsonviewer(QWidget):
         doc += "}"
         self.text_browser.setHtml(doc)
 
+# ------------------------------------ Worklist model ------------------------------------
+
+class worklistModel(QAbstractTableModel):
+    # The view only asks for the visible cells, rows are kept as tuples in a plain list
+    def __init__(self, rows):
+        QAbstractTableModel.__init__(self)
+        self.rows = rows
+        self.headers = ["ID", "Volume", "Segment", "Labels"]
+        self.exists = dict()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        rows = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return rows[column] if column < len(rows) else f""
+        if role == Qt.ItemDataRole.ForegroundRole and column in (1, 2):
+            # Existence checks are deferred to the rows that are actually painted
+            if not self.__exists__(rows[column]):
+                return QColor('red')
+        return None
+
+    def appendRows(self, rows):
+        if not rows:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+    def removeRow(self, row, parent=QModelIndex()):
+        self.beginRemoveRows(parent, row, row)
+        del self.rows[row]
+        self.endRemoveRows()
+        return True
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows.clear()
+        self.exists.clear()
+        self.endResetModel()
+
+    def __exists__(self, path):
+        exists = self.exists.get(path)
+        if exists is None:
+            exists = os.path.exists(path)
+            self.exists[path] = exists
+        return exists
+
+
+class worklistLoader(QThread):
+    # Parses the csv file out of the user interface thread and hands the rows over in batches
+    rowsLoaded = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+    def __init__(self, listFile, batchSize=5000):
+        QThread.__init__(self)
+        self.listFile = listFile
+        self.batchSize = batchSize
+
+    def run(self):
+        try:
+            batch = []
+            for rr in iterWorklist(self.listFile):
+                batch.append(rr)
+                if len(batch) >= self.batchSize:
+                    self.rowsLoaded.emit(batch)
+                    batch = []
+            self.rowsLoaded.emit(batch)
+        except Exception as e:
+            print(f"[Error] While trying to open file {self.listFile}: {e}")
+            self.failed.emit(f"Error While trying to open file {self.listFile}")
+
+# ---------------------------------- End Worklist model ----------------------------------
+
 # --------------------------------- Radiomics Progress ---------------------------------
 
 class radiomicsProgress(QWidget):
     finish = pyqtSignal()
+    progressChanged = pyqtSignal(dict)
     def __init__(self):
         QWidget.__init__(self)
         self.setWindowTitle("Radiomics Progress")
@@ -127,101 +175,78 @@ class radiomicsProgress(QWidget):
         self.label_3.move(10, 80)
         self.label_3.resize(700,28)
 
+        self.label_4 = QLabel('', self)
+        self.label_4.move(10, 160)
+        self.label_4.resize(700,28)
+
+        self.label_5 = QLabel('', self)
+        self.label_5.move(10, 180)
+        self.label_5.resize(700,200)
+        self.label_5.setAlignment(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignTop)
+
         self.progressBar = QProgressBar(self)
         self.progressBar.move(10,120)
         self.progressBar.resize(700,28)
 
-        self.usingDatabase = False
-        self.databaseConnectionString = f""
-        self.database = f""
-        self.collection = f""
-        self.client = None
+        # The runner reports from its own thread, the snapshots reach the widgets through the
+        # signal (queued connection) at most 10 times per second
+        self.progressChanged.connect(self.__showProgress__)
+        self.tracker = progressTracker(self.progressChanged.emit, refreshRate=10.0)
+        self.runner = radiomicsRunner()
+        self.runner.addListener(self.tracker)
+        # Trailing updates between the events (coalesced events, elapsed, ETA)
+        self.timer = QTimer(self)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self.tracker.tick)
+        self.finish.connect(self.timer.stop)
 
     def setUsingDatabase(self, usingdb):
-        if type(usingdb) is bool:
-            self.usingDatabase = usingdb
-        else:
-            raise TypeError("Argument should be a boolean") 
+        self.runner.setUsingDatabase(usingdb)
 
     def setDatabaseconnection(self, connstr, database, collection):
-        self.databaseConnectionString = connstr
-        self.database = database
-        self.collection = collection
+        self.runner.setDatabaseconnection(connstr, database, collection)
 
     def setWorkingList(self, worklist):
-        self.worklist = worklist
+        self.runner.setWorkingList(worklist)
 
     def setRadiomicsParams(self, params):
-        # Add check params format
-        self.radiomicsParams = params
+        self.runner.setRadiomicsParams(params)
+
+    def setOutputDirectory(self, directory):
+        self.runner.setOutputDirectory(directory)
+
+    def setWorkers(self, workers):
+        self.runner.setWorkers(workers)
+
+    def setCache(self, directory):
+        self.runner.setCache(directory)
 
     def exec(self):
+        self.progressBar.setMinimum(0)
+        self.progressBar.setMaximum(max(1, len(self.runner.worklist)))
+        self.progressBar.setValue(0)
+        self.label_0.setText(f"Processing ...")
+        self.tracker.reset()
+        self.timer.start()
         thr = threading.Thread(target=self.__exec__, daemon=True)
         thr.start()
 
     def __exec__(self):
-        items = len(self.worklist)
-        item = 0
-        self.progressBar.setMinimum(0)
-        self.progressBar.setMaximum(items)
-
-        if self.usingDatabase:
-            try:
-                self.client = pymongo.MongoClient(self.databaseConnectionString)
-            except Exception as e:
-                print(f"[Error] while connect to the database: {e}")
-                self.client = None
-
-        for volumes in self.worklist:
-            filesExistCheck = os.path.exists(volumes[1]) and os.path.exists(volumes[2])
-            item += 1
-
-            if filesExistCheck:
-                print(f"Processing ...")
-                print(f"ID:  {volumes[0]}")
-                print(f"Volume:    {volumes[1]}")
-                print(f"Segment:   {volumes[2]}")
-                self.label_0.setText(f"Processing ...")
-                self.label_1.setText(f"Process for ID:  {volumes[0]}")
-                self.label_2.setText(f"Volume:    {volumes[1]}")
-                self.label_3.setText(f"Segment:   {volumes[2]}")
-
-                isDone, result = extractRadiomics(volumes[1], volumes[2], self.radiomicsParams)
-
-                if isDone:
-                    formatDone, dradiomics_document = formatResult( result, volumes[0])
-                    if formatDone:
-                        try:
-                            with open(f'{volumes[0]}.json', 'w') as fp:
-                                json.dump(dradiomics_document, fp)
-                        except Exception as e:
-                            print(f"[Error] while trying to save radiomics result in the file {volumes[0]}.json: {e}")
-                    
-                    if self.usingDatabase:
-                        try:
-                            self.client[self.database][self.collection].insert_one(dict(dradiomics_document))
-                        except Exception as e:
-                            print(f"[Error] while trying to save radiomics result in the database {volumes[0]}: {e}")
-                
-            else:
-                print(f"[Error] No such file:")
-                print(f"ID:  {volumes[0]}")
-                print(f"Volume:    {volumes[1]}")
-                print(f"Segment:   {volumes[2]}")
-                self.label_0.setText(f"[Error] No such file:")
-                self.label_1.setText(f"Process for ID:  {volumes[0]}")
-                self.label_2.setText(f"Volume:    {volumes[1]}")
-                self.label_3.setText(f"Segment:   {volumes[2]}")
-            
-            self.progressBar.setValue(item)
-
-        if self.usingDatabase:
-            try:
-                self.client.close()
-            except:
-                pass
-            self.client = None
-        self.finish.emit()            
+        try:
+            self.runner.run()
+        except Exception as e:
+            print(f"[Error] while running the radiomics extraction: {e}")
+        self.finish.emit()
+
+    def __showProgress__(self, snapshot):
+        self.progressBar.setMaximum(max(1, snapshot['items']))
+        self.progressBar.setValue(snapshot['completed'])
+        self.label_0.setText(f"Processing ..." if snapshot['completed'] < snapshot['items'] else f"Finished")
+        self.label_1.setText(f"Cases:     {snapshot['completed']} / {snapshot['items']}    elapsed {formatDuration(snapshot['elapsed'])}")
+        self.label_2.setText(f"Done: {snapshot['done']} (cached {snapshot['cached']})    Failed: {snapshot['failed']}    Missing: {snapshot['missing']}    Invalid: {snapshot['invalid']}    Skipped: {snapshot['skipped']}")
+        self.label_3.setText(f"Throughput: {snapshot['casesPerSecond']:.2f} cases/s    ETA {formatDuration(snapshot['eta'])}")
+        self.label_4.setText(f"Active cases ({len(snapshot['active'])}):")
+        self.label_5.setText('\n'.join(f"worker {worker}:  {ID}  ({formatDuration(running)})" for worker, (ID, running) in sorted(snapshot['active'].items(), key=lambda item: str(item[0]))))
 
 # ------------------------------- End Radiomics Progress -------------------------------
         
@@ -240,6 +265,13 @@ class RdmWindow(QMainWindow):
         self.InitialSegmentFile = f""
 
         self.fileList=[]
+        self.worklistModel = worklistModel(self.fileList)
+        self.table.setModel(self.worklistModel)
+        self.table.setColumnWidth(0, 50)
+        self.table.setColumnWidth(1, 370)
+        self.table.setColumnWidth(2, 370)
+        self.table.setColumnWidth(3, 80)
+        self.listLoader = None
 
         self.OuputDirectory = f""
         self.UseDB = False
@@ -250,7 +282,7 @@ class RdmWindow(QMainWindow):
         self.DatabaseCollection = f""
 
         self.jsonviewerWidget = jsonviewer(self)
-        self.jsonparamsfile = json.loads(r'{"setting": {"binWidth": 25.0, "symmetricalGLCM": true}, "featureClass": {"firstorder": null, "glcm": null, "gldm": null, "glrlm": null, "glszm": null, "ngtdm": null, "shape": null, "shape2D": null}, "imageType": {"Original": {} }}')
+        self.jsonparamsfile = json.loads(defaultParams)
         self.progress = radiomicsProgress()
         self.progress.finish.connect(self.radiomicsExtractionFinish)
 
@@ -268,6 +300,13 @@ class RdmWindow(QMainWindow):
         layout.addWidget(self.line_edit_1_ID, 1, 1)
         self.line_edit_1_ID.move(140, 10)
 
+        self.label_12 = QLabel('Labels:', self)
+        self.label_12.move(290, 10)
+        self.line_edit_12_Labels = QLineEdit(self)
+        self.line_edit_12_Labels.move(340, 10)
+        self.line_edit_12_Labels.resize(100, 28)
+        self.line_edit_12_Labels.setPlaceholderText('1;2 or all')
+
         #------------------ Radiomics parameters secction ------------------------------------
 
         self.button_AddRadiomicsButton = QPushButton('Add Radiomics File', self)
@@ -355,6 +394,18 @@ class RdmWindow(QMainWindow):
         self.line_edit_9_Collection.move(140, 240)
         self.line_edit_9_Collection.resize(200, 28)
 
+        self.label_10 = QLabel('Workers:', self)
+        self.label_10.move(5, 270)
+        self.spinBox_10_Workers = QSpinBox(self)
+        self.spinBox_10_Workers.move(140, 270)
+        self.spinBox_10_Workers.setRange(1, os.cpu_count() or 1)
+        self.spinBox_10_Workers.setValue(1)
+
+        self.checkBox_useCache = QCheckBox(self)
+        self.checkBox_useCache.move(5, 300)
+        self.label_11 = QLabel('Use results cache', self)
+        self.label_11.move(25, 300)
+
         self.button_test = QPushButton('Test Connection', self)
         self.button_test.move(500, 300)
         self.button_test.clicked.connect(self.on_button_click_DBConnectionTest)
@@ -363,15 +414,11 @@ class RdmWindow(QMainWindow):
         self.button_exec.move(700, 300)
         self.button_exec.clicked.connect(self.on_button_click_exec)
 
-        self.table = QTableWidget(self)
+        self.table = QTableView(self)
         self.table.setGeometry(0, 0, 790, 350)
         self.table.move(5,400)
-        self.table.setColumnCount(3)
-        self.table.setColumnWidth(0, 50)
-        self.table.setColumnWidth(1, 370)
-        self.table.setColumnWidth(2, 370)
-        self.table.setHorizontalHeaderLabels(["ID","Volume", "Segment"])
         self.table.horizontalHeader().setVisible(True)
+        self.table.verticalHeader().setDefaultSectionSize(24)
 
         self.button_DeletSelected = QPushButton('Delet selected', self)
         layout.addWidget(self.button_DeletSelected, 2, 4)
@@ -413,11 +460,14 @@ class RdmWindow(QMainWindow):
             QMessageBox.critical(self, "Error", self.mssg)
 
     def on_button_click_add_volume_file(self):
-        self.InitialVolumeFile, _ = QFileDialog.getOpenFileName(self,"Choose Volume File", "","Nearly Raw Raster Data Files (*.nrrd);;All Files (*)")
+        self.InitialVolumeFile, _ = QFileDialog.getOpenFileName(self,"Choose Volume File", "","Nearly Raw Raster Data Files (*.nrrd);;DICOM Series (*.dcm);;All Files (*)")
+        if self.InitialVolumeFile and isDicomFile(self.InitialVolumeFile):
+            # A slice of a DICOM series stands for the whole series directory
+            self.InitialVolumeFile = os.path.dirname(self.InitialVolumeFile)
         self.line_edit_2_VolumeFile.setText(self.InitialVolumeFile)
 
     def on_button_click_add_segment_file(self):
-        self.InitialSegmentFile, _ = QFileDialog.getOpenFileName(self,"Choose Volume File", "","Nearly Raw Raster Data Files (*.nrrd);;All Files (*)")
+        self.InitialSegmentFile, _ = QFileDialog.getOpenFileName(self,"Choose Volume File", "","Nearly Raw Raster Data Files (*.nrrd);;DICOM-SEG / RTSTRUCT (*.dcm);;All Files (*)")
         self.line_edit_3_SegmentFile.setText(self.InitialSegmentFile)
 
     def on_button_click_clear(self):
@@ -428,6 +478,7 @@ class RdmWindow(QMainWindow):
         self.line_edit_1_ID.setText(self.InitialID)
         self.line_edit_2_VolumeFile.setText(self.InitialVolumeFile)
         self.line_edit_3_SegmentFile.setText(self.InitialSegmentFile)
+        self.line_edit_12_Labels.setText("")
 
     def on_button_click_add(self):
         self.mssg = ""
@@ -443,14 +494,11 @@ class RdmWindow(QMainWindow):
 
         if lenCheck:
             if filesExistCheck:
-                self.fileList.append([self.InitialID, self.InitialVolumeFile, self.InitialSegmentFile])
-                self.table.setRowCount( len(self.fileList) )
-                row = 0
-                for rows in self.fileList:
-                    self.table.setItem(row, 0, QTableWidgetItem( rows[0] ))
-                    self.table.setItem(row, 1, QTableWidgetItem( rows[1] ))
-                    self.table.setItem(row, 2, QTableWidgetItem( rows[2] ))
-                    row += 1
+                labels = self.line_edit_12_Labels.text().strip()
+                if len(labels) > 0:
+                    self.worklistModel.appendRows([ (self.InitialID, self.InitialVolumeFile, self.InitialSegmentFile, labels) ])
+                else:
+                    self.worklistModel.appendRows([ (self.InitialID, self.InitialVolumeFile, self.InitialSegmentFile) ])
             else:
                 print(f"One or more files do not exist")
                 self.error = True
@@ -489,6 +537,7 @@ class RdmWindow(QMainWindow):
         else:
             #------------------------- Database Connection ------------------------
             try:
+                import pymongo
                 client = pymongo.MongoClient(self.DatabaseConnectionString)
                 if ( self.DatabaseName in client.list_database_names() ):
                     if ( self.DatabaseCollection in client[self.DatabaseName].list_collection_names() ):
@@ -537,6 +586,9 @@ class RdmWindow(QMainWindow):
                         self.progress.setDatabaseconnection(self.DatabaseConnectionString, self.DatabaseName, self.DatabaseCollection)
                         self.progress.setWorkingList(self.fileList)
                         self.progress.setRadiomicsParams(self.jsonparamsfile)
+                        self.progress.setOutputDirectory(self.OuputDirectory)
+                        self.progress.setWorkers(self.spinBox_10_Workers.value())
+                        self.progress.setCache(self.__cacheDirectory__())
                         self.progress.exec()
                         # --------------------------  End Radiomics extraction using database --------------------------
                     else:
@@ -551,6 +603,9 @@ class RdmWindow(QMainWindow):
                     self.progress.setUsingDatabase(False)
                     self.progress.setWorkingList(self.fileList)
                     self.progress.setRadiomicsParams(self.jsonparamsfile)
+                    self.progress.setOutputDirectory(self.OuputDirectory)
+                    self.progress.setWorkers(self.spinBox_10_Workers.value())
+                    self.progress.setCache(self.__cacheDirectory__())
                     self.progress.exec()
                     # --------------------------  End Radiomics extraction --------------------------
 
@@ -562,6 +617,12 @@ class RdmWindow(QMainWindow):
             QMessageBox.critical(self, "Error", self.mssg)
             self.setEnabled(True)
 
+    def __cacheDirectory__(self):
+        # The cache lives next to the results so that a re-run of the same output directory reuses it
+        if self.checkBox_useCache.isChecked():
+            return os.path.join(self.OuputDirectory, '.rdmcache')
+        return None
+
     def radiomicsExtractionFinish(self):
         QMessageBox.information(self, "Information", "Radiomics work is done.")
         self.progress.close()
@@ -572,50 +633,40 @@ class RdmWindow(QMainWindow):
         self.error = False
         self.mssg = f""
 
-        row = self.table.currentRow()
+        row = self.table.currentIndex().row()
 
         if row < 0:
             self.error = True
             self.mssg = f"No row selected"
         else:
-            del self.fileList[row]
-            self.table.setRowCount( len(self.fileList) )
-            row = 0
-            for rows in self.fileList:
-                self.table.setItem(row, 0, QTableWidgetItem( rows[0] ))
-                self.table.setItem(row, 1, QTableWidgetItem( rows[1] ))
-                self.table.setItem(row, 2, QTableWidgetItem( rows[2] ))
-                row += 1
+            self.worklistModel.removeRow(row)
 
         if self.error:
             QMessageBox.critical(self, "Error", self.mssg)
 
+    def worklistLoadFailed(self, mssg):
+        self.worklistModel.clear()
+        QMessageBox.critical(self, "Error", mssg)
+
+    def worklistLoadFinished(self):
+        self.button_ImportList.setEnabled(True)
+        self.button_exec.setEnabled(True)
+        self.table.resizeColumnToContents(0)
+
     def on_button_click_ImportList(self):
         self.error = False
         self.mssg = f""
         listFile, _ = QFileDialog.getOpenFileName(self,"Choose list File", "","Comma Ceparated Values Files (*.csv);;All Files (*)")
 
         if os.path.exists(listFile):
-            try:
-                self.fileList = []
-                with open(listFile) as fobj:
-                    csvreader = csv.reader(fobj)
-                    for rr in csvreader:
-                        self.fileList.append(rr)
-                
-                self.table.setRowCount( len(self.fileList) )
-                row = 0
-                for rows in self.fileList:
-                    self.table.setItem(row, 0, QTableWidgetItem( rows[0] ))
-                    self.table.setItem(row, 1, QTableWidgetItem( rows[1] ))
-                    self.table.setItem(row, 2, QTableWidgetItem( rows[2] ))
-                    row += 1
-            except:
-                self.error = True
-                self.mssg = f"Error While trying to open file {listFile}"
-                self.fileList = []
-                self.table.setRowCount( len(self.fileList) )
-                
+            self.worklistModel.clear()
+            self.button_ImportList.setEnabled(False)
+            self.button_exec.setEnabled(False)
+            self.listLoader = worklistLoader(listFile)
+            self.listLoader.rowsLoaded.connect(self.worklistModel.appendRows)
+            self.listLoader.failed.connect(self.worklistLoadFailed)
+            self.listLoader.finished.connect(self.worklistLoadFinished)
+            self.listLoader.start()
 
         if self.error:
             QMessageBox.critical(self, "Error", self.mssg)
@@ -623,6 +674,7 @@ class RdmWindow(QMainWindow):
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     window = RdmWindow()
     sys.exit(app.exec())
\ No newline at end of file
@@ -0,0 +1,211 @@
+'''
+Radiomics extraction benchmark
+
+Generates synthetic phantoms (volume + spherical lesions in the mask) at several sizes,
+ROI fractions and label counts, runs them through the extraction and formatting pipeline
+(processCase) with each params file and writes a machine readable baseline: cases/sec,
+time per stage (feature class / image type) and peak memory.
+
+    python rdmbench.py -o bench.json
+    python rdmbench.py --sizes 64x64x64,512x512x300 --params rdmparam_wavelet.json -o bench.json
+    python rdmbench.py -o new.json --compare bench.json
+    python rdmbench.py --features model_features.txt -o bench.json
+
+The phantoms are generated once in the work directory and reused by later runs
+
+'''
+
+import sys
+import os
+import json
+import time
+import math
+import platform
+import argparse
+import subprocess
+
+
+defaultSizes = '64x64x64,128x128x128,256x256x128'
+defaultFractions = '0.01,0.1'
+defaultLabels = '1,3'
+
+
+def phantomName(size, fraction, labels, seed):
+    return f"phantom_{size[0]}x{size[1]}x{size[2]}_roi{fraction}_labels{labels}_seed{seed}"
+
+
+def makePhantom(directory, size, fraction, labels, seed=0):
+    # Volume: CT like background with noise, lesions: spheres brighter than the background.
+    # Mask: one label per lesion, together covering about `fraction` of the volume
+    import numpy
+    import SimpleITK as sitk
+
+    name = phantomName(size, fraction, labels, seed)
+    volumeFile = os.path.join(directory, f"{name}_volume.nrrd")
+    maskFile = os.path.join(directory, f"{name}_mask.nrrd")
+    if os.path.exists(volumeFile) and os.path.exists(maskFile):
+        return volumeFile, maskFile
+
+    rng = numpy.random.default_rng(seed)
+    shape = (size[2], size[1], size[0])
+    volume = rng.standard_normal(shape, dtype=numpy.float32)
+    volume *= 30.0
+    volume += 40.0
+    mask = numpy.zeros(shape, dtype=numpy.uint8)
+
+    lesionVoxels = fraction * volume.size / labels
+    radius = max(2.0, (3.0 * lesionVoxels / (4.0 * math.pi)) ** (1.0 / 3.0))
+    for label in range(1, labels + 1):
+        center = [rng.uniform(min(radius, n / 2.0), max(n / 2.0, n - radius)) for n in shape]
+        low = [max(0, int(c - radius)) for c in center]
+        high = [min(n, int(c + radius) + 1) for c, n in zip(center, shape)]
+        zz, yy, xx = numpy.ogrid[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+        sphere = ((zz - center[0]) ** 2 + (yy - center[1]) ** 2 + (xx - center[2]) ** 2) <= radius ** 2
+        region = mask[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+        region[sphere] = label
+        volume[low[0]:high[0], low[1]:high[1], low[2]:high[2]][sphere] += 80.0 + 20.0 * label
+
+    image = sitk.GetImageFromArray(volume.astype(numpy.int16))
+    image.SetSpacing((0.8, 0.8, 1.5))
+    segment = sitk.GetImageFromArray(mask)
+    segment.CopyInformation(image)
+    sitk.WriteImage(image, volumeFile, True)
+    sitk.WriteImage(segment, maskFile, True)
+    return volumeFile, maskFile
+
+
+def environment():
+    info = {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+    for package in ('pyradiomics', 'numpy', 'SimpleITK', 'PyWavelets'):
+        try:
+            from importlib.metadata import version
+            info[package] = version(package)
+        except Exception:
+            info[package] = None
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip() or None
+    except Exception:
+        info['commit'] = None
+    return info
+
+
+def runCase(volumes, params, repeat, features=None):
+    from rdmengine import processCase, setImageCacheSize
+
+    # The first run warms up the extractor, it is not measured. Without the decoded volume
+    # cache every measured run reads and decodes the volume, as a worker does for a new case
+    setImageCacheSize(0)
+    processCase(volumes, params, features)
+    result = {'cases': 0, 'failed': 0, 'wall': 0.0, 'peakRSS': 0.0, 'stages': dict()}
+    for index in range(repeat):
+        start = time.perf_counter()
+        isDone, documents, stats = processCase(volumes, params, features)
+        result['wall'] += time.perf_counter() - start
+        result['cases'] += 1
+        if not isDone:
+            result['failed'] += 1
+        result['features'] = max([len(document) for document in documents] + [0])
+        if stats.get('peakRSS') is not None:
+            result['peakRSS'] = max(result['peakRSS'], stats['peakRSS'])
+        for name, stage in stats.get('stages', dict()).items():
+            total = result['stages'].setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            total['wall'] += stage['wall'] / repeat
+            total['cpu'] += stage['cpu'] / repeat
+    result['casesPerSecond'] = result['cases'] / result['wall'] if result['wall'] > 0 else 0.0
+    return result
+
+
+def compare(results, baselineFile, threshold):
+    # Prints the change of cases/sec against the baseline, returns the regressions
+    with open(baselineFile, 'r') as fp:
+        baseline = {(entry['phantom'], entry['params']): entry for entry in json.load(fp)['results']}
+    regressions = []
+    for entry in results:
+        previous = baseline.get( (entry['phantom'], entry['params']) )
+        if previous is None or previous['casesPerSecond'] <= 0:
+            continue
+        ratio = entry['casesPerSecond'] / previous['casesPerSecond']
+        flag = ''
+        if ratio < 1.0 - threshold:
+            flag = '  <-- slower'
+            regressions.append(entry)
+        print(f"{entry['phantom']} {entry['params']}: {previous['casesPerSecond']:.3f} -> {entry['casesPerSecond']:.3f} cases/s ({ratio:.2f}x){flag}")
+    return regressions
+
+
+def parseArguments(argv):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(prog='rdmbench', description='Radiomics extraction benchmark on synthetic phantoms')
+    parser.add_argument('-o', '--output', default='bench.json', help='Benchmark results (json)')
+    parser.add_argument('-p', '--params', action='append', help='Radiomics parameters file (json), can be repeated')
+    parser.add_argument('--sizes', default=defaultSizes, help=f'Phantom sizes XxYxZ separated by commas (default {defaultSizes})')
+    parser.add_argument('--fractions', default=defaultFractions, help=f'ROI fractions of the volume (default {defaultFractions})')
+    parser.add_argument('--labels', default=defaultLabels, help=f'Number of labels in the mask (default {defaultLabels})')
+    parser.add_argument('--features', help='Feature list: each params file is also run with the minimal params of the list, with its speedup')
+    parser.add_argument('--repeat', type=int, default=3, help='Measured runs per case')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the phantoms')
+    parser.add_argument('--workdir', default=os.path.join(here, '.rdmbench'), help='Directory for the generated phantoms')
+    parser.add_argument('--compare', help='Baseline results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+    if not args.params:
+        args.params = [os.path.join(here, 'rdmparam.json'), os.path.join(here, 'rdmparam_wavelet.json')]
+    return args
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+    os.makedirs(args.workdir, exist_ok=True)
+
+    sizes = [tuple(int(n) for n in size.lower().split('x')) for size in args.sizes.split(',')]
+    fractions = [float(fraction) for fraction in args.fractions.split(',')]
+    labelCounts = [int(labels) for labels in args.labels.split(',')]
+
+    params = dict()
+    for paramsFile in args.params:
+        with open(paramsFile, 'r') as fp:
+            params[os.path.basename(paramsFile)] = json.load(fp)
+
+    # Minimal params of the feature list: {params name: (minimal params, features, full params name)}
+    profiles = dict()
+    if args.features:
+        from rdmprofile import readFeatureList, minimalParams
+        features = tuple(readFeatureList(args.features))
+        for paramsName, rdm_params in params.items():
+            profiles[paramsName] = (minimalParams(rdm_params, features)[0], features, os.path.basename(args.features))
+
+    results = []
+    for size in sizes:
+        for fraction in fractions:
+            for labels in labelCounts:
+                name = phantomName(size, fraction, labels, args.seed)
+                print(f"Phantom {name} ...")
+                volumeFile, maskFile = makePhantom(args.workdir, size, fraction, labels, args.seed)
+                volumes = (name, volumeFile, maskFile, 'all') if labels > 1 else (name, volumeFile, maskFile)
+                for paramsName, rdm_params in params.items():
+                    result = runCase(volumes, rdm_params, args.repeat)
+                    result.update({'phantom': name, 'params': paramsName, 'size': list(size), 'fraction': fraction, 'labels': labels})
+                    results.append(result)
+                    print(f"    {paramsName}: {result['casesPerSecond']:.3f} cases/s, peak memory {result['peakRSS']:.0f} MB")
+                    if paramsName in profiles:
+                        minimal, features, featuresName = profiles[paramsName]
+                        profile = runCase(volumes, minimal, args.repeat, features)
+                        profile.update({'phantom': name, 'params': f"{paramsName}+{featuresName}", 'size': list(size), 'fraction': fraction, 'labels': labels})
+                        profile['speedup'] = result['wall'] / profile['wall'] if profile['wall'] > 0 else 0.0
+                        results.append(profile)
+                        print(f"    {paramsName} + {featuresName}: {profile['casesPerSecond']:.3f} cases/s, {profile['speedup']:.1f}x the full extraction, peak memory {profile['peakRSS']:.0f} MB")
+
+    with open(args.output, 'w') as fp:
+        json.dump({'environment': environment(), 'results': results}, fp, indent=2)
+    print(f"Benchmark results saved in {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"[Error] {len(regressions)} benchmark(s) slower than the baseline")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+'''
+Radiomics result cache
+
+Persistent on disk cache of the formatted radiomics documents. The key is a hash of the
+content of the volume file, the content of the mask file and the normalized radiomics
+params, so a re-run only extracts the cases that changed. The cache is bounded in size,
+the least recently used entries are evicted first
+
+The preprocessed image cache keeps, with the same eviction, the preprocessed and filtered
+images cropped to the ROI as memory mappable numpy files, keyed by the content of the files
+and the settings used before the feature classes. It is shared by the worker processes, the
+size of the directory is summed again before every eviction decision
+
+'''
+
+import os
+import json
+import hashlib
+import threading
+import concurrent.futures
+
+from rdmengine import paramsDigest
+
+
+def radiomicsVersion():
+    try:
+        from importlib.metadata import version
+        return version('pyradiomics')
+    except Exception:
+        return f""
+
+
+class fileDigests():
+    # Content hashes of the input files, memoized by (size, modification time) so that
+    # unchanged files are hashed only once across runs
+    def __init__(self, indexFile):
+        self.indexFile = indexFile
+        self.lock = threading.Lock()
+        self.index = dict()
+        try:
+            with open(self.indexFile, 'r') as fp:
+                self.index = json.load(fp)
+        except Exception:
+            self.index = dict()
+
+    def digest(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            known = self.index.get(path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(4 * 1024 * 1024), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self.lock:
+            self.index[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def save(self):
+        with self.lock:
+            tmp = f"{self.indexFile}.tmp"
+            with open(tmp, 'w') as fp:
+                json.dump(self.index, fp)
+            os.replace(tmp, self.indexFile)
+
+
+class diskCache():
+    # shared: other processes write to the directory too (one cache per worker), the size
+    # counted by this process is not the size of the directory
+    def __init__(self, directory, maxBytes, shared=False):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.shared = shared
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.__scan__()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, key[:2], f"{key}{extension}")
+
+    def touch(self, path):
+        # The modification time is the last access time used by the eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, *paths):
+        with self.lock:
+            entries = None
+            if self.shared:
+                entries = self.__scan__()
+            else:
+                self.size += sum(os.path.getsize(path) for path in paths)
+            if self.size > self.maxBytes:
+                self.evict(entries)
+
+    def evict(self, entries=None):
+        if entries is None:
+            entries = self.__scan__()
+        # Evict down to 90% of the quota so that the directory is not scanned on every write
+        target = int(self.maxBytes * 0.9)
+        for mtime, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def __scan__(self):
+        # Entries of the directory, the least recently used first, and their total size
+        entries = []
+        for path in self.__entries__():
+            try:
+                stat = os.stat(path)
+                entries.append( (stat.st_mtime, stat.st_size, path) )
+            except OSError:
+                pass
+        entries.sort()
+        self.size = sum(entry[1] for entry in entries)
+        return entries
+
+    def __entries__(self):
+        for root, dirs, files in os.walk(self.directory):
+            if root == self.directory:
+                continue
+            for name in files:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(root, name)
+
+
+class resultCache(diskCache):
+    def __init__(self, directory, maxBytes=1024 * 1024 * 1024):
+        diskCache.__init__(self, directory, maxBytes)
+        self.digests = fileDigests(os.path.join(self.directory, 'digests.json'))
+        self.version = radiomicsVersion()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, volumes, rdm_params):
+        sha = hashlib.sha256()
+        sha.update(self.digests.digest(volumes[1]).encode('utf-8'))
+        sha.update(self.digests.digest(volumes[2]).encode('utf-8'))
+        sha.update(paramsDigest(rdm_params).encode('utf-8'))
+        # Labels column of the worklist, if any
+        sha.update(';'.join(volumes[3:]).encode('utf-8'))
+        sha.update(self.version.encode('utf-8'))
+        return sha.hexdigest()
+
+    def keys(self, worklist, rdm_params, workers=4):
+        # Hashing is I/O bound, the files are read in parallel
+        def caseKey(volumes):
+            try:
+                return self.key(volumes, rdm_params)
+            except Exception as e:
+                print(f"[Error] while hashing the files of {volumes[0]}: {e}")
+                return None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            keys = list(executor.map(caseKey, worklist))
+        try:
+            self.digests.save()
+        except Exception as e:
+            print(f"[Error] while saving the cache index: {e}")
+        return keys
+
+    def get(self, key):
+        if key is None:
+            self.misses += 1
+            return None
+        path = self.path(key, '.json')
+        try:
+            with open(path, 'r') as fp:
+                documents = json.load(fp)['documents']
+        except Exception:
+            self.misses += 1
+            return None
+        self.touch(path)
+        self.hits += 1
+        return documents
+
+    def put(self, key, documents):
+        if key is None:
+            return
+        path = self.path(key, '.json')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as fp:
+                json.dump({'documents': documents}, fp)
+            os.replace(tmp, path)
+            self.added(path)
+        except Exception as e:
+            print(f"[Error] while saving the result in the cache: {e}")
+
+    def summary(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size}
+
+
+class preprocessedCache(diskCache):
+    # Preprocessed (normalized, resampled) image and filtered images cropped to the ROI, keyed
+    # by the content of the volume and the mask and by the settings used before the feature
+    # classes (the feature settings, e.g. binWidth, are not in the key). An entry is one image
+    # type: the stack of its derived images (.npy, memory mapped on read), the cropped mask
+    # (.mask.npy) and the names, geometry and diagnostics (.pkl). An entry missing one of its
+    # files (evicted) is a miss. Every worker has its own instance on the same directory
+    def __init__(self, directory, maxBytes=20 * 1024 * 1024 * 1024):
+        diskCache.__init__(self, directory, maxBytes, shared=True)
+        self.version = radiomicsVersion()
+        # Content hashes of the worker, by (path, size, modification time)
+        self.digests = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, path):
+        if os.path.isdir(path):
+            from rdmdicom import directoryFingerprint
+            return directoryFingerprint(path)
+        stat = os.stat(path)
+        known = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        digest = self.digests.get(known)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as fp:
+                for block in iter(lambda: fp.read(4 * 1024 * 1024), b''):
+                    sha.update(block)
+            digest = sha.hexdigest()
+            if len(self.digests) >= 64:
+                self.digests.clear()
+            self.digests[known] = digest
+        return digest
+
+    def groupKey(self, source, settings):
+        # source: (volume file, mask file), settings: of the extractor with the label
+        from rdmengine import preprocessingKey
+        sha = hashlib.sha256()
+        for path in source:
+            sha.update(self.digest(path).encode('utf-8'))
+        sha.update(preprocessingKey(settings).encode('utf-8'))
+        sha.update(self.version.encode('utf-8'))
+        return sha.hexdigest()
+
+    def key(self, groupKey, filterKey=None):
+        # filterKey: (image type, filter settings), None for the preprocessed image
+        return hashlib.sha256(f"{groupKey}:{json.dumps(filterKey)}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        # Returns (images, mask, diagnostics) or None. images yields (image type name, image),
+        # each image is read from the memory mapped stack when it is reached, only one derived
+        # image of the stack (e.g. one wavelet sub-band) is in memory at a time
+        import pickle
+        import numpy
+        import SimpleITK as sitk
+        paths = [self.path(key, extension) for extension in ('.pkl', '.npy', '.mask.npy')]
+        try:
+            with open(paths[0], 'rb') as fp:
+                meta = pickle.load(fp)
+            stack = numpy.load(paths[1], mmap_mode='r')
+            maskArray = numpy.load(paths[2], mmap_mode='r')
+        except Exception:
+            self.misses += 1
+            return None
+
+        def toImage(array):
+            image = sitk.GetImageFromArray(numpy.ascontiguousarray(array))
+            image.SetOrigin(meta['origin'])
+            image.SetSpacing(meta['spacing'])
+            image.SetDirection(meta['direction'])
+            return image
+        images = cachedImages(meta['names'], lambda index: toImage(stack[index].astype(meta['dtypes'][index], copy=False)))
+        mask = toImage(maskArray)
+        for path in paths:
+            self.touch(path)
+        self.hits += 1
+        return images, mask, meta['diagnostics']
+
+    def put(self, key, images, mask, diagnostics=None):
+        # images: [(image type name, image)] with the geometry of the cropped mask
+        import pickle
+        import numpy
+        import SimpleITK as sitk
+        try:
+            arrays = [sitk.GetArrayViewFromImage(image) for name, image in images]
+            meta = {
+                'names': [name for name, image in images],
+                'dtypes': [array.dtype.str for array in arrays],
+                'origin': mask.GetOrigin(),
+                'spacing': mask.GetSpacing(),
+                'direction': mask.GetDirection(),
+                'diagnostics': diagnostics,
+            }
+            path = self.path(key, '.pkl')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            written = []
+            # The metadata goes last, an entry is only read once it is complete
+            for extension, write in (('.npy', lambda fp: numpy.save(fp, numpy.stack(arrays))),
+                                     ('.mask.npy', lambda fp: numpy.save(fp, sitk.GetArrayViewFromImage(mask))),
+                                     ('.pkl', lambda fp: pickle.dump(meta, fp))):
+                path = self.path(key, extension)
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, 'wb') as fp:
+                    write(fp)
+                os.replace(tmp, path)
+                written.append(path)
+            self.added(*written)
+        except Exception as e:
+            print(f"[Error] while saving the preprocessed images in the cache: {e}")
+
+    def summary(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size}
+
+
+class cachedImages():
+    # (image type name, image) of a cached entry, read on iteration
+    def __init__(self, names, load):
+        self.names = names
+        self.load = load
+
+    def __iter__(self):
+        for index, name in enumerate(self.names):
+            yield name, self.load(index)
+
+    def __len__(self):
+        return len(self.names)
@@ -0,0 +1,223 @@
+'''
+Radiomics extraction utility Command Line
+
+Headless entry point for the extraction of a worklist, it runs the same pipeline as the
+user interface (radiomicsRunner) without importing PyQt, so it can be used on compute
+nodes without a display
+
+    python rdmcli.py worklist.csv -p rdmparam.json -o results --workers 8
+    python rdmcli.py inbox --watch -p rdmparam.json -o results --workers 4
+
+The worklist has the same format as the "Import List" button of the user interface
+(ID, volume file, segment file), the params file has the rdmparam.json format. With --watch
+the worklist (or the inbox directory) is watched and the cases extracted as they arrive
+
+'''
+
+import sys
+import os
+import json
+import time
+import signal
+import argparse
+import multiprocessing
+
+from rdmengine import defaultParams
+from rdmrunner import readWorklist, radiomicsRunner
+from rdmwatch import inboxWatcher, worklistWatcher
+from rdmprogress import progressTracker, progressLine
+from rdmprofile import readFeatureList, measureSpeedup
+from rdmperturb import readPerturbations
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(prog='rdmcli', description='Radiomics worklist extractor')
+    parser.add_argument('worklist', help='CSV worklist file: ID, volume file or DICOM series directory, segment file (image, DICOM-SEG or RTSTRUCT)')
+    parser.add_argument('--watch', action='store_true', help='Serve mode: the worklist (a CSV rows are appended to, or an inbox directory of {ID}_volume / {ID}_mask files) is watched and the new cases extracted as they arrive, until SIGTERM or Ctrl+C')
+    parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between two looks at the watched worklist or inbox')
+    parser.add_argument('--settle', type=float, default=2.0, help='Seconds without change before the files of an inbox case or of a watched worklist row are taken')
+    parser.add_argument('--wait-timeout', type=float, default=3600.0, help='Seconds a row of the watched worklist waits for its files, it is then reported missing')
+    parser.add_argument('-p', '--params', action='append', help='Radiomics parameters file (json), can be repeated to extract several params sets in one pass')
+    parser.add_argument('-o', '--output', default='.', help='Output directory for the json results')
+    parser.add_argument('-f', '--format', default='json', choices=['json', 'csv', 'parquet'], help='json: one file per ID, csv/parquet: a single feature matrix')
+    parser.add_argument('--features', help='Feature list (text, one name per line, or json): only the image types and feature classes of these features are computed and stored')
+    parser.add_argument('--speedup', action='store_true', help='With --features, time the first case with the full params and the feature list after the run')
+    parser.add_argument('--perturb', help='Perturbation spec (json): every row is also extracted with dilated, eroded, translated and randomized masks, the documents are tagged with _PERTURBATION_')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--timeout', type=float, help='Wall clock limit of a case in seconds, the worker running it is replaced')
+    parser.add_argument('--max-memory', type=int, help='Address space limit of a worker process in MB (RLIMIT_AS)')
+    parser.add_argument('--max-rss', type=int, help='Resident memory limit of a worker process in MB, the worker exceeding it is replaced')
+    parser.add_argument('--retries', type=int, default=1, help='Runs again of a case whose worker crashed, timed out or ran out of memory')
+    parser.add_argument('--retry-params', help='Radiomics parameters file (json) for the runs again, e.g. without the Wavelet image type')
+    parser.add_argument('--preflight', default='report', choices=['drop', 'report', 'off'], help='Validation of the worklist from the headers and the mask labels: only report the rows bound to fail (default), drop them, or skip it')
+    parser.add_argument('--scheduling', default='cost', choices=['cost', 'worklist'], help='cost: most expensive cases first (estimated from the headers), worklist: worklist order')
+    parser.add_argument('--memory-budget', type=int, help='Memory in MB for the workers: cases are admitted while the sum of their estimated peak memory fits in it')
+    parser.add_argument('--cache', help='Results cache directory, unchanged cases are not extracted again')
+    parser.add_argument('--cache-size', type=int, default=1024, help='Results cache size limit in MB')
+    parser.add_argument('--dicom-cache', help='Cache directory of the volumes assembled from DICOM series directories')
+    parser.add_argument('--dicom-cache-size', type=int, default=10240, help='DICOM series cache size limit in MB')
+    parser.add_argument('--preprocessed-cache', help='Cache directory of the preprocessed and filtered images cropped to the ROI, reused when only feature settings change')
+    parser.add_argument('--preprocessed-cache-size', type=int, default=20480, help='Preprocessed image cache size limit in MB')
+    parser.add_argument('--shared', help='Shared directory (e.g. NFS) to split the worklist between several runners with lease files')
+    parser.add_argument('--lease-time', type=float, default=600.0, help='Seconds without renewal after which the lease of a dead runner is reclaimed')
+    parser.add_argument('--progress-rate', type=float, default=1.0, help='Progress lines per second (0 disables the progress lines)')
+    parser.add_argument('--prometheus', help='Prometheus textfile with the stage timings (node exporter textfile collector)')
+    parser.add_argument('--db-connection', help='MongoDB connection string, enables the database output')
+    parser.add_argument('--db-name', help='MongoDB database')
+    parser.add_argument('--db-collection', help='MongoDB collection')
+    parser.add_argument('--db-overwrite', action='store_true', help='Extract again the cases already stored in the collection with the same params (default: skipped, the run resumes)')
+    return parser.parse_args(argv)
+
+
+def reportSpeedup(worklist, params, runner):
+    # Full extraction against the feature list on the first case with its files present
+    for volumes in worklist:
+        if len(volumes) > 2 and os.path.exists(volumes[1]) and os.path.exists(volumes[2]):
+            break
+    else:
+        return
+    try:
+        full, reduced, fullWidth, reducedWidth = measureSpeedup(volumes, params, runner.extractionParams, runner.features)
+    except Exception as e:
+        print(f"[Error] while timing the full extraction of {volumes[0]}: {e}")
+        return
+    print(f"Speedup of the feature list on {volumes[0]}: {full:.2f} s for {fullWidth} features, {reduced:.2f} s for {reducedWidth} features ({full / reduced if reduced > 0 else 0.0:.1f}x)")
+
+
+def serve(runner, args):
+    # The completed cases are kept in the state file of the output directory, a restarted
+    # service goes on where it stopped
+    stateFile = os.path.join(args.output, 'watch-state.jsonl')
+    if os.path.isdir(args.worklist):
+        source = inboxWatcher(args.worklist, stateFile, args.settle)
+    else:
+        source = worklistWatcher(args.worklist, stateFile, args.settle, args.wait_timeout)
+    def stop(signum, frame):
+        print(f"Stopping, the running cases finish ...")
+        runner.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Watching {args.worklist} for new cases")
+    return runner.serve(source, args.poll_interval)
+
+
+def main(argv=None):
+    args = parseArguments(argv)
+
+    if args.workers < 1:
+        print(f"[Error] The number of workers should be a positive integer")
+        return 2
+
+    if not os.path.isdir(args.output):
+        print(f"[Error] Output directory does not exist: {args.output}")
+        return 2
+
+    worklist = []
+    if not args.watch:
+        try:
+            worklist = readWorklist(args.worklist)
+        except Exception as e:
+            print(f"[Error] Error While trying to open file {args.worklist}: {e}")
+            return 2
+    elif not os.path.exists(args.worklist):
+        print(f"[Error] No such worklist or inbox directory: {args.worklist}")
+        return 2
+
+    if args.params:
+        # Several params files: the documents are tagged with the file name without extension
+        params = []
+        for paramsFile in args.params:
+            try:
+                with open(paramsFile, 'r') as file:
+                    params.append( (os.path.splitext(os.path.basename(paramsFile))[0], json.load(file)) )
+            except Exception as e:
+                print(f"[Error] File can not be readed, pelase cheack if it is a valid json format: {e}")
+                return 2
+        if len(params) == 1:
+            params = params[0][1]
+    else:
+        params = json.loads(defaultParams)
+
+    runner = radiomicsRunner()
+    runner.setWorkingList(worklist)
+    try:
+        runner.setRadiomicsParams(params)
+    except ValueError as e:
+        print(f"[Error] {e}")
+        return 2
+    if args.features:
+        try:
+            runner.setFeatureList(readFeatureList(args.features))
+        except Exception as e:
+            print(f"[Error] Feature list {args.features}: {e}")
+            return 2
+    if args.perturb:
+        try:
+            runner.setPerturbations(readPerturbations(args.perturb))
+        except Exception as e:
+            print(f"[Error] Perturbation spec {args.perturb}: {e}")
+            return 2
+    runner.setOutputDirectory(args.output)
+    runner.setWorkers(args.workers)
+    runner.setScheduling(args.scheduling)
+    runner.setMemoryBudget(args.memory_budget * 1024 * 1024 if args.memory_budget else None)
+    runner.setPreflight(args.preflight)
+    runner.setLimits(args.timeout, args.max_memory * 1024 * 1024 if args.max_memory else None, args.max_rss * 1024 * 1024 if args.max_rss else None)
+    reducedParams = None
+    if args.retry_params:
+        try:
+            with open(args.retry_params, 'r') as file:
+                reducedParams = json.load(file)
+        except Exception as e:
+            print(f"[Error] File can not be readed, pelase cheack if it is a valid json format: {e}")
+            return 2
+    runner.setRetries(args.retries, reducedParams)
+    runner.setOutputFormat(args.format)
+    runner.setPrometheusFile(args.prometheus)
+    tracker = None
+    if args.progress_rate > 0:
+        tracker = progressTracker(lambda snapshot: print(progressLine(snapshot), flush=True), args.progress_rate)
+        runner.addListener(tracker)
+    if args.shared:
+        runner.setSharedDirectory(args.shared, args.lease_time)
+    if args.cache:
+        runner.setCache(args.cache, args.cache_size * 1024 * 1024)
+    if args.dicom_cache:
+        runner.setSeriesCache(args.dicom_cache, args.dicom_cache_size * 1024 * 1024)
+    if args.preprocessed_cache:
+        runner.setPreprocessedCache(args.preprocessed_cache, args.preprocessed_cache_size * 1024 * 1024)
+
+    if args.db_connection:
+        if not (args.db_name and args.db_collection):
+            print(f"[Error] --db-name and --db-collection are required with --db-connection")
+            return 2
+        runner.setUsingDatabase(True)
+        runner.setDatabaseconnection(args.db_connection, args.db_name, args.db_collection)
+        runner.setDatabaseResume(not args.db_overwrite)
+
+    start = time.time()
+    if tracker is not None:
+        tracker.startTimer()
+    try:
+        if args.watch:
+            summary = serve(runner, args)
+        else:
+            summary = runner.run()
+    except Exception as e:
+        print(f"[Error] while running the radiomics extraction: {e}")
+        return 2
+    finally:
+        if tracker is not None:
+            tracker.stopTimer()
+    elapsed = time.time() - start
+
+    if args.features and args.speedup:
+        reportSpeedup(worklist, params, runner)
+
+    print(f"Radiomics work is done: {summary['done']} done, {summary['failed']} failed, {summary['missing']} missing, {summary['invalid']} invalid, {summary['skipped']} done by other runners of {summary['items']} in {elapsed:.1f} s")
+    return 0 if (summary['failed'] + summary['missing'] + summary['invalid']) == 0 else 1
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,320 @@
+'''
+Radiomics DICOM input
+
+The worklist accepts a DICOM series directory as volume (or mask) and a DICOM-SEG or
+RTSTRUCT file as mask. The slices of a series are decoded by a thread pool and assembled
+into one volume, which is kept in a persistent compressed cache (nrrd) keyed by the series
+UID and the files of the series: later extractions of the same series read the cached
+volume and skip the DICOM parsing. A directory is recognized from a listing of its files
+(names, sizes, modification times), the DICOM headers are not read for a cached series.
+
+DICOM-SEG and RTSTRUCT masks are converted to a label map on the grid of the volume, they
+need pydicom (pip install pydicom)
+
+'''
+
+import os
+import json
+import hashlib
+import concurrent.futures
+
+from rdmcache import diskCache
+
+
+# Persistent cache of the assembled series, None when not used, and decode threads per process
+_seriesCache = None
+_decodeThreads = min(8, os.cpu_count() or 1)
+
+
+def setSeriesCache(directory, maxBytes=10 * 1024 * 1024 * 1024):
+    global _seriesCache
+    _seriesCache = diskCache(directory, maxBytes) if directory else None
+
+
+def setDecodeThreads(threads):
+    global _decodeThreads
+    _decodeThreads = max(1, int(threads))
+
+
+def isDicomFile(path):
+    # Extension, or the DICM magic after the 128 bytes preamble
+    if not os.path.isfile(path):
+        return False
+    if os.path.splitext(path)[1].lower() in ('.dcm', '.ima'):
+        return True
+    try:
+        with open(path, 'rb') as fp:
+            fp.seek(128)
+            return fp.read(4) == b'DICM'
+    except OSError:
+        return False
+
+
+def directoryFingerprint(directory):
+    # Cheap identity of a series directory, no file is opened
+    sha = hashlib.sha256()
+    sha.update(os.path.abspath(directory).encode('utf-8'))
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.is_file():
+            stat = entry.stat()
+            sha.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns}\x1f".encode('utf-8'))
+    return sha.hexdigest()
+
+
+def seriesFiles(directory):
+    # The largest series when the directory holds several (e.g. localizer and axial series)
+    import SimpleITK as sitk
+    seriesIDs = sitk.ImageSeriesReader.GetGDCMSeriesIDs(str(directory))
+    if not seriesIDs:
+        raise ValueError(f"No DICOM series in {directory}")
+    series = [(uid, list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(str(directory), uid))) for uid in seriesIDs]
+    return max(series, key=lambda item: len(item[1]))
+
+
+def seriesKey(uid, files):
+    sha = hashlib.sha256()
+    sha.update(uid.encode('utf-8'))
+    for fileName in files:
+        stat = os.stat(fileName)
+        sha.update(f"{os.path.basename(fileName)}:{stat.st_size}:{stat.st_mtime_ns}\x1f".encode('utf-8'))
+    return sha.hexdigest()
+
+
+def decodeSeries(files, threads=None):
+    # Slices decoded in parallel (GDCM releases the GIL), stacked in the order of their
+    # position along the normal of the slices
+    import numpy
+    import SimpleITK as sitk
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads or _decodeThreads) as executor:
+        slices = list(executor.map(lambda fileName: sitk.ReadImage(str(fileName)), files))
+    if slices[0].GetDimension() != 3 or any(image.GetNumberOfComponentsPerPixel() > 1 for image in slices):
+        # Multi-frame or color files, left to the series reader
+        reader = sitk.ImageSeriesReader()
+        reader.SetFileNames([str(fileName) for fileName in files])
+        return reader.Execute()
+
+    normal = numpy.array(slices[0].GetDirection()).reshape(3, 3)[:, 2]
+    positions = [float(numpy.dot(normal, image.GetOrigin())) for image in slices]
+    order = sorted(range(len(slices)), key=positions.__getitem__)
+    slices = [slices[index] for index in order]
+    positions = [positions[index] for index in order]
+
+    arrays = [sitk.GetArrayViewFromImage(image) for image in slices]
+    dtype = numpy.result_type(*[array.dtype for array in arrays])
+    volume = numpy.empty((len(arrays),) + arrays[0].shape[-2:], dtype=dtype)
+    for index, array in enumerate(arrays):
+        volume[index] = array.reshape(array.shape[-2:])
+
+    spacing = list(slices[0].GetSpacing())
+    if len(slices) > 1:
+        gaps = numpy.diff(positions)
+        spacing[2] = float(gaps.mean())
+        if gaps.max() - gaps.min() > 0.01 * max(spacing[2], 1e-6):
+            print(f"[Warning] uneven slice spacing ({gaps.min():.3f} to {gaps.max():.3f} mm), the mean spacing is used")
+    image = sitk.GetImageFromArray(volume)
+    image.SetOrigin(slices[0].GetOrigin())
+    image.SetSpacing(spacing)
+    image.SetDirection(slices[0].GetDirection())
+    return image
+
+
+def cachedSeries(directory):
+    # Path of the cached volume of a series directory, None when it is not cached
+    if _seriesCache is None:
+        return None
+    pointer = _seriesCache.path(directoryFingerprint(directory), '.series')
+    try:
+        with open(pointer, 'r') as fp:
+            path = _seriesCache.path(json.load(fp)['key'], '.nrrd')
+    except (OSError, ValueError, KeyError):
+        return None
+    if not os.path.exists(path):
+        return None
+    _seriesCache.touch(pointer)
+    _seriesCache.touch(path)
+    return path
+
+
+def readSeries(directory):
+    import SimpleITK as sitk
+    path = cachedSeries(directory)
+    if path is not None:
+        try:
+            return sitk.ReadImage(path)
+        except Exception as e:
+            print(f"[Error] while reading the cached series {path}: {e}")
+
+    uid, files = seriesFiles(directory)
+    image = decodeSeries(files)
+    if _seriesCache is not None:
+        key = seriesKey(uid, files)
+        try:
+            path = _seriesCache.path(key, '.nrrd')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            writer = sitk.ImageFileWriter()
+            writer.SetImageIO('NrrdImageIO')
+            writer.SetFileName(tmp)
+            writer.UseCompressionOn()
+            writer.Execute(image)
+            os.replace(tmp, path)
+            _seriesCache.added(path)
+
+            pointer = _seriesCache.path(directoryFingerprint(directory), '.series')
+            os.makedirs(os.path.dirname(pointer), exist_ok=True)
+            with open(f"{pointer}.{os.getpid()}.tmp", 'w') as fp:
+                json.dump({'key': key, 'seriesUID': uid, 'directory': os.path.abspath(directory)}, fp)
+            os.replace(f"{pointer}.{os.getpid()}.tmp", pointer)
+            _seriesCache.added(pointer)
+        except Exception as e:
+            print(f"[Error] while saving the series {uid} in the cache: {e}")
+    return image
+
+
+def seriesGeometry(directory):
+    # Geometry from the cached volume header, or from the headers of the first and last slices
+    import numpy
+    import SimpleITK as sitk
+    path = cachedSeries(directory)
+    files = None
+    if path is None:
+        uid, files = seriesFiles(directory)
+        path = files[0]
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    geometry = {
+        'size': tuple(reader.GetSize()),
+        'spacing': tuple(reader.GetSpacing()),
+        'origin': tuple(reader.GetOrigin()),
+        'direction': tuple(reader.GetDirection()),
+        'components': reader.GetNumberOfComponents(),
+    }
+    if files is not None and len(files) > 1 and len(geometry['size']) == 3:
+        last = sitk.ImageFileReader()
+        last.SetFileName(str(files[-1]))
+        last.ReadImageInformation()
+        normal = numpy.array(geometry['direction']).reshape(3, 3)[:, 2]
+        distance = float(numpy.dot(normal, numpy.array(last.GetOrigin()) - numpy.array(geometry['origin'])))
+        if distance < 0:
+            geometry['origin'] = tuple(last.GetOrigin())
+        geometry['size'] = geometry['size'][:2] + (len(files),)
+        geometry['spacing'] = geometry['spacing'][:2] + (abs(distance) / (len(files) - 1),)
+    return geometry
+
+
+def readDataset(path, pixels=True):
+    try:
+        import pydicom
+    except ImportError:
+        raise ImportError("DICOM-SEG and RTSTRUCT masks need pydicom: pip install pydicom")
+    return pydicom.dcmread(str(path), stop_before_pixels=not pixels)
+
+
+def segmentationLabels(path):
+    # {label: name} of a DICOM-SEG (segment numbers) or RTSTRUCT (position of the ROI in the
+    # structure set, ROIs with contours only), None for another DICOM object
+    dataset = readDataset(path, pixels=False)
+    modality = getattr(dataset, 'Modality', None)
+    if modality == 'SEG':
+        return {int(segment.SegmentNumber): str(getattr(segment, 'SegmentLabel', '')) for segment in dataset.SegmentSequence}
+    if modality == 'RTSTRUCT':
+        contoured = set(int(roi.ReferencedROINumber) for roi in getattr(dataset, 'ROIContourSequence', []) if len(getattr(roi, 'ContourSequence', [])) > 0)
+        return {index + 1: str(roi.ROIName) for index, roi in enumerate(dataset.StructureSetROISequence) if int(roi.ROINumber) in contoured}
+    return None
+
+
+def readSegmentation(path, reference):
+    # Label map of a DICOM-SEG or RTSTRUCT on the grid of the reference volume, other DICOM
+    # files are read as an image
+    import SimpleITK as sitk
+    dataset = readDataset(path)
+    modality = getattr(dataset, 'Modality', None)
+    if modality == 'SEG':
+        labels = segLabelMap(dataset, reference)
+    elif modality == 'RTSTRUCT':
+        labels = rtstructLabelMap(dataset, reference)
+    else:
+        return sitk.ReadImage(str(path))
+    mask = sitk.GetImageFromArray(labels)
+    mask.CopyInformation(reference)
+    return mask
+
+
+def labelArray(reference, labels):
+    import numpy
+    size = reference.GetSize()
+    return numpy.zeros((size[2], size[1], size[0]), dtype=numpy.uint8 if labels < 256 else numpy.uint16)
+
+
+def segLabelMap(dataset, reference):
+    import numpy
+    size = reference.GetSize()
+    if (int(dataset.Columns), int(dataset.Rows)) != (size[0], size[1]):
+        raise ValueError(f"DICOM-SEG grid {dataset.Columns}x{dataset.Rows} differs from the volume {size[0]}x{size[1]}")
+    frames = dataset.pixel_array
+    if frames.ndim == 2:
+        frames = frames[numpy.newaxis]
+    threshold = 0
+    if getattr(dataset, 'SegmentationType', 'BINARY') == 'FRACTIONAL':
+        threshold = float(getattr(dataset, 'MaximumFractionalValue', 255)) / 2.0
+    labels = labelArray(reference, max(int(segment.SegmentNumber) for segment in dataset.SegmentSequence))
+    outside = 0
+    for index, frame in enumerate(dataset.PerFrameFunctionalGroupsSequence):
+        segment = int(frame.SegmentIdentificationSequence[0].ReferencedSegmentNumber)
+        position = tuple(float(value) for value in frame.PlanePositionSequence[0].ImagePositionPatient)
+        z = reference.TransformPhysicalPointToIndex(position)[2]
+        if not 0 <= z < size[2]:
+            outside += 1
+            continue
+        labels[z][frames[index] > threshold] = segment
+    if outside:
+        print(f"[Warning] {outside} DICOM-SEG frames outside of the volume")
+    return labels
+
+
+def rtstructLabelMap(dataset, reference):
+    # Contours rasterized slice by slice (even-odd rule, inner contours are holes), the label
+    # of a ROI is its position in the structure set
+    import numpy
+    size = reference.GetSize()
+    rois = [int(roi.ROINumber) for roi in dataset.StructureSetROISequence]
+    labels = labelArray(reference, len(rois))
+    origin = numpy.array(reference.GetOrigin())
+    toIndex = numpy.linalg.inv(numpy.array(reference.GetDirection()).reshape(3, 3) @ numpy.diag(reference.GetSpacing()))
+    for roiContour in getattr(dataset, 'ROIContourSequence', []):
+        label = rois.index(int(roiContour.ReferencedROINumber)) + 1
+        polygons = dict()
+        for contour in getattr(roiContour, 'ContourSequence', []):
+            points = numpy.array(contour.ContourData, dtype=numpy.float64).reshape(-1, 3)
+            indexes = (points - origin) @ toIndex.T
+            polygons.setdefault(int(round(indexes[:, 2].mean())), []).append(indexes[:, :2])
+        for z, contours in polygons.items():
+            if not 0 <= z < size[2]:
+                continue
+            inside = numpy.zeros((size[1], size[0]), dtype=bool)
+            for polygon in contours:
+                inside ^= fillPolygon(polygon, inside.shape)
+            labels[z][inside] = label
+    return labels
+
+
+def fillPolygon(polygon, shape):
+    # Pixels whose center (integer index) is inside the polygon of continuous indexes (x, y)
+    import numpy
+    inside = numpy.zeros(shape, dtype=bool)
+    x, y = polygon[:, 0], polygon[:, 1]
+    x0, x1 = max(0, int(numpy.floor(x.min()))), min(shape[1] - 1, int(numpy.ceil(x.max())))
+    y0, y1 = max(0, int(numpy.floor(y.min()))), min(shape[0] - 1, int(numpy.ceil(y.max())))
+    if x0 > x1 or y0 > y1:
+        return inside
+    px, py = numpy.meshgrid(numpy.arange(x0, x1 + 1), numpy.arange(y0, y1 + 1))
+    box = numpy.zeros(px.shape, dtype=bool)
+    xn, yn = numpy.roll(x, -1), numpy.roll(y, -1)
+    for index in range(len(x)):
+        if y[index] == yn[index]:
+            continue
+        crosses = (y[index] > py) != (yn[index] > py)
+        box ^= crosses & (px < (xn[index] - x[index]) * (py - y[index]) / (yn[index] - y[index]) + x[index])
+    inside[y0:y1 + 1, x0:x1 + 1] = box
+    return inside
@@ -0,0 +1,651 @@
+'''
+Radiomics extraction engine
+
+Extraction and formatting of the radiomics features for a single case, this module
+does not depend on the user interface and it is the code that runs inside the worker
+processes. radiomics and numpy are imported on first use so that importing the module
+stays cheap for the command line and for the worker start up
+
+'''
+
+import os
+import copy
+import collections
+import json
+import hashlib
+
+from rdmmetrics import stageTimer, resetPeakMemory, peakMemory, setMemoryLimit
+
+
+defaultParams = r'{"setting": {"binWidth": 25.0, "symmetricalGLCM": true}, "featureClass": {"firstorder": null, "glcm": null, "gldm": null, "glrlm": null, "glszm": null, "ngtdm": null, "shape": null, "shape2D": null}, "imageType": {"Original": {} }}'
+
+
+# Extractors are configured once per params set and reused for every case of the worker
+_extractors = dict()
+
+
+def paramsKey(rdm_params):
+    return json.dumps(rdm_params, sort_keys=True)
+
+
+def normalizeParams(rdm_params):
+    # binWidth 25 and 25.0 are the same setting, numbers are compared as floats
+    if isinstance(rdm_params, dict):
+        return {str(key): normalizeParams(value) for key, value in rdm_params.items()}
+    if isinstance(rdm_params, (list, tuple)):
+        return [normalizeParams(value) for value in rdm_params]
+    if isinstance(rdm_params, int) and not isinstance(rdm_params, bool):
+        return float(rdm_params)
+    return rdm_params
+
+
+def paramsDigest(rdm_params):
+    return hashlib.sha256(paramsKey(normalizeParams(rdm_params)).encode('utf-8')).hexdigest()
+
+
+def paramsSets(rdm_params):
+    # One params set (dict) or a list of them, each one a dict or a (name, dict) pair. Returns
+    # [(name, params)], the name is None for a single params set (documents are not tagged)
+    if isinstance(rdm_params, dict):
+        return [(None, rdm_params)]
+    sets = []
+    for index, entry in enumerate(rdm_params):
+        if isinstance(entry, dict):
+            sets.append( (f"params{index + 1}", entry) )
+        else:
+            name, params = entry
+            sets.append( (str(name), params) )
+    if len(set(name for name, params in sets)) != len(sets):
+        raise ValueError("The names of the params sets must be unique")
+    return sets
+
+
+# Settings only used by the feature classes (discretization and matrices), params sets that
+# differ by these settings only share the preprocessing and the filtered images
+featureSettings = ('binWidth', 'binCount', 'symmetricalGLCM', 'weightingNorm', 'distances', 'gldm_a', 'voxelArrayShift')
+
+
+def preprocessingKey(settings):
+    return json.dumps({name: value for name, value in settings.items() if name not in featureSettings}, sort_keys=True, default=str)
+
+
+def getExtractor(rdm_params):
+    # Returns the extractor and the label configured in the params (default 1), the label is
+    # passed explicitly to execute() because execute() keeps the last label in the settings
+    key = paramsKey(rdm_params)
+    extractor = _extractors.get(key)
+    if extractor is None:
+        import radiomics.featureextractor
+        rmics = radiomics.featureextractor.RadiomicsFeatureExtractor()
+        rmics.enableAllFeatures()
+        rmics.loadJSONParams( key )
+        extractor = (rmics, rmics.settings.get('label', 1))
+        if len(_extractors) >= 8:
+            _extractors.clear()
+        _extractors[key] = extractor
+    return extractor
+
+
+def parseLabels(labels):
+    # Labels column of the worklist: empty for the label of the params, "all" for every
+    # label present in the mask, or a list of labels separated by ";" (e.g. 1;2;5)
+    if labels is None or len(labels.strip()) == 0:
+        return None
+    if labels.strip().lower() == 'all':
+        return 'all'
+    return [int(label) for label in labels.replace(',', ';').split(';') if len(label.strip()) > 0]
+
+
+def maskLabels(mask):
+    import SimpleITK as sitk
+    if mask.GetNumberOfComponentsPerPixel() > 1 or mask.GetPixelID() not in (sitk.sitkUInt8, sitk.sitkUInt16, sitk.sitkUInt32, sitk.sitkUInt64, sitk.sitkInt8, sitk.sitkInt16, sitk.sitkInt32, sitk.sitkInt64):
+        mask = sitk.Cast(mask, sitk.sitkUInt32)
+    statistics = sitk.LabelShapeStatisticsImageFilter()
+    statistics.Execute(mask)
+    return [int(label) for label in statistics.GetLabels() if label != 0]
+
+
+def loadVolume(File_volume):
+    # Image file, or DICOM series directory (cached assembled volume when configured)
+    if os.path.isdir(File_volume):
+        from rdmdicom import readSeries
+        return readSeries(File_volume)
+    import SimpleITK as sitk
+    return sitk.ReadImage(str(File_volume))
+
+
+def loadMask(File_mask, image):
+    # DICOM-SEG and RTSTRUCT masks are converted to a label map on the grid of the volume
+    from rdmdicom import isDicomFile, readSegmentation
+    if isDicomFile(File_mask):
+        return readSegmentation(File_mask, image)
+    return loadVolume(File_mask)
+
+
+# Decoded volumes kept by the worker, least recently used first out. Worklists often list the
+# same volume with several segmentations (one per reader), those rows are scheduled together
+_images = collections.OrderedDict()
+_imagesBytes = 0
+_imagesMaxBytes = 2 * 1024 * 1024 * 1024
+_imageStats = {'decodes': 0, 'hits': 0}
+
+
+def setImageCacheSize(maxBytes):
+    global _imagesMaxBytes
+    _imagesMaxBytes = maxBytes
+    _evictImages()
+
+
+def imageBytes(image):
+    return image.GetNumberOfPixels() * image.GetNumberOfComponentsPerPixel() * image.GetSizeOfPixelComponent()
+
+
+def loadCachedVolume(File_volume):
+    global _imagesBytes
+    stat = os.stat(File_volume)
+    key = (os.path.abspath(File_volume), stat.st_size, stat.st_mtime_ns)
+    image = _images.get(key)
+    if image is not None:
+        _images.move_to_end(key)
+        _imageStats['hits'] += 1
+        return image
+
+    image = loadVolume(File_volume)
+    _imageStats['decodes'] += 1
+    size = imageBytes(image)
+    if size <= _imagesMaxBytes:
+        _images[key] = image
+        _imagesBytes += size
+        _evictImages()
+    return image
+
+
+def _evictImages():
+    global _imagesBytes
+    while _images and _imagesBytes > _imagesMaxBytes:
+        key, image = _images.popitem(last=False)
+        _imagesBytes -= imageBytes(image)
+
+
+# Persistent cache of the preprocessed and filtered images cropped to the ROI, None when not used
+_preprocessedCache = None
+
+
+def setPreprocessedCache(directory, maxBytes=20 * 1024 * 1024 * 1024):
+    global _preprocessedCache
+    if directory:
+        from rdmcache import preprocessedCache
+        _preprocessedCache = preprocessedCache(directory, maxBytes)
+    else:
+        _preprocessedCache = None
+
+
+def initWorker(imageCacheBytes, memoryLimit=None, seriesCache=None, decodeThreads=None, preprocessedCache=None):
+    setImageCacheSize(imageCacheBytes)
+    if preprocessedCache is not None:
+        setPreprocessedCache(*preprocessedCache)
+    if memoryLimit:
+        setMemoryLimit(memoryLimit)
+    if seriesCache is not None or decodeThreads is not None:
+        import rdmdicom
+        if seriesCache is not None:
+            rdmdicom.setSeriesCache(*seriesCache)
+        if decodeThreads is not None:
+            rdmdicom.setDecodeThreads(decodeThreads)
+
+
+# Single feature class copies of the extractors, by id of the extractor
+_classExtractors = dict()
+
+
+def classExtractors(rmics):
+    # Shallow copies of the extractor enabling one feature class each (shape excluded), the
+    # computeFeatures of a copy computes that class only so every class is timed on its own
+    entry = _classExtractors.get(id(rmics))
+    if entry is None or entry[0] is not rmics:
+        from radiomics import getFeatureClasses
+        featureClasses = getFeatureClasses()
+        copies = []
+        for featureClassName, featureNames in rmics.enabledFeatures.items():
+            if featureClassName.startswith('shape') or featureClassName not in featureClasses:
+                continue
+            single = copy.copy(rmics)
+            single.enabledFeatures = {featureClassName: featureNames}
+            copies.append( (featureClassName, single) )
+        entry = (rmics, copies)
+        if len(_classExtractors) >= 32:
+            _classExtractors.clear()
+        _classExtractors[id(rmics)] = entry
+    return entry[1]
+
+
+def computeFeatureClasses(rmics, image, mask, imageTypeName, timer, stage, **kwargs):
+    # RadiomicsFeatureExtractor.computeFeatures, timed per feature class
+    featureVector = collections.OrderedDict()
+    for featureClassName, single in classExtractors(rmics):
+        with timer.stage(f'{stage}/{featureClassName}'):
+            featureVector.update(single.computeFeatures(image, mask, imageTypeName, **kwargs))
+    return featureVector
+
+
+def executeStages(rmics, image, mask, label, timer):
+    return executeSets([rmics], image, mask, [label], timer)[0]
+
+
+def executeSets(extractors, image, mask, labels, timer, source=None, memo=None):
+    # Same steps as RadiomicsFeatureExtractor.execute (segment based extraction) with every
+    # stage timed: preprocessing (normalization, resampling, mask checks), shape, and the
+    # filtering and each feature class of every enabled image type. Extractors whose settings
+    # only differ by feature settings (e.g. binWidth) share the preprocessing and each filtered
+    # image is computed once for all the extractors enabling the image type. source (volume
+    # file, mask file) enables the preprocessed image cache, memo keeps the filtered images
+    # between calls with masks of the same region (see executeGroup). Returns one feature
+    # vector per extractor
+    featureVectors = [None] * len(extractors)
+    groups = collections.OrderedDict()
+    for index, (rmics, label) in enumerate(zip(extractors, labels)):
+        rmics.settings['label'] = label
+        groups.setdefault(preprocessingKey(rmics.settings), []).append(index)
+    for indexes in groups.values():
+        for index, featureVector in zip(indexes, executeGroup([extractors[index] for index in indexes], image, mask, labels[indexes[0]], timer, source, memo)):
+            featureVectors[index] = featureVector
+    return featureVectors
+
+
+def executeGroup(extractors, image, mask, label, timer, source=None, memo=None):
+    import numpy
+    import SimpleITK as sitk
+    from radiomics import imageoperations, generalinfo
+
+    rmics = extractors[0]
+    settings = rmics.settings
+    # As execute(): geometryTolerance is the SimpleITK tolerance of the image/mask geometry
+    geometryTolerance = settings.get('geometryTolerance', None)
+    if geometryTolerance is not None:
+        sitk.ProcessObject.SetGlobalDefaultCoordinateTolerance(geometryTolerance)
+        sitk.ProcessObject.SetGlobalDefaultDirectionTolerance(geometryTolerance)
+
+    # Memo of the filtered images for the masks of one image (e.g. perturbed masks), cropped
+    # to memo['region'] (index, size) holding every mask. Only when the preprocessed image
+    # does not depend on the mask (no resampling and no pre-cropping)
+    if memo is not None and (settings.get('resampledPixelSpacing', None) or settings.get('preCrop', False)):
+        memo = None
+
+    # Image types by filter settings, in the order of the first extractor enabling them
+    filters = collections.OrderedDict()
+    for index, extractor in enumerate(extractors):
+        for imageType, customKwargs in extractor.enabledImagetypes.items():
+            filterKey = (imageType, preprocessingKey(customKwargs))
+            filters.setdefault(filterKey, []).append( (index, customKwargs) )
+
+    # Preprocessed image cache: the preprocessed image (the Original image type) and the
+    # filtered images cropped to the ROI. When every entry is there the preprocessing and the
+    # filters are skipped. The resegmentation is not cached, its shape mask is another one
+    cache = _preprocessedCache if source is not None and settings.get('resegmentRange', None) is None else None
+    cached = dict()
+    if cache is not None:
+        with timer.stage('preprocessing'):
+            groupKey = cache.groupKey(source, settings)
+            keys = {None: cache.key(groupKey)}
+            keys.update((filterKey, cache.key(groupKey, filterKey)) for filterKey in filters if filterKey[0] != 'Original')
+            for filterKey, key in keys.items():
+                cached[filterKey] = cache.get(key)
+            for filterKey in filters:
+                if filterKey[0] == 'Original':
+                    cached[filterKey] = cached[None]
+    hit = cache is not None and all(entry is not None for entry in cached.values())
+
+    featureVectors = [collections.OrderedDict() for extractor in extractors]
+    generalInfo = None
+    if settings.get('additionalInfo', True):
+        generalInfo = generalinfo.GeneralInfo()
+        generalInfo.addGeneralSettings(settings)
+        generalInfo.addEnabledImageTypes(rmics.enabledImagetypes)
+
+    resegmentedMask = None
+    imageDiagnostics = dict()
+    if hit:
+        # Cropped preprocessed image and mask, with the image and mask diagnostics
+        images, mask, imageDiagnostics = cached[None]
+        name, image = next(iter(images))
+        with timer.stage('preprocessing'):
+            boundingBox, correctedMask = imageoperations.checkMask(image, mask, **settings)
+    else:
+        with timer.stage('preprocessing'):
+            image, mask = rmics.loadImage(image, mask, generalInfo, **settings)
+            boundingBox, correctedMask = imageoperations.checkMask(image, mask, **settings)
+            if correctedMask is not None:
+                if generalInfo is not None:
+                    generalInfo.addMaskElements(image, correctedMask, label, 'corrected')
+                mask = correctedMask
+                # Resampled on the grid of the image, the region of the memo is not on it
+                memo = None
+
+            if settings.get('resegmentRange', None) is not None:
+                resegmentedMask = imageoperations.resegmentMask(image, mask, **settings)
+                boundingBox, correctedMask = imageoperations.checkMask(image, resegmentedMask, **settings)
+                if generalInfo is not None:
+                    generalInfo.addMaskElements(image, resegmentedMask, label, 'resegmented')
+
+            if cache is not None and cached[None] is None:
+                diagnostics = None
+                if generalInfo is not None:
+                    diagnostics = {name: value for name, value in generalInfo.getGeneralInfo().items() if not name.startswith(('diagnostics_Versions_', 'diagnostics_Configuration_'))}
+                croppedImage, croppedMask = imageoperations.cropToTumorMask(image, mask, boundingBox)
+                cache.put(keys[None], [('original', croppedImage)], croppedMask, diagnostics)
+
+    if generalInfo is not None:
+        diagnostics = collections.OrderedDict(generalInfo.getGeneralInfo())
+        diagnostics.update(imageDiagnostics or dict())
+        for featureVector, extractor in zip(featureVectors, extractors):
+            featureVector.update(diagnostics)
+            if extractor is not rmics:
+                # Same image and mask diagnostics, the configuration is the one of the extractor
+                configuration = generalinfo.GeneralInfo()
+                configuration.addGeneralSettings(extractor.settings)
+                configuration.addEnabledImageTypes(extractor.enabledImagetypes)
+                featureVector.update(configuration.getGeneralInfo())
+
+    shapeMask = resegmentedMask if settings.get('resegmentShape', False) and resegmentedMask is not None else mask
+    with timer.stage('shape'):
+        shapes = dict()
+        for featureVector, extractor in zip(featureVectors, extractors):
+            # Shape features do not depend on the feature settings, computed once per selection
+            shapeKey = paramsKey({name: features for name, features in extractor.enabledFeatures.items() if name.startswith('shape')})
+            if shapeKey not in shapes:
+                shapes[shapeKey] = extractor.computeShape(image, shapeMask, boundingBox, **extractor.settings)
+            featureVector.update(shapes[shapeKey])
+    if resegmentedMask is not None:
+        mask = resegmentedMask
+
+    if memo is not None:
+        regionIndex, regionSize = memo['region']
+        regionMask = sitk.RegionOfInterest(mask, regionSize, regionIndex)
+        regionBox = numpy.array(boundingBox) - numpy.repeat(regionIndex, 2)
+        memoized = memo.setdefault(preprocessingKey(settings), dict())
+
+    for (imageType, filterKey), users in filters.items():
+        args = settings.copy()
+        args.update(users[0][1])
+        entry = cached.get( (imageType, filterKey) )
+        memoEntry = None
+        if entry is not None:
+            # The generators yield the arguments they were given as the image kwargs
+            images, inputMask = entry[0], entry[1]
+            imageGenerator = ((inputImage, imageTypeName, args) for imageTypeName, inputImage in images)
+        elif memo is not None and (imageType, filterKey) in memoized:
+            memoEntry = memoized[(imageType, filterKey)]
+            imageGenerator = iter(memoEntry)
+        else:
+            imageGenerator = getattr(imageoperations, f'get{imageType}Image')(image, mask, **args)
+        store = [] if cache is not None and entry is None and imageType != 'Original' else None
+        memoStore = [] if memo is not None and entry is None and memoEntry is None else None
+        while True:
+            with timer.stage(f'{imageType}/filter'):
+                filtered = next(imageGenerator, None)
+                if filtered is not None:
+                    inputImage, imageTypeName, inputKwargs = filtered
+                    if memoEntry is not None:
+                        inputImage, inputMask = imageoperations.cropToTumorMask(inputImage, regionMask, regionBox)
+                    elif entry is None:
+                        if memoStore is not None:
+                            memoStore.append( (sitk.RegionOfInterest(inputImage, regionSize, regionIndex), imageTypeName, inputKwargs) )
+                        inputImage, inputMask = imageoperations.cropToTumorMask(inputImage, mask, boundingBox)
+                        if store is not None:
+                            store.append( (imageTypeName, inputImage) )
+            if filtered is None:
+                break
+            for index, customKwargs in users:
+                kwargs = inputKwargs
+                if len(extractors) > 1:
+                    kwargs = dict(inputKwargs)
+                    kwargs.update(extractors[index].settings)
+                    kwargs.update(customKwargs)
+                featureVectors[index].update(computeFeatureClasses(extractors[index], inputImage, inputMask, imageTypeName, timer, imageType, **kwargs))
+        if store:
+            with timer.stage(f'{imageType}/filter'):
+                cache.put(keys[(imageType, filterKey)], store, inputMask)
+        if memoStore is not None:
+            memoized[(imageType, filterKey)] = memoStore
+
+    return featureVectors
+
+
+def extractRadiomicsLabels(File_volume, File_mask, rdm_params, labels=None, timer=None):
+    # Returns a list of (label, result), label is None for the default
+    isDone, results = extractRadiomicsSets(File_volume, File_mask, [(None, rdm_params)], labels, timer)
+    return isDone, [(label, result) for name, label, result in results]
+
+
+def extractRadiomicsSets(File_volume, File_mask, sets, labels=None, timer=None, errors=None):
+    # The volume and the mask are read and decoded once, then the features are extracted for
+    # every requested label with every params set. Returns a list of (params set name, label,
+    # result), label is None for the default label of the params set. The error messages are
+    # appended to errors
+    if timer is None:
+        timer = stageTimer()
+    if errors is None:
+        errors = []
+    try:
+        print(f'[1] Loading radiomics ...')
+        extractors = [getExtractor(rdm_params) for name, rdm_params in sets]
+        print(f'[2] Loading files ...')
+        with timer.stage('load'):
+            image = loadCachedVolume(File_volume)
+            mask = loadMask(File_mask, image)
+        if labels == 'all':
+            labels = maskLabels(mask)
+            print(f'Labels present in the mask: {labels}')
+    except Exception as e:
+        print(f"[Error] {e}")
+        errors.append(f"{e}")
+        return False, []
+
+    results = []
+    for label in (labels if labels is not None else [None]):
+        try:
+            print(f'[3] Radiomics extraction ...' if label is None else f'[3] Radiomics extraction, label {label} ...')
+            featureVectors = executeSets([rmics for rmics, defaultLabel in extractors], image, mask, [defaultLabel if label is None else label for rmics, defaultLabel in extractors], timer, (File_volume, File_mask))
+            results.extend( (name, label, featureVector) for (name, rdm_params), featureVector in zip(sets, featureVectors) )
+        except Exception as e:
+            print(f"[Error] {e}" if label is None else f"[Error] label {label}: {e}")
+            errors.append(f"{e}" if label is None else f"label {label}: {e}")
+    print(f'[4] Radiomics features calculated in {timer.result()["wall"]:.2f} s, peak memory {peakMemory()} MB')
+    return len(results) > 0, results
+
+
+def extractPerturbations(File_volume, File_mask, sets, perturbations, labels=None, timer=None, errors=None):
+    # Test-retest mode: the volume and the mask are read once, the mask variants of the
+    # perturbation spec (rdmperturb) are generated in memory for every requested label and
+    # extracted against the same image, the filtered images are computed once for all the
+    # variants of a label. Returns a list of (params set name, label, variant name, result),
+    # the default label is the one of the first params set
+    from rdmperturb import maskVariants, variantRegion, variantImage
+    import SimpleITK as sitk
+    if timer is None:
+        timer = stageTimer()
+    if errors is None:
+        errors = []
+    try:
+        print(f'[1] Loading radiomics ...')
+        extractors = [getExtractor(rdm_params) for name, rdm_params in sets]
+        print(f'[2] Loading files ...')
+        with timer.stage('load'):
+            image = loadCachedVolume(File_volume)
+            mask = loadMask(File_mask, image)
+            maskArray = sitk.GetArrayViewFromImage(mask)
+        if labels == 'all':
+            labels = maskLabels(mask)
+            print(f'Labels present in the mask: {labels}')
+    except Exception as e:
+        print(f"[Error] {e}")
+        errors.append(f"{e}")
+        return False, []
+
+    results = []
+    for label in (labels if labels is not None else [None]):
+        value = extractors[0][1] if label is None else label
+        try:
+            with timer.stage('perturbation'):
+                variants, start = maskVariants(maskArray, value, perturbations)
+                memo = {'region': variantRegion(variants, start)}
+        except Exception as e:
+            print(f"[Error] label {value}: {e}")
+            errors.append(f"label {value}: {e}")
+            continue
+        for variantName, variant in variants:
+            try:
+                print(f'[3] Radiomics extraction, label {value}, {variantName} ...')
+                if not variant.any():
+                    raise ValueError(f"the variant is empty")
+                with timer.stage('perturbation'):
+                    variantMask = variantImage(mask, maskArray, variant, start, value)
+                featureVectors = executeSets([rmics for rmics, defaultLabel in extractors], image, variantMask, [value] * len(extractors), timer, memo=memo)
+                results.extend( (name, label, variantName, featureVector) for (name, rdm_params), featureVector in zip(sets, featureVectors) )
+            except Exception as e:
+                print(f"[Error] label {value}, {variantName}: {e}")
+                errors.append(f"label {value}, {variantName}: {e}")
+    print(f'[4] Radiomics features of the mask variants calculated in {timer.result()["wall"]:.2f} s, peak memory {peakMemory()} MB')
+    return len(results) > 0, results
+
+
+def extractRadiomics(File_volume, File_mask, rdm_params):
+    isDone, results = extractRadiomicsLabels(File_volume, File_mask, rdm_params)
+    if not isDone:
+        return False, None
+    return True, results[0][1]
+
+
+class featureSchema():
+    # Layout of the results of one params set: feature names (converted to one float row) and
+    # diagnostics names with their conversion. It is built from the first result and reused as
+    # long as the results have the same keys. With a feature list (keep) only those features
+    # are in the documents
+    def __init__(self, result, keep=None):
+        import numpy
+        self.names = tuple(result.keys())
+        self.keep = keep
+        self.features = []
+        self.diagnostics = []
+        # Stored names in the order of the result
+        self.order = []
+        for name in self.names:
+            kind = type(result[name])
+            if not name.startswith('diagnostics_') and kind in (numpy.ndarray, numpy.float64):
+                if keep is None or name in keep:
+                    self.features.append(name)
+                    self.order.append(name)
+                continue
+            if kind in (str, tuple):
+                self.diagnostics.append( (name, str) )
+            elif kind is dict:
+                self.diagnostics.append( (name, None) )
+            elif kind in (numpy.ndarray, numpy.float64):
+                self.diagnostics.append( (name, float) )
+            else:
+                # Other values (e.g. the voxel counts of the diagnostics) are not stored, as before
+                continue
+            self.order.append(name)
+
+    def matches(self, result):
+        return tuple(result.keys()) == self.names
+
+    def row(self, result):
+        import numpy
+        return numpy.fromiter(map(result.__getitem__, self.features), dtype=numpy.float64, count=len(self.features))
+
+    def format(self, result, id_):
+        # Returns the document (keys in the order of the result, as before), the float row of
+        # the features and the diagnostics alone
+        diagnostics = dict()
+        for name, convert in self.diagnostics:
+            diagnostics[name] = result[name] if convert is None else convert(result[name])
+        row = self.row(result)
+        values = dict(zip(self.features, row.tolist()))
+        values.update(diagnostics)
+        document = {'_ID_': str(id_)}
+        for name in self.order:
+            document[name] = values[name]
+        return document, row, diagnostics
+
+
+# Schemas by params set, same life time as the extractors
+_schemas = dict()
+
+
+def getSchema(rdm_params, result, keep=None):
+    key = (paramsKey(rdm_params), keep)
+    schema = _schemas.get(key)
+    if schema is None or not schema.matches(result):
+        schema = featureSchema(result, None if keep is None else frozenset(keep))
+        if keep is not None and len(schema.features) < len(keep):
+            computed = set(schema.features)
+            print(f"[Warning] features of the list not extracted: {', '.join(name for name in keep if name not in computed)}")
+        if len(_schemas) >= 8:
+            _schemas.clear()
+        _schemas[key] = schema
+    return schema
+
+
+def formatResult( result, id_, schema=None ):
+    print(f"Formating radiomics result...")
+    try:
+        if schema is None or not schema.matches(result):
+            schema = featureSchema(result)
+        document, row, diagnostics = schema.format(result, id_)
+        return True, document
+    except Exception as e:
+        print(f"[Error] While triying to format radiomics result: {e}")
+        return False, {'_ID_': str(id_)}
+
+
+def processCase(volumes, rdm_params, features=None, perturbations=None):
+    # Runs in the worker process, only the formatted documents go back to the parent,
+    # one document per label when the worklist row has a labels column and per params set
+    # when rdm_params is a list of params sets. features: tuple of the feature names kept in
+    # the documents, None for all. perturbations: spec of the mask variants (rdmperturb), one
+    # document per variant tagged with _PERTURBATION_. The stats of the case (volume decodes,
+    # volume cache hits) are returned with the documents
+    decodes, hits = _imageStats['decodes'], _imageStats['hits']
+    preprocessedHits, preprocessedMisses = (_preprocessedCache.hits, _preprocessedCache.misses) if _preprocessedCache is not None else (0, 0)
+    resetPeakMemory()
+    timer = stageTimer()
+    stats = dict()
+    try:
+        labels = parseLabels(volumes[3]) if len(volumes) > 3 else None
+        sets = paramsSets(rdm_params)
+    except (ValueError, TypeError) as e:
+        print(f"[Error] Invalid labels or params sets for {volumes[0]}: {e}")
+        stats['error'] = f"invalid labels or params sets: {e}"
+        return False, [], stats
+
+    errors = []
+    if perturbations is None:
+        isDone, results = extractRadiomicsSets(volumes[1], volumes[2], sets, labels, timer, errors)
+        results = [(name, label, None, result) for name, label, result in results]
+    else:
+        isDone, results = extractPerturbations(volumes[1], volumes[2], sets, perturbations, labels, timer, errors)
+    params = dict(sets)
+    documents = []
+    with timer.stage('format'):
+        for name, label, variant, result in results:
+            formatDone, dradiomics_document = formatResult( result, volumes[0], getSchema(params[name], result, features) )
+            if formatDone:
+                if label is not None:
+                    dradiomics_document['_LABEL_'] = label
+                if name is not None:
+                    dradiomics_document['_PARAMS_'] = name
+                if variant is not None:
+                    dradiomics_document['_PERTURBATION_'] = variant
+                documents.append(dradiomics_document)
+    stats.update(timer.result())
+    stats['peakRSS'] = peakMemory()
+    stats['worker'] = os.getpid()
+    stats['volumeDecodes'] = _imageStats['decodes'] - decodes
+    stats['volumeHits'] = _imageStats['hits'] - hits
+    if _preprocessedCache is not None:
+        stats['preprocessedHits'] = _preprocessedCache.hits - preprocessedHits
+        stats['preprocessedMisses'] = _preprocessedCache.misses - preprocessedMisses
+    if errors:
+        stats['error'] = '; '.join(errors)
+    return len(documents) > 0, documents, stats
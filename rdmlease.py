@@ -0,0 +1,207 @@
+'''
+Radiomics worklist leases
+
+Shares one worklist between several runners (nodes) through a shared directory, e.g. on an
+NFS mount, without any central service. A runner claims a case by creating its lease file
+atomically (O_CREAT | O_EXCL), keeps the lease alive while the case runs and writes a
+completion marker when the case is stored (by the database writer when there is one).
+Leases not renewed within the lease time belong to a dead runner and are reclaimed by the
+others. A runner whose lease was reclaimed (e.g. a node stalled longer than the lease time)
+finds another owner in the lease file, at its next renewal or when the case ends: the lease
+is lost and the case is left to the new owner
+
+    shared/leases/<case key>.lease
+    shared/done/<case key>.done
+
+'''
+
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+
+
+def caseKey(volumes, paramsHash=None):
+    # Same row (ID, volume, segment, labels) and params -> same key on every node, a shared
+    # directory reused with other params does not skip the cases
+    values = [str(value) for value in volumes]
+    if paramsHash is not None:
+        values.append(paramsHash)
+    return hashlib.sha1('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+class leaseQueue():
+    def __init__(self, directory, leaseTime=600.0, owner=None):
+        self.directory = directory
+        self.leaseTime = leaseTime
+        self.owner = owner if owner else f"{socket.gethostname()}:{os.getpid()}"
+        self.leasesDirectory = os.path.join(directory, 'leases')
+        self.doneDirectory = os.path.join(directory, 'done')
+        os.makedirs(self.leasesDirectory, exist_ok=True)
+        os.makedirs(self.doneDirectory, exist_ok=True)
+
+        self.held = set()
+        self.lost = set()
+        self.lock = threading.Lock()
+        self.heartbeat = None
+        self.stopped = threading.Event()
+        self.reclaimed = 0
+
+    def start(self):
+        # Renews the held leases every third of the lease time
+        self.stopped.clear()
+        self.heartbeat = threading.Thread(target=self.__renew__, daemon=True)
+        self.heartbeat.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeat is not None:
+            self.heartbeat.join()
+            self.heartbeat = None
+        with self.lock:
+            held = list(self.held)
+        for key in held:
+            self.release(key)
+
+    def isHeld(self, key):
+        with self.lock:
+            return key in self.held
+
+    def isLost(self, key):
+        # Checked again in the lease file for a held lease, the last renewal may be old
+        with self.lock:
+            if key in self.lost:
+                return True
+            if key not in self.held:
+                return False
+        return self.__lost__(key, self.__owner__(self.__leasePath__(key)))
+
+    def isDone(self, key):
+        return os.path.exists(self.__donePath__(key))
+
+    def claim(self, key):
+        if self.isDone(key):
+            return False
+        path = self.__leasePath__(key)
+        if self.__create__(path):
+            return self.__claimed__(key)
+
+        # The lease exists, it is taken over only when it has expired
+        try:
+            age = time.time() - os.stat(path).st_mtime
+        except FileNotFoundError:
+            return self.__create__(path) and self.__claimed__(key)
+        if age < self.leaseTime:
+            return False
+
+        # Only one runner manages to rename the expired lease, the others get an error
+        stale = f"{path}.{self.owner.replace(':', '_')}.stale"
+        try:
+            os.rename(path, stale)
+        except OSError:
+            return False
+        try:
+            if time.time() - os.stat(stale).st_mtime < self.leaseTime:
+                # Another runner reclaimed it between the check and the rename, put it back
+                try:
+                    os.link(stale, path)
+                except OSError:
+                    pass
+                return False
+        except OSError:
+            pass
+        finally:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        if self.__create__(path):
+            self.reclaimed += 1
+            print(f"Lease of {key} expired, reclaimed by {self.owner}")
+            return self.__claimed__(key)
+        return False
+
+    def complete(self, key, status='done'):
+        # Failed cases are completed too, another runner would fail the same way. A lost case
+        # is completed by its new owner
+        if self.isLost(key):
+            self.release(key)
+            return
+        try:
+            with open(self.__donePath__(key), 'w') as fp:
+                json.dump({'owner': self.owner, 'time': time.time(), 'status': status}, fp)
+        except Exception as e:
+            print(f"[Error] while writing the completion marker of {key}: {e}")
+        self.release(key)
+
+    def release(self, key):
+        with self.lock:
+            self.held.discard(key)
+            self.lost.discard(key)
+        # The lease file of another owner (lost lease) is left alone
+        path = self.__leasePath__(key)
+        if self.__owner__(path) != self.owner:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def __claimed__(self, key):
+        # A completion marker written meanwhile by another runner wins over the new lease
+        if self.isDone(key):
+            self.release(key)
+            return False
+        with self.lock:
+            self.held.add(key)
+        return True
+
+    def __create__(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'owner': self.owner, 'time': time.time()}, fp)
+        return True
+
+    def __renew__(self):
+        while not self.stopped.wait(self.leaseTime / 3.0):
+            with self.lock:
+                held = list(self.held)
+            for key in held:
+                path = self.__leasePath__(key)
+                if self.__lost__(key, self.__owner__(path)):
+                    continue
+                try:
+                    os.utime(path)
+                except OSError as e:
+                    print(f"[Error] while renewing the lease of {key}: {e}")
+
+    def __lost__(self, key, owner):
+        # Reclaimed by another runner, it runs and stores the case now
+        if owner == self.owner:
+            return False
+        with self.lock:
+            if key not in self.held:
+                return key in self.lost
+            self.held.discard(key)
+            self.lost.add(key)
+        print(f"[Error] lease of {key} lost to {owner or 'another runner'}, the case is dropped here")
+        return True
+
+    def __owner__(self, path):
+        # Owner written in the lease file, None when there is no lease or it can not be read
+        try:
+            with open(path, 'r') as fp:
+                return json.load(fp).get('owner')
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def __leasePath__(self, key):
+        return os.path.join(self.leasesDirectory, f"{key}.lease")
+
+    def __donePath__(self, key):
+        return os.path.join(self.doneDirectory, f"{key}.done")
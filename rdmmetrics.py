@@ -0,0 +1,207 @@
+'''
+Radiomics extraction metrics
+
+stageTimer: wall and CPU time of the stages of one case (image load, preprocessing,
+shape, filtering and feature classes of every image type), used inside the workers.
+
+metricsWriter: writes one json line per case next to the results (metrics.jsonl) and,
+optionally, the totals in the Prometheus textfile format for the node exporter.
+
+failureManifest: the bad cases of the run and their cause (failures.jsonl)
+
+'''
+
+import os
+import sys
+import json
+import time
+import contextlib
+import collections
+
+
+def resetPeakMemory():
+    # Linux only: resets the peak resident set size (VmHWM) so that it is measured per case
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except Exception:
+        return False
+
+
+def peakMemory():
+    # Peak resident set size in MB, since the last resetPeakMemory() where it is supported,
+    # since the process start otherwise. None where it is not available
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except Exception:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def processMemory(pid):
+    # Resident set size of another process in MB, Linux only, None where it is not available
+    try:
+        with open(f'/proc/{pid}/status') as fp:
+            for line in fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except Exception:
+        pass
+    return None
+
+
+def setMemoryLimit(maxBytes):
+    # Address space limit of the current process (RLIMIT_AS), allocations over the limit
+    # raise MemoryError instead of bringing the node to the out of memory killer
+    try:
+        import resource
+    except ImportError:
+        print(f"[Error] the memory limit is not supported on this platform")
+        return False
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            maxBytes = min(maxBytes, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (maxBytes, hard))
+        return True
+    except (ValueError, OSError) as e:
+        print(f"[Error] while setting the memory limit: {e}")
+        return False
+
+
+class stageTimer():
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def add(self, name, wall, cpu):
+        stage = self.stages.setdefault(name, [0.0, 0.0])
+        stage[0] += wall
+        stage[1] += cpu
+
+    def result(self):
+        return {
+            'wall': time.perf_counter() - self.wall,
+            'cpu': time.process_time() - self.cpu,
+            'stages': {name: {'wall': stage[0], 'cpu': stage[1]} for name, stage in self.stages.items()},
+        }
+
+
+class metricsWriter():
+    def __init__(self, directory, prometheusFile=None, suffix=f""):
+        self.metricsFile = os.path.join(directory, f"metrics{suffix}.jsonl")
+        self.prometheusFile = prometheusFile
+        self.fp = open(self.metricsFile, 'a')
+
+        self.cases = collections.Counter()
+        self.stages = collections.OrderedDict()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peakRSS = 0.0
+        self.lastExport = 0.0
+
+    def put(self, volumes, isDone, stats):
+        record = {'_ID_': volumes[0], 'volume': volumes[1], 'mask': volumes[2], 'done': isDone, 'time': time.time()}
+        record.update(stats)
+        self.fp.write(json.dumps(record))
+        self.fp.write('\n')
+        self.fp.flush()
+
+        self.cases['done' if isDone else 'failed'] += 1
+        self.wall += stats.get('wall', 0.0)
+        self.cpu += stats.get('cpu', 0.0)
+        if stats.get('peakRSS') is not None:
+            self.peakRSS = max(self.peakRSS, stats['peakRSS'])
+        for name, stage in stats.get('stages', dict()).items():
+            total = self.stages.setdefault(name, [0.0, 0.0])
+            total[0] += stage['wall']
+            total[1] += stage['cpu']
+
+        if self.prometheusFile and time.monotonic() - self.lastExport > 10.0:
+            self.export()
+
+    def export(self):
+        self.lastExport = time.monotonic()
+        lines = []
+        lines.append('# HELP rdmxtractor_cases_total Cases processed by status')
+        lines.append('# TYPE rdmxtractor_cases_total counter')
+        for status, count in self.cases.items():
+            lines.append(f'rdmxtractor_cases_total{{status="{status}"}} {count}')
+        lines.append('# HELP rdmxtractor_case_seconds_total Wall time spent in the cases')
+        lines.append('# TYPE rdmxtractor_case_seconds_total counter')
+        lines.append(f'rdmxtractor_case_seconds_total {self.wall}')
+        lines.append('# HELP rdmxtractor_stage_seconds_total Wall time spent per stage (image type/feature class)')
+        lines.append('# TYPE rdmxtractor_stage_seconds_total counter')
+        for name, stage in self.stages.items():
+            lines.append(f'rdmxtractor_stage_seconds_total{{stage="{name}"}} {stage[0]}')
+        lines.append('# HELP rdmxtractor_stage_cpu_seconds_total CPU time spent per stage (image type/feature class)')
+        lines.append('# TYPE rdmxtractor_stage_cpu_seconds_total counter')
+        for name, stage in self.stages.items():
+            lines.append(f'rdmxtractor_stage_cpu_seconds_total{{stage="{name}"}} {stage[1]}')
+        lines.append('# HELP rdmxtractor_peak_rss_megabytes Largest peak resident set size of a case')
+        lines.append('# TYPE rdmxtractor_peak_rss_megabytes gauge')
+        lines.append(f'rdmxtractor_peak_rss_megabytes {self.peakRSS}')
+
+        # Written to a temporary file and renamed, the exporter never reads a partial file
+        try:
+            tmp = f"{self.prometheusFile}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as fp:
+                fp.write('\n'.join(lines))
+                fp.write('\n')
+            os.replace(tmp, self.prometheusFile)
+        except Exception as e:
+            print(f"[Error] while writing the Prometheus metrics {self.prometheusFile}: {e}")
+
+    def summary(self):
+        # Stages sorted by wall time, the most expensive first
+        stages = sorted(self.stages.items(), key=lambda item: item[1][0], reverse=True)
+        return {'wall': self.wall, 'cpu': self.cpu, 'peakRSS': self.peakRSS, 'stages': [(name, stage[0], stage[1]) for name, stage in stages]}
+
+    def close(self):
+        self.fp.close()
+        if self.prometheusFile:
+            self.export()
+
+
+class failureManifest():
+    # One json line per bad case (missing files, failed extraction, crash, timeout) with its
+    # cause, the file is only created when there is a failure
+    def __init__(self, directory, suffix=f""):
+        self.failuresFile = os.path.join(directory, f"failures{suffix}.jsonl")
+        self.fp = None
+        self.count = 0
+
+    def put(self, volumes, cause, attempts=1):
+        if self.fp is None:
+            self.fp = open(self.failuresFile, 'a')
+        record = {'_ID_': volumes[0], 'volume': volumes[1], 'mask': volumes[2], 'labels': volumes[3] if len(volumes) > 3 else None, 'cause': cause, 'attempts': attempts, 'time': time.time()}
+        self.fp.write(json.dumps(record))
+        self.fp.write('\n')
+        self.fp.flush()
+        self.count += 1
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
@@ -0,0 +1,200 @@
+'''
+Radiomics mask perturbations
+
+Mask variants of a segmentation for test-retest and robustness studies, generated in memory
+with NumPy array operations on the bounding box of the ROI. The spec (json) lists the
+perturbations, distances and translations in voxels, translations as (x, y, z):
+
+    {"dilate": [1, 2], "erode": [1], "translate": [[1, 0, 0], [0, -2, 0]],
+     "randomize": {"count": 10, "sigma": 2.0, "amplitude": 1.0, "seed": 0}}
+
+The unperturbed mask is always the first variant (original). Contour randomization moves
+the boundary of the ROI with smooth random noise: the box smoothed mask (0.5 on the
+boundary) plus smoothed noise of `amplitude` voxels is thresholded at 0.5. Only the voxels
+of the smoothed boundary band move, there is no island or hole away from the contour
+
+'''
+
+import json
+
+
+perturbationNames = ('dilate', 'erode', 'translate', 'randomize')
+
+
+def readPerturbations(fileName):
+    with open(fileName, 'r') as fp:
+        spec = json.load(fp)
+    variantNames(spec)
+    return spec
+
+
+def variantNames(spec):
+    # Names of the variants of the spec (tag _PERTURBATION_ of the documents), ValueError when
+    # the spec is not valid
+    if not isinstance(spec, dict):
+        raise ValueError("The perturbation spec is a json object")
+    unknown = [name for name in spec if name not in perturbationNames]
+    if unknown:
+        raise ValueError(f"Unknown perturbation(s): {', '.join(unknown)}, known: {', '.join(perturbationNames)}")
+    names = ['original']
+    for radius in spec.get('dilate', []):
+        names.append(f"dilate{int(radius)}")
+    for radius in spec.get('erode', []):
+        names.append(f"erode{int(radius)}")
+    for shift in spec.get('translate', []):
+        if len(shift) != 3:
+            raise ValueError(f"Translation {shift} is not (x, y, z)")
+        names.append('translate' + ''.join(f"{'m' if value < 0 else 'p'}{abs(int(value))}" for value in shift))
+    randomize = spec.get('randomize')
+    if randomize:
+        for index in range(int(randomize.get('count', 1))):
+            names.append(f"randomize{index + 1}")
+    if len(set(names)) != len(names):
+        raise ValueError("The perturbation spec has duplicated variants")
+    return names
+
+
+def margin(spec):
+    # Voxels around the ROI a variant can reach
+    reach = [0]
+    reach += [int(radius) for radius in spec.get('dilate', [])]
+    reach += [abs(int(value)) for shift in spec.get('translate', []) for value in shift]
+    randomize = spec.get('randomize')
+    if randomize:
+        reach.append(int(3 * float(randomize.get('amplitude', 1.0))) + 2)
+    return max(reach)
+
+
+def shifted(array, offset, fill=False):
+    # array moved by offset (z, y, x), filled with `fill` where nothing comes in
+    import numpy
+    result = numpy.full_like(array, fill)
+    target = []
+    source = []
+    for shift, length in zip(offset, array.shape):
+        if abs(shift) >= length:
+            return result
+        target.append(slice(max(0, shift), length + min(0, shift)))
+        source.append(slice(max(0, -shift), length - max(0, shift)))
+    result[tuple(target)] = array[tuple(source)]
+    return result
+
+
+def ballOffsets(radius, flat=False):
+    # Offsets (z, y, x) of the ball of `radius` voxels, a disk in the slice for 2D masks
+    import numpy
+    span = numpy.arange(-radius, radius + 1)
+    zz, yy, xx = numpy.meshgrid([0] if flat else span, span, span, indexing='ij')
+    inside = zz ** 2 + yy ** 2 + xx ** 2 <= radius ** 2
+    return numpy.stack([zz[inside], yy[inside], xx[inside]], axis=1)
+
+
+def dilate(roi, radius):
+    result = roi.copy()
+    for offset in ballOffsets(radius, roi.shape[0] == 1):
+        result |= shifted(roi, tuple(offset))
+    return result
+
+
+def erode(roi, radius):
+    # Outside the array is background, the ROI is eroded from the border of the image too
+    background = ~roi
+    result = background.copy()
+    for offset in ballOffsets(radius, roi.shape[0] == 1):
+        result |= shifted(background, tuple(offset), fill=True)
+    return ~result
+
+
+def smooth(array, width):
+    # Separable box filter of `width` voxels (odd) applied twice, with cumulative sums
+    import numpy
+    half = width // 2
+    for repeat in range(2):
+        for axis in range(array.ndim):
+            if array.shape[axis] == 1:
+                continue
+            padding = [(0, 0)] * array.ndim
+            padding[axis] = (half + 1, half)
+            sums = numpy.cumsum(numpy.pad(array, padding, mode='edge'), axis=axis)
+            upper = [slice(None)] * array.ndim
+            lower = [slice(None)] * array.ndim
+            upper[axis] = slice(width, None)
+            lower[axis] = slice(None, -width)
+            array = (sums[tuple(upper)] - sums[tuple(lower)]) / width
+    return array
+
+
+def randomized(roi, count, sigma=2.0, amplitude=1.0, seed=0):
+    import numpy
+    rng = numpy.random.default_rng(seed)
+    width = 2 * int(round(sigma)) + 1
+    level = smooth(roi.astype(numpy.float64), width)
+    # Slope of the smoothed mask across the boundary, the noise moves it by about amplitude voxels
+    slope = 1.0 / width
+    # float64 cumulative sums, 0 and 1 up to rounding outside of the band
+    band = (level > 1e-9) & (level < 1.0 - 1e-9)
+    # The noise is drawn on a larger box and cropped, the smoothing then averages as many
+    # voxels on the border of the box as inside
+    pad = [0 if length == 1 else width for length in roi.shape]
+    crop = tuple(slice(before, before + length) for before, length in zip(pad, roi.shape))
+    variants = []
+    for index in range(count):
+        noise = rng.standard_normal([length + 2 * before for before, length in zip(pad, roi.shape)]).astype(numpy.float32)
+        noise = smooth(noise, width)[crop]
+        noise /= max(float(noise.std()), 1e-6)
+        variants.append(numpy.where(band, level + amplitude * slope * noise > 0.5, roi))
+    return variants
+
+
+def maskVariants(maskArray, label, spec):
+    # maskArray: (z, y, x) label map. Returns the variants [(name, boolean array)] on the box
+    # of the ROI grown by the margin of the spec, and the start (z, y, x) of that box
+    import numpy
+    roi = maskArray == label
+    if not roi.any():
+        raise ValueError(f"label {label} not in the mask")
+    grow = margin(spec)
+    where = numpy.nonzero(roi)
+    start = [max(0, int(axis.min()) - grow) for axis in where]
+    stop = [min(length, int(axis.max()) + grow + 1) for axis, length in zip(where, maskArray.shape)]
+    box = tuple(slice(begin, end) for begin, end in zip(start, stop))
+    roi = roi[box]
+
+    variants = [('original', roi)]
+    for radius in spec.get('dilate', []):
+        variants.append( (f"dilate{int(radius)}", dilate(roi, int(radius))) )
+    for radius in spec.get('erode', []):
+        variants.append( (f"erode{int(radius)}", erode(roi, int(radius))) )
+    for shift in spec.get('translate', []):
+        name = 'translate' + ''.join(f"{'m' if value < 0 else 'p'}{abs(int(value))}" for value in shift)
+        variants.append( (name, shifted(roi, (int(shift[2]), int(shift[1]), int(shift[0])))) )
+    randomize = spec.get('randomize')
+    if randomize:
+        count = int(randomize.get('count', 1))
+        for index, variant in enumerate(randomized(roi, count, float(randomize.get('sigma', 2.0)), float(randomize.get('amplitude', 1.0)), int(randomize.get('seed', 0)))):
+            variants.append( (f"randomize{index + 1}", variant) )
+    return variants, tuple(start)
+
+
+def variantRegion(variants, start):
+    # (index, size) in SimpleITK (x, y, z) order of the box holding every variant
+    import numpy
+    union = numpy.zeros_like(variants[0][1])
+    for name, variant in variants:
+        union |= variant
+    where = numpy.nonzero(union)
+    low = [int(axis.min()) + begin for axis, begin in zip(where, start)]
+    high = [int(axis.max()) + begin + 1 for axis, begin in zip(where, start)]
+    return [int(value) for value in reversed(low)], [int(end - begin) for begin, end in zip(reversed(low), reversed(high))]
+
+
+def variantImage(mask, maskArray, variant, start, label):
+    # Label map with the geometry of the mask, label on the voxels of the variant
+    import numpy
+    import SimpleITK as sitk
+    array = numpy.zeros(maskArray.shape, dtype=numpy.uint32 if label > 255 else numpy.uint8)
+    box = tuple(slice(begin, begin + length) for begin, length in zip(start, variant.shape))
+    array[box][variant] = label
+    image = sitk.GetImageFromArray(array)
+    image.CopyInformation(mask)
+    return image
@@ -0,0 +1,196 @@
+'''
+Radiomics worker pool
+
+Isolated worker processes for the extraction. Each worker has its own pipe and runs the
+rows of one group at a time, reporting every row it starts and finishes, so the parent
+always knows which case a worker is running. A worker that crashes (segmentation fault,
+killed by the out of memory killer), exceeds the wall clock timeout of a case or the
+resident memory limit is killed and replaced, the case is reported as aborted with its
+cause and the rest of its group is given back to the caller
+
+'''
+
+import os
+import time
+import multiprocessing
+import multiprocessing.connection
+
+from rdmmetrics import processMemory
+
+
+def workerMain(conn, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            return
+        if task is None:
+            return
+        taskId, function, rows, args = task
+        for index, row in enumerate(rows):
+            conn.send( ('started', taskId, index, os.getpid()) )
+            try:
+                result = function(row, *args)
+            except BaseException as e:
+                # MemoryError under the address space limit, or anything processCase let go
+                conn.send( ('error', taskId, index, f"{type(e).__name__}: {e}") )
+                continue
+            conn.send( ('done', taskId, index, result) )
+        conn.send( ('idle', taskId) )
+
+
+class workerPool():
+    def __init__(self, workers, initializer=None, initargs=(), timeout=None, rssLimit=None):
+        self.size = workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.rssLimit = rssLimit
+        self.workers = []
+        self.restarts = 0
+        self.stillborn = 0
+
+    def start(self):
+        for index in range(self.size):
+            self.workers.append(self.__spawn__())
+
+    def idle(self):
+        return sum(1 for worker in self.workers if worker['task'] is None)
+
+    def busy(self):
+        return self.size - self.idle()
+
+    def submit(self, taskId, function, rows, args=()):
+        # Runs function(row, *args) for every row on an idle worker, False when none is idle
+        for worker in self.workers:
+            if worker['task'] is None:
+                worker['task'] = taskId
+                worker['rows'] = len(rows)
+                worker['completed'] = 0
+                worker['started'] = None
+                try:
+                    worker['conn'].send( (taskId, function, rows, args) )
+                except (OSError, ValueError) as e:
+                    # The worker died while idle, the next poll replaces it
+                    worker['sendError'] = f"{e}"
+                return True
+        return False
+
+    def poll(self, timeout=0.25):
+        # Returns the events of the workers:
+        #   ('started', task, row index, pid)
+        #   ('done', task, row index, result)
+        #   ('failed', task, row index, cause)                the row raised, the task goes on
+        #   ('idle', task)                                    every row of the task is done
+        #   ('aborted', task, row index or None, cause, first row not run)
+        # After 'aborted' the worker is replaced and the task is over, the rows from the
+        # first row not run are for the caller to submit again
+        events = []
+        waitables = [worker['conn'] for worker in self.workers] + [worker['process'].sentinel for worker in self.workers]
+        try:
+            multiprocessing.connection.wait(waitables, timeout)
+        except OSError:
+            pass
+
+        now = time.monotonic()
+        for position, worker in enumerate(self.workers):
+            cause = self.__receive__(worker, events)
+            if cause is None and worker['task'] is not None and worker['started'] is not None:
+                if self.timeout is not None and now - worker['started'] > self.timeout:
+                    cause = f"timeout after {self.timeout:.0f} s"
+                elif self.rssLimit is not None:
+                    rss = processMemory(worker['process'].pid)
+                    if rss is not None and rss > self.rssLimit:
+                        cause = f"resident memory {rss:.0f} MB over the limit of {self.rssLimit:.0f} MB"
+            if cause is None and not worker['process'].is_alive():
+                cause = self.__exitCause__(worker['process'])
+            if cause is None:
+                continue
+
+            # The worker is replaced, its case is aborted and the rest of its group given back.
+            # Workers dying before running anything (e.g. the initializer fails) stop the pool
+            if not worker['ran']:
+                self.stillborn += 1
+                if self.stillborn > 2 * self.size:
+                    raise RuntimeError(f"The worker processes fail before running any case: {cause}")
+            if worker['task'] is not None:
+                running = worker['started'] is not None
+                failed = worker['completed'] if running else None
+                events.append( ('aborted', worker['task'], failed, cause, worker['completed'] + (1 if running else 0)) )
+            self.__kill__(worker)
+            self.workers[position] = self.__spawn__()
+            self.restarts += 1
+        return events
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker['conn'].send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker['process'].join(5.0)
+            if worker['process'].is_alive():
+                self.__kill__(worker)
+            worker['conn'].close()
+        self.workers = []
+
+    def __receive__(self, worker, events):
+        # Reads the pending messages of a worker, returns the cause if the worker is lost
+        try:
+            while worker['conn'].poll():
+                message = worker['conn'].recv()
+                status, taskId = message[0], message[1]
+                if status == 'started':
+                    worker['started'] = time.monotonic()
+                    worker['ran'] = True
+                    self.stillborn = 0
+                    events.append(message)
+                elif status == 'done':
+                    worker['started'] = None
+                    worker['completed'] += 1
+                    events.append(message)
+                elif status == 'error':
+                    # The worker survived, the rest of the task goes on
+                    worker['started'] = None
+                    worker['completed'] += 1
+                    events.append( ('failed', taskId, message[2], message[3]) )
+                elif status == 'idle':
+                    worker['task'] = None
+                    worker['started'] = None
+                    events.append(message)
+        except (EOFError, OSError):
+            return self.__exitCause__(worker['process'], wait=True)
+        return worker.pop('sendError', None)
+
+    def __exitCause__(self, process, wait=False):
+        if wait:
+            process.join(1.0)
+        code = process.exitcode
+        if code is None:
+            return f"worker lost"
+        if code < 0:
+            if -code == 9:
+                return f"worker killed (signal 9), probably out of memory"
+            return f"worker crashed (signal {-code})"
+        return f"worker exited with code {code}"
+
+    def __kill__(self, worker):
+        try:
+            worker['process'].kill()
+            worker['process'].join(5.0)
+        except Exception:
+            pass
+        try:
+            worker['conn'].close()
+        except Exception:
+            pass
+
+    def __spawn__(self):
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=workerMain, args=(child, self.initializer, self.initargs), daemon=True)
+        process.start()
+        child.close()
+        return {'process': process, 'conn': conn, 'task': None, 'rows': 0, 'completed': 0, 'started': None, 'ran': False}
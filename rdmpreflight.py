@@ -0,0 +1,167 @@
+'''
+Radiomics worklist preflight
+
+Validation of the worklist before the extraction, without decoding any volume: the
+geometry of the volume and of the mask (size, spacing, origin, direction) is read from the
+file headers. The label checks need the voxels of the mask: it is decoded (small next to
+the volume) and summarized per label (voxels, bounding box), unless its header already
+fails the checks. Rows bound to fail (geometry mismatch, empty mask, missing labels, ROI
+too small) are reported up front. The rows are checked in parallel
+
+'''
+
+import os
+import concurrent.futures
+
+from rdmengine import paramsSets, parseLabels, loadVolume
+from rdmdicom import isDicomFile, seriesGeometry, segmentationLabels
+
+
+def preflightSettings(rdm_params):
+    # The checks follow the settings of the first params set
+    name, params = paramsSets(rdm_params)[0]
+    settings = params.get('setting') or dict()
+    return {
+        'label': int(settings.get('label', 1)),
+        'correctMask': bool(settings.get('correctMask', False)),
+        'geometryTolerance': settings.get('geometryTolerance') or 1e-6,
+        'minimumROIDimensions': int(settings.get('minimumROIDimensions', 2)),
+        'minimumROISize': settings.get('minimumROISize'),
+    }
+
+
+def readGeometry(fileName):
+    if os.path.isdir(fileName):
+        return seriesGeometry(fileName)
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(fileName))
+    reader.ReadImageInformation()
+    return {
+        'size': tuple(reader.GetSize()),
+        'spacing': tuple(reader.GetSpacing()),
+        'origin': tuple(reader.GetOrigin()),
+        'direction': tuple(reader.GetDirection()),
+        'components': reader.GetNumberOfComponents(),
+    }
+
+
+def labelSummary(fileName):
+    # {label: (voxels, bounding box size)} of the mask
+    import SimpleITK as sitk
+    mask = loadVolume(fileName)
+    if mask.GetNumberOfComponentsPerPixel() > 1 or mask.GetPixelID() not in (sitk.sitkUInt8, sitk.sitkUInt16, sitk.sitkUInt32):
+        mask = sitk.Cast(mask, sitk.sitkUInt32)
+    statistics = sitk.LabelShapeStatisticsImageFilter()
+    statistics.Execute(mask)
+    summary = dict()
+    for label in statistics.GetLabels():
+        if label == 0:
+            continue
+        box = statistics.GetBoundingBox(label)
+        summary[int(label)] = (int(statistics.GetNumberOfPixels(label)), tuple(box[len(box) // 2:]))
+    return summary
+
+
+def mismatch(first, second, tolerance):
+    return len(first) != len(second) or any(abs(a - b) > tolerance * max(1.0, abs(a), abs(b)) for a, b in zip(first, second))
+
+
+def checkCase(volumes, settings):
+    # Returns (errors, warnings, header), header has the voxels and ROI voxels used by the
+    # cost scheduling, None when the files can not be read
+    errors = []
+    warnings = []
+    try:
+        volume = readGeometry(volumes[1])
+    except Exception as e:
+        return [f"volume header can not be read: {e}"], warnings, None
+    if volume['components'] > 1:
+        errors.append(f"volume has {volume['components']} components per voxel")
+
+    try:
+        if isDicomFile(volumes[2]):
+            # DICOM-SEG or RTSTRUCT: rasterized on the grid of the volume, the labels come
+            # from the segments or ROIs of the file
+            segments = segmentationLabels(volumes[2])
+            if segments is not None:
+                return checkLabels(volumes, settings, volume, {label: None for label in segments}, errors, warnings)
+        mask = readGeometry(volumes[2])
+    except Exception as e:
+        return errors + [f"mask header can not be read: {e}"], warnings, None
+
+    if len(volume['size']) != len(mask['size']):
+        errors.append(f"volume is {len(volume['size'])}D, mask is {len(mask['size'])}D")
+    else:
+        # correctMask resamples a mask with another geometry onto the volume, a warning only
+        report = warnings if settings['correctMask'] else errors
+        if volume['size'] != mask['size']:
+            report.append(f"size {volume['size']} of the volume, {mask['size']} of the mask")
+        for name in ('spacing', 'origin', 'direction'):
+            if mismatch(volume[name], mask[name], settings['geometryTolerance']):
+                report.append(f"{name} {volume[name]} of the volume, {mask[name]} of the mask")
+
+    if errors:
+        # Bound to fail from the headers, the mask is not decoded
+        return errors, warnings, None
+    try:
+        summary = labelSummary(volumes[2])
+    except Exception as e:
+        errors.append(f"mask can not be read: {e}")
+        return errors, warnings, None
+    return checkLabels(volumes, settings, volume, summary, errors, warnings)
+
+
+def checkLabels(volumes, settings, volume, summary, errors, warnings):
+    # summary: {label: (voxels, bounding box size) or None when unknown before rasterization}
+    labels = parseLabels(volumes[3]) if len(volumes) > 3 else None
+    if not summary:
+        errors.append(f"mask is empty")
+        labels = []
+    elif labels is None:
+        labels = [settings['label']]
+    elif labels == 'all':
+        labels = sorted(summary)
+
+    present = [label for label in labels if label in summary]
+    missing = [label for label in labels if label not in summary]
+    if missing and summary:
+        (errors if not present else warnings).append(f"label(s) {';'.join(str(label) for label in missing)} not in the mask, labels present: {';'.join(str(label) for label in sorted(summary))}")
+    for label in present:
+        if summary[label] is None:
+            continue
+        voxels, box = summary[label]
+        dimensions = sum(1 for length in box if length > 1)
+        small = []
+        if dimensions < settings['minimumROIDimensions']:
+            small.append(f"{dimensions}D")
+        if settings['minimumROISize'] is not None and voxels < settings['minimumROISize']:
+            small.append(f"{voxels} voxels")
+        if small:
+            (errors if len(present) == 1 else warnings).append(f"label {label} ROI too small ({', '.join(small)})")
+
+    voxels = 1
+    for length in volume['size']:
+        voxels *= length
+    roiVoxels = 0
+    for label in present:
+        if summary[label] is None:
+            continue
+        size = 1
+        for length in summary[label][1]:
+            size *= length
+        roiVoxels += size
+    return errors, warnings, {'voxels': voxels, 'roiVoxels': roiVoxels, 'labels': max(1, len(present))}
+
+
+def preflight(worklist, rdm_params, workers=4):
+    # One (errors, warnings, header) per row, the rows are checked in parallel (I/O and
+    # SimpleITK release the GIL)
+    settings = preflightSettings(rdm_params)
+    def check(volumes):
+        try:
+            return checkCase(volumes, settings)
+        except Exception as e:
+            return [f"preflight failed: {e}"], [], None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(check, worklist))
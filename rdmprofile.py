@@ -0,0 +1,175 @@
+'''
+Radiomics extraction profile from a feature list
+
+The models downstream only use a few of the features extracted by the params files, which
+enable every feature class on every image type. From the list of the feature names a model
+needs (e.g. original_firstorder_Mean, wavelet-LLH_glcm_Contrast, log-sigma-3-0-mm-3D_glszm_ZoneEntropy)
+the minimal params are derived: only the image types, LoG sigmas and feature classes with
+the features of the list are enabled, the settings of the params are kept. The documents are
+then reduced to the features of the list (the diagnostics are kept)
+
+'''
+
+import copy
+import json
+import time
+import collections
+
+from rdmengine import paramsSets
+
+
+# Prefix of the feature names (image type name of pyradiomics) -> image type of the params
+imageTypePrefixes = {
+    'original': 'Original',
+    'wavelet': 'Wavelet',
+    'log': 'LoG',
+    'square': 'Square',
+    'squareroot': 'SquareRoot',
+    'logarithm': 'Logarithm',
+    'exponential': 'Exponential',
+    'gradient': 'Gradient',
+}
+
+featureClasses = ('firstorder', 'glcm', 'gldm', 'glrlm', 'glszm', 'ngtdm', 'shape', 'shape2D')
+
+
+def readFeatureList(fileName):
+    # json list (or {"features": [...]}), or text with one name per line or separated by
+    # commas (e.g. the header of a feature matrix, its tag columns are ignored)
+    with open(fileName, 'r') as fp:
+        if fileName.lower().endswith('.json'):
+            names = json.load(fp)
+            if isinstance(names, dict):
+                names = names['features']
+        else:
+            names = []
+            for line in fp:
+                line = line.split('#', 1)[0]
+                names.extend(name.strip().strip('"') for name in line.split(','))
+    features = []
+    for name in names:
+        name = str(name).strip()
+        if name and not (name.startswith('_') and name.endswith('_')) and name not in features:
+            features.append(name)
+    if not features:
+        raise ValueError(f"No feature names in {fileName}")
+    return features
+
+
+def parseFeatureName(name):
+    # Returns (image type, feature class, feature, LoG sigma or None), the image type is None
+    # for the shape features (computed on the original image only)
+    parts = name.split('_')
+    if len(parts) < 3:
+        raise ValueError(f"{name} is not a feature name ({{image type}}_{{feature class}}_{{feature}})")
+    imageTypeName, featureClass, featureName = parts[0], parts[1], '_'.join(parts[2:])
+    if featureClass not in featureClasses:
+        raise ValueError(f"{name}: unknown feature class {featureClass}")
+    if featureClass.startswith('shape'):
+        if imageTypeName != 'original':
+            raise ValueError(f"{name}: shape features are only computed on the original image")
+        return None, featureClass, featureName, None
+
+    prefix = imageTypeName.split('-')[0]
+    sigma = None
+    if prefix == 'lbp':
+        imageType = 'LBP2D' if imageTypeName.startswith('lbp-2D') else 'LBP3D'
+    elif prefix in imageTypePrefixes:
+        imageType = imageTypePrefixes[prefix]
+        if imageType == 'LoG':
+            # log-sigma-3-0-mm-3D: sigma 3.0
+            try:
+                sigma = float(imageTypeName.split('sigma-', 1)[1].split('-mm', 1)[0].replace('-', '.'))
+            except (IndexError, ValueError):
+                raise ValueError(f"{name}: no sigma in the image type {imageTypeName}")
+    else:
+        raise ValueError(f"{name}: unknown image type {imageTypeName}")
+    return imageType, featureClass, featureName, sigma
+
+
+def minimalParams(rdm_params, features, restrict=False):
+    # Returns the params with only the image types and feature classes of the features, and
+    # the warnings. A feature whose image type the params do not enable turns it on with its
+    # default settings, unless restrict (e.g. reduced params for the retries): the feature is
+    # then left out. A list of params sets gives the list of the minimal params sets
+    if not isinstance(rdm_params, dict):
+        warnings = []
+        sets = []
+        for name, params in paramsSets(rdm_params):
+            params, setWarnings = minimalParams(params, features, restrict)
+            sets.append( (name, params) )
+            warnings.extend(f"{name}: {warning}" for warning in setWarnings)
+        return sets, warnings
+
+    errors = []
+    parsed = []
+    for name in features:
+        try:
+            parsed.append(parseFeatureName(name))
+        except ValueError as e:
+            errors.append(f"{e}")
+    if errors:
+        raise ValueError('; '.join(errors))
+
+    enabledTypes = rdm_params.get('imageType') or {'Original': {}}
+    enabledClasses = rdm_params.get('featureClass')
+    warnings = []
+    imageTypes = collections.OrderedDict()
+    classes = collections.OrderedDict()
+    sigmas = set()
+    for imageType, featureClass, featureName, sigma in parsed:
+        if imageType is not None and imageType not in enabledTypes:
+            if restrict:
+                continue
+            if imageType not in imageTypes:
+                warnings.append(f"image type {imageType} is not enabled in the params, enabled for the features of the list")
+        if enabledClasses is not None and featureClass not in enabledClasses:
+            if restrict:
+                continue
+            warnings.append(f"feature class {featureClass} is not enabled in the params")
+        if imageType is not None:
+            imageTypes.setdefault(imageType, copy.deepcopy(enabledTypes.get(imageType) or dict()))
+        if sigma is not None:
+            sigmas.add(sigma)
+        names = classes.setdefault(featureClass, [])
+        if featureName not in names:
+            names.append(featureName)
+
+    if 'LoG' in imageTypes:
+        imageTypes['LoG']['sigma'] = sorted(sigmas)
+
+    params = copy.deepcopy(rdm_params)
+    params['imageType'] = dict(imageTypes)
+    params['featureClass'] = dict(classes)
+    return params, sorted(set(warnings))
+
+
+def profileSummary(rdm_params, minimal):
+    # Derived images and feature classes of the full params and of the minimal params
+    from rdmschedule import derivedImages
+    def classes(params):
+        return sum(len(sets.get('featureClass') or featureClasses) for name, sets in paramsSets(params))
+    return {'images': (derivedImages(rdm_params)[0], derivedImages(minimal)[0]), 'classes': (classes(rdm_params), classes(minimal))}
+
+
+def measureSpeedup(volumes, rdm_params, minimal, features, repeat=1):
+    # Times the extraction of one case with the full params and with the minimal params in
+    # this process, the first run of each warms up the extractor and is not measured.
+    # Returns (full seconds, minimal seconds, features in the documents of each)
+    from rdmengine import processCase
+
+    def measure(params, keep):
+        isDone, documents, stats = processCase(volumes, params, keep)
+        if not isDone:
+            raise RuntimeError(stats.get('error', f"extraction of {volumes[0]} failed"))
+        wall = 0.0
+        for index in range(repeat):
+            start = time.perf_counter()
+            isDone, documents, stats = processCase(volumes, params, keep)
+            wall += time.perf_counter() - start
+        width = max([sum(1 for name in document if not (name.startswith('_') or name.startswith('diagnostics_'))) for document in documents] + [0])
+        return wall / repeat, width
+
+    full, fullWidth = measure(rdm_params, None)
+    reduced, reducedWidth = measure(minimal, tuple(features))
+    return full, reduced, fullWidth, reducedWidth
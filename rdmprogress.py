@@ -0,0 +1,136 @@
+'''
+Radiomics extraction progress
+
+progressTracker turns the events of radiomicsRunner into progress snapshots: counts per
+status, cases/sec over a rolling window, ETA and the case active on each worker. The
+snapshots are handed to a callback at a fixed refresh rate whatever the number of
+events, the user interface forwards them through a Qt signal and the command line
+prints them. Events inside the refresh interval are coalesced and flushed by tick(),
+called at the refresh rate by a QTimer in the user interface and by the timer thread
+of startTimer() in the command line, which also keeps elapsed and ETA moving during
+long cases
+
+'''
+
+import time
+import threading
+import collections
+
+
+def formatDuration(seconds):
+    if seconds is None:
+        return f"--:--:--"
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}"
+
+
+class progressTracker():
+    def __init__(self, callback, refreshRate=4.0, window=60.0):
+        self.callback = callback
+        self.interval = 1.0 / refreshRate
+        self.window = window
+        self.lock = threading.Lock()
+        self.stopped = None
+        self.reset()
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.lastEmit = 0.0
+        self.running = False
+        self.items = 0
+        self.completed = 0
+        self.counts = collections.Counter()
+        self.active = dict()
+        self.completions = collections.deque()
+
+    def __call__(self, event):
+        # radiomicsRunner listener
+        with self.lock:
+            status = event['status']
+            now = time.monotonic()
+            self.items = event['items']
+            self.running = status != 'finished'
+            if status == 'started':
+                self.active[event['worker']] = (str(event['volumes'][0]), now)
+            elif status != 'finished':
+                self.completed = event['item']
+                self.counts[status] += 1
+                if status in ('done', 'failed'):
+                    self.completions.append(now)
+                    self.__idle__(event['worker'], str(event['volumes'][0]))
+
+            if status != 'finished' and now - self.lastEmit < self.interval:
+                return
+            if status == 'finished':
+                self.active.clear()
+            self.lastEmit = now
+            snapshot = self.__snapshot__(now)
+        self.callback(snapshot)
+
+    def tick(self):
+        # Trailing update: the latest state, unless an event was just emitted
+        with self.lock:
+            now = time.monotonic()
+            if not self.running or now - self.lastEmit < self.interval / 2.0:
+                return
+            self.lastEmit = now
+            snapshot = self.__snapshot__(now)
+        self.callback(snapshot)
+
+    def startTimer(self):
+        # tick() from a thread at the refresh rate, until stopTimer()
+        self.stopTimer()
+        self.stopped = threading.Event()
+        threading.Thread(target=self.__timer__, args=(self.stopped,), daemon=True).start()
+
+    def stopTimer(self):
+        if self.stopped is not None:
+            self.stopped.set()
+            self.stopped = None
+
+    def __timer__(self, stopped):
+        while not stopped.wait(self.interval):
+            self.tick()
+
+    def __idle__(self, worker, ID):
+        # The worker may already have reported its next case, only that case is kept
+        if worker is not None:
+            if worker in self.active and self.active[worker][0] == ID:
+                del self.active[worker]
+            return
+        for worker, (activeID, started) in list(self.active.items()):
+            if activeID == ID:
+                del self.active[worker]
+                return
+
+    def __snapshot__(self, now):
+        # Throughput over the extracted cases of the last `window` seconds, cached, missing and
+        # skipped cases are instantaneous and only count towards the progress
+        while self.completions and now - self.completions[0] > self.window:
+            self.completions.popleft()
+        elapsed = now - self.start
+        span = min(self.window, elapsed)
+        rate = len(self.completions) / span if span > 0 else 0.0
+        remaining = self.items - self.completed
+        eta = remaining / rate if rate > 0 else None
+        return {
+            'items': self.items,
+            'completed': self.completed,
+            'done': self.counts['done'] + self.counts['cached'],
+            'failed': self.counts['failed'],
+            'missing': self.counts['missing'],
+            'invalid': self.counts['invalid'],
+            'cached': self.counts['cached'],
+            'skipped': self.counts['skipped'],
+            'casesPerSecond': rate,
+            'eta': eta,
+            'elapsed': elapsed,
+            'active': {worker: (ID, now - started) for worker, (ID, started) in self.active.items()},
+        }
+
+
+def progressLine(snapshot):
+    active = ', '.join(f"{worker}:{ID}" for worker, (ID, running) in snapshot['active'].items())
+    return (f"[{snapshot['completed']}/{snapshot['items']}] done {snapshot['done']} failed {snapshot['failed']} missing {snapshot['missing']} invalid {snapshot['invalid']}"
+            f" | {snapshot['casesPerSecond']:.2f} cases/s | ETA {formatDuration(snapshot['eta'])}"
+            + (f" | active {active}" if active else f""))
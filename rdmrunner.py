@@ -0,0 +1,857 @@
+'''
+Radiomics worklist runner
+
+Drives the extraction of a whole worklist without any user interface, it is shared by
+the graphical application (radiomicsProgress) and the command line (rdmcli.py).
+Progress is reported to the registered listeners, the database driver is only
+imported when the database option is used. Database writes go through a background
+mongoWriter so the extraction does not wait on the network
+
+'''
+
+import os
+import csv
+import json
+import time
+import collections
+
+from rdmengine import processCase, initWorker, paramsSets, paramsDigest, parseLabels
+from rdmsinks import mongoWriter, featureMatrixWriter, documentName
+from rdmcache import resultCache
+from rdmmetrics import metricsWriter, failureManifest
+from rdmpool import workerPool
+from rdmdicom import setSeriesCache
+from rdmlease import leaseQueue, caseKey
+from rdmschedule import caseHeaders, costModel, memoryModel, caseScheduler
+from rdmpreflight import preflight
+from rdmprofile import parseFeatureName, minimalParams, profileSummary
+from rdmperturb import variantNames
+
+
+def iterWorklist(listFile):
+    # Same format as the "Import List" button: ID, volume file, segment file and
+    # optionally the labels to extract (e.g. 1;2;5 or all)
+    with open(listFile, newline='') as fobj:
+        csvreader = csv.reader(fobj)
+        for rr in csvreader:
+            if len(rr) == 0:
+                continue
+            yield tuple(rr)
+
+
+def readWorklist(listFile):
+    return list(iterWorklist(listFile))
+
+
+class radiomicsRunner():
+    def __init__(self):
+        self.usingDatabase = False
+        self.databaseConnectionString = f""
+        self.database = f""
+        self.collection = f""
+        self.databaseResume = True
+        self.writer = None
+
+        self.worklist = []
+        self.radiomicsParams = None
+        self.outputDirectory = f""
+        self.outputFormat = 'json'
+        self.matrix = None
+        self.workers = 1
+        self.listeners = []
+        self.cacheDirectory = None
+        self.cacheSize = 1024 * 1024 * 1024
+        self.cache = None
+        self.imageCacheSize = 2 * 1024 * 1024 * 1024
+        self.seriesCacheDirectory = None
+        self.seriesCacheSize = 10 * 1024 * 1024 * 1024
+        self.preprocessedCacheDirectory = None
+        self.preprocessedCacheSize = 20 * 1024 * 1024 * 1024
+        self.prometheusFile = None
+        self.metrics = None
+        self.sharedDirectory = None
+        self.leaseTime = 600.0
+        self.leases = None
+        self.paramsHash = None
+        self.scheduling = 'cost'
+        self.scheduler = None
+        self.memoryBudget = None
+        self.memory = None
+        self.headers = dict()
+        self.passedOver = 0
+        self.preflightMode = 'report'
+        self.suffix = f""
+        self.timeout = None
+        self.memoryLimit = None
+        self.rssLimit = None
+        self.retries = 1
+        self.reducedParams = None
+        self.features = None
+        self.perturbations = None
+        self.extractionParams = None
+        self.retryParams = None
+        self.attempts = dict()
+        self.failures = None
+        self.preflightReport = None
+        self.source = None
+        self.stopping = False
+
+    def setUsingDatabase(self, usingdb):
+        if type(usingdb) is bool:
+            self.usingDatabase = usingdb
+        else:
+            raise TypeError("Argument should be a boolean")
+
+    def setDatabaseconnection(self, connstr, database, collection):
+        self.databaseConnectionString = connstr
+        self.database = database
+        self.collection = collection
+
+    def setDatabaseResume(self, resume):
+        # Skip the cases whose documents of the same params are already in the collection, an
+        # interrupted run goes on where it stopped. False extracts them again (upserted)
+        self.databaseResume = resume
+
+    def setWorkingList(self, worklist):
+        self.worklist = worklist
+
+    def setRadiomicsParams(self, params):
+        # One params set, or a list of params sets (dicts or (name, dict) pairs) extracted in
+        # one pass: every case is loaded once and gives one document per params set, tagged
+        # with the name of the set (_PARAMS_)
+        paramsSets(params)
+        self.radiomicsParams = params
+
+    def setOutputDirectory(self, directory):
+        self.outputDirectory = directory
+
+    def setOutputFormat(self, outputFormat):
+        # json: one file per ID, csv/parquet: a single feature matrix for the whole worklist
+        if outputFormat in ('json', 'csv', 'parquet'):
+            self.outputFormat = outputFormat
+        else:
+            raise ValueError(f"Unknown output format: {outputFormat}")
+
+    def setWorkers(self, workers):
+        if type(workers) is int and workers > 0:
+            self.workers = workers
+        else:
+            raise TypeError("Argument should be a positive integer")
+
+    def setCache(self, directory, maxBytes=1024 * 1024 * 1024):
+        # Results cache, None disables it
+        self.cacheDirectory = directory
+        self.cacheSize = maxBytes
+
+    def setImageCache(self, maxBytes):
+        # Memory for the decoded volumes kept by each worker between rows of the same volume
+        self.imageCacheSize = maxBytes
+
+    def setSeriesCache(self, directory, maxBytes=10 * 1024 * 1024 * 1024):
+        # Persistent cache of the volumes assembled from DICOM series directories, None
+        # decodes the series on every run
+        self.seriesCacheDirectory = directory
+        self.seriesCacheSize = maxBytes
+
+    def setPreprocessedCache(self, directory, maxBytes=20 * 1024 * 1024 * 1024):
+        # Persistent cache of the preprocessed and filtered images cropped to the ROI, runs
+        # that only change feature settings (e.g. binWidth) skip the preprocessing and the
+        # filters. None disables it
+        self.preprocessedCacheDirectory = directory
+        self.preprocessedCacheSize = maxBytes
+
+    def setPrometheusFile(self, prometheusFile):
+        # Textfile for the Prometheus node exporter with the stage timings, None disables it
+        self.prometheusFile = prometheusFile
+
+    def setSharedDirectory(self, directory, leaseTime=600.0):
+        # Several runners on the same worklist share the cases through lease files in this
+        # directory (e.g. on NFS), None runs the whole worklist alone
+        self.sharedDirectory = directory
+        self.leaseTime = leaseTime
+
+    def setScheduling(self, scheduling):
+        # cost: parallel runs dispatch the most expensive cases first (estimated from the
+        # headers, refitted from the timings), worklist: the order of the worklist
+        if scheduling in ('cost', 'worklist'):
+            self.scheduling = scheduling
+        else:
+            raise ValueError(f"Unknown scheduling: {scheduling}")
+
+    def setPreflight(self, mode):
+        # Validation of the rows from the headers (and the mask labels) before the extraction.
+        # report (default): the problems are listed, every row is extracted, drop: the rows
+        # with errors are not extracted, off
+        if mode in ('off', 'report', 'drop'):
+            self.preflightMode = mode
+        else:
+            raise ValueError(f"Unknown preflight mode: {mode}")
+
+    def setLimits(self, timeout=None, memoryLimit=None, rssLimit=None):
+        # Wall clock timeout of a case (s), address space limit of the workers (bytes) and
+        # resident memory limit of the workers (bytes), None disables them. With any limit the
+        # cases run in isolated worker processes, even with a single worker
+        self.timeout = timeout
+        self.memoryLimit = memoryLimit
+        self.rssLimit = rssLimit
+
+    def setMemoryBudget(self, maxBytes):
+        # Memory of the machine for the extraction (bytes), None disables it. The cases are
+        # admitted to the workers while the sum of their estimated peak memory stays within
+        # the budget: small cases run on every worker, large ones on fewer. A case larger than
+        # the budget runs alone
+        self.memoryBudget = maxBytes
+
+    def setRetries(self, retries, reducedParams=None):
+        # Cases whose worker crashed, timed out or ran out of memory run again up to `retries`
+        # times, with reducedParams (e.g. without the Wavelet image type) when given
+        if type(retries) is int and retries >= 0:
+            self.retries = retries
+        else:
+            raise TypeError("Argument should be a non negative integer")
+        if reducedParams is not None:
+            paramsSets(reducedParams)
+        self.reducedParams = reducedParams
+
+    def setFeatureList(self, features):
+        # Feature names needed downstream (e.g. by a model), None for all. Only the image types
+        # and feature classes of these features are computed and the documents only have them
+        if features is not None:
+            for name in features:
+                parseFeatureName(name)
+            features = tuple(features)
+        self.features = features
+
+    def setPerturbations(self, spec):
+        # Test-retest mode: every row is extracted with the mask variants of the spec (see
+        # rdmperturb), one document per variant tagged with _PERTURBATION_. None disables it
+        if spec is not None:
+            variantNames(spec)
+        self.perturbations = spec
+
+    def addListener(self, listener):
+        # listener(event), event: {'status', 'volumes', 'item', 'items', 'worker'}. Status is
+        # started, done, failed, missing, invalid, cached, skipped or finished. Listeners are
+        # called from the thread running the worklist
+        self.listeners.append(listener)
+
+    def run(self):
+        try:
+            # A failed open is cleaned up too, __close__ skips what was not opened
+            self.__open__()
+            pending = self.__admit__(self.worklist)
+
+            headers = None
+            if self.preflightMode != 'off' and pending:
+                pending, headers = self.__preflight__(pending)
+
+            groups = self.__groupByVolume__(pending)
+            if self.workers > 1 or self.__isolated__():
+                self.__runParallel__(self.__schedule__(pending, groups, headers))
+            else:
+                self.__runSerial__(collections.deque(groups))
+            print(f"Volume decodes: {self.summary['volumeDecodes']}, saved by the shared volume scheduling: {self.summary['volumeDecodesSaved']}")
+        finally:
+            self.__close__()
+
+        return self.summary
+
+    def serve(self, source, pollInterval=2.0):
+        # Long running mode: the cases come from source.poll() as they arrive (rdmwatch
+        # inboxWatcher or worklistWatcher) and run on a warm worker pool, which keeps the
+        # extractors loaded, until stop() is called. Every case stored, failed or dropped is
+        # reported to source.completed(), which persists it so a restart does not run it again
+        self.worklist = []
+        self.source = source
+        try:
+            self.__open__()
+            self.__runParallel__(collections.deque(), pollInterval)
+        finally:
+            self.source = None
+            self.__close__()
+        return self.summary
+
+    def stop(self):
+        # No case is dispatched anymore, the running cases finish. Thread and signal safe
+        self.stopping = True
+
+    def __open__(self):
+        self.summary = {'items': len(self.worklist), 'done': 0, 'failed': 0, 'missing': 0, 'skipped': 0, 'stored': 0, 'invalid': 0, 'volumeDecodes': 0, 'volumeDecodesSaved': 0, 'preprocessedHits': 0, 'preprocessedMisses': 0}
+        self.item = 0
+        self.stopping = False
+        self.preflightReport = None
+
+        suffix = f""
+        if self.sharedDirectory:
+            self.leases = leaseQueue(self.sharedDirectory, self.leaseTime)
+            self.leases.start()
+            # Files written by this runner only, the output directory may be shared with other nodes
+            suffix = '-' + self.leases.owner.replace(':', '-')
+        self.suffix = suffix
+
+        self.extractionParams = self.radiomicsParams
+        self.retryParams = self.reducedParams
+        if self.features is not None:
+            self.__profile__()
+        self.paramsHash = paramsDigest(self.__cacheParams__())
+        self.headers = dict()
+        self.passedOver = 0
+        self.memory = memoryModel(self.extractionParams) if self.memoryBudget else None
+
+        if self.outputFormat != 'json':
+            # One feature matrix per params set, the params sets have different columns
+            self.matrix = dict()
+            for name, params in paramsSets(self.radiomicsParams):
+                # A restarted service appends to the rows of its previous starts
+                self.matrix[name] = featureMatrixWriter(self.outputDirectory, self.outputFormat, suffix=suffix if name is None else f"{suffix}-{name}", append=self.source is not None)
+        self.metrics = metricsWriter(self.outputDirectory, self.prometheusFile, suffix=suffix)
+        self.failures = failureManifest(self.outputDirectory, suffix=suffix)
+        self.attempts = dict()
+
+        if self.usingDatabase:
+            try:
+                self.writer = mongoWriter(self.databaseConnectionString, self.database, self.collection, paramsHash=self.paramsHash)
+                self.writer.start()
+            except Exception as e:
+                print(f"[Error] while connect to the database: {e}")
+                self.writer = None
+
+        if self.seriesCacheDirectory:
+            # Also used here by the preflight, for the geometry of the cached series
+            setSeriesCache(self.seriesCacheDirectory, self.seriesCacheSize)
+
+        if self.cacheDirectory:
+            try:
+                self.cache = resultCache(self.cacheDirectory, self.cacheSize)
+            except Exception as e:
+                print(f"[Error] while opening the results cache {self.cacheDirectory}: {e}")
+                self.cache = None
+
+    def __admit__(self, rows):
+        # Missing files and cached results are handled first, returns the rows to extract with
+        # their cache keys
+        keys = [None] * len(rows)
+        if self.cache is not None:
+            try:
+                existing = [volumes for volumes in rows if self.__filesExist__(volumes)]
+                existingKeys = iter(self.cache.keys(existing, self.__cacheParams__(), max(4, self.workers)))
+                keys = [next(existingKeys) if self.__filesExist__(volumes) else None for volumes in rows]
+            except Exception as e:
+                print(f"[Error] while hashing the cases for the results cache {self.cacheDirectory}: {e}")
+
+        stored = set()
+        if self.writer is not None and self.databaseResume:
+            stored = self.__storedCases__(rows)
+
+        pending = []
+        for volumes, key in zip(rows, keys):
+            if not self.__filesExist__(volumes):
+                self.__missing__(volumes)
+                continue
+            if str(volumes[0]) in stored:
+                self.__stored__(volumes)
+                continue
+            if self.leases is not None and self.leases.isDone(caseKey(volumes, self.paramsHash)):
+                self.__skipped__(volumes)
+                continue
+            cached = self.__cached__(volumes, key)
+            if cached is not None:
+                self.__saveDocuments__(volumes, True, cached)
+                self.__completed__('cached', volumes)
+                continue
+            pending.append( (volumes, key) )
+        return pending
+
+    def __ingest__(self, pending):
+        # New rows of the source in serve mode, they go through the same checks as a worklist
+        try:
+            rows = self.source.poll()
+        except Exception as e:
+            print(f"[Error] while looking for new cases: {e}")
+            return
+        for volumes, cause in self.source.rejectedRows():
+            self.summary['items'] += 1
+            print(f"[Error] {cause}: {','.join(volumes)}")
+            self.summary['invalid'] += 1
+            self.failures.put(volumes, cause, 0)
+            self.__completed__('invalid', volumes)
+        if not rows:
+            return
+        self.summary['items'] += len(rows)
+        admitted = self.__admit__(rows)
+        if self.preflightMode != 'off' and admitted:
+            admitted, headers = self.__preflight__(admitted)
+        elif self.memory is not None and admitted:
+            self.__readHeaders__(admitted)
+        pending.extend(self.__groupByVolume__(admitted))
+
+    def __close__(self):
+        if self.writer is not None:
+            # Flushed first, the completion markers of the shared worklist wait for it
+            self.writer.close()
+            self.summary['database'] = self.writer.summary()
+            if self.summary['stored']:
+                print(f"Database: {self.summary['stored']} cases already stored, not extracted again")
+            print(f"Database: {self.summary['database']['written']} documents written ({self.summary['database']['throughput']:.1f} docs/s), {self.summary['database']['failed']} failed")
+            for failedID in self.summary['database']['failedIDs']:
+                print(f"[Error] not saved in the database: {failedID}")
+            self.writer = None
+        if self.leases is not None:
+            self.leases.stop()
+            self.summary['leasesReclaimed'] = self.leases.reclaimed
+            print(f"Shared worklist: {self.summary['skipped']} cases done by other runners, {self.leases.reclaimed} expired leases reclaimed")
+            self.leases = None
+        if self.preflightReport is not None:
+            self.preflightReport.close()
+            self.preflightReport = None
+        if self.metrics is not None:
+            self.metrics.close()
+            self.summary['metrics'] = self.metrics.summary()
+            for name, wall, cpu in self.summary['metrics']['stages'][:10]:
+                print(f"Stage {name}: {wall:.1f} s wall, {cpu:.1f} s cpu")
+            self.metrics = None
+        if self.failures is not None:
+            self.failures.close()
+            self.summary['failures'] = {'count': self.failures.count, 'file': self.failures.failuresFile if self.failures.count else None}
+            if self.failures.count:
+                print(f"Failure manifest: {self.failures.count} bad cases in {self.failures.failuresFile}")
+            self.failures = None
+        if self.matrix is not None:
+            for matrix in self.matrix.values():
+                try:
+                    matrix.close()
+                except Exception as e:
+                    print(f"[Error] while closing the feature matrix {matrix.featureFile}: {e}")
+            self.summary['matrix'] = [matrix.featureFile for matrix in self.matrix.values()]
+            self.matrix = None
+        if self.preprocessedCacheDirectory:
+            print(f"Preprocessed image cache: {self.summary['preprocessedHits']} hits, {self.summary['preprocessedMisses']} misses")
+        if self.cache is not None:
+            self.summary['cache'] = self.cache.summary()
+            print(f"Cache: {self.summary['cache']['hits']} hits, {self.summary['cache']['misses']} misses")
+            self.cache = None
+        self.scheduler = None
+        self.__notify__('finished', None)
+
+    def __profile__(self):
+        # Minimal params of the feature list, the retries keep the image types and feature
+        # classes of the reduced params only
+        self.extractionParams, warnings = minimalParams(self.radiomicsParams, self.features)
+        for warning in warnings:
+            print(f"[Warning] feature list: {warning}")
+        if self.reducedParams is not None:
+            self.retryParams, warnings = minimalParams(self.reducedParams, self.features, restrict=True)
+        profile = profileSummary(self.radiomicsParams, self.extractionParams)
+        self.summary['profile'] = dict(profile, features=len(self.features))
+        print(f"Feature list: {len(self.features)} features, {profile['images'][1]} of {profile['images'][0]} derived images, {profile['classes'][1]} of {profile['classes'][0]} feature classes")
+
+    def __cacheParams__(self):
+        # The documents of a feature list are a subset of the extraction and the perturbations
+        # give other documents, both are in the key
+        if self.features is None and self.perturbations is None:
+            return self.extractionParams
+        return [self.extractionParams, sorted(self.features or []), self.perturbations]
+
+    def __groupByVolume__(self, pending):
+        # Groups keep the order of the first row of each volume
+        groups = dict()
+        for volumes, key in pending:
+            groups.setdefault(os.path.abspath(volumes[1]), []).append( (volumes, key) )
+        return list(groups.values())
+
+    def __preflight__(self, pending):
+        # Returns the rows to extract and their headers for the cost scheduling
+        start = time.monotonic()
+        worklist = [volumes for volumes, key in pending]
+        results = preflight(worklist, self.extractionParams, max(4, self.workers))
+        kept = []
+        headers = dict()
+        flagged = 0
+        for (volumes, key), (errors, warnings, header) in zip(pending, results):
+            if header is not None:
+                headers[tuple(volumes)] = header
+            if errors or warnings:
+                flagged += 1
+                # Opened on the first problem of the run, closed with the run
+                if self.preflightReport is None:
+                    self.preflightReport = open(os.path.join(self.outputDirectory, f"preflight{self.suffix}.jsonl"), 'w')
+                self.preflightReport.write(json.dumps({'_ID_': volumes[0], 'volume': volumes[1], 'mask': volumes[2], 'errors': errors, 'warnings': warnings}))
+                self.preflightReport.write('\n')
+                self.preflightReport.flush()
+                for error in errors:
+                    print(f"[Error] preflight {volumes[0]}: {error}")
+                for warning in warnings:
+                    print(f"[Warning] preflight {volumes[0]}: {warning}")
+            if errors and self.preflightMode == 'drop':
+                self.__invalid__(volumes, errors)
+                continue
+            kept.append( (volumes, key) )
+        self.headers.update(headers)
+        print(f"Preflight of {len(worklist)} cases in {time.monotonic() - start:.1f} s: {flagged} with problems" + (f", {self.summary['invalid']} dropped" if self.preflightMode == 'drop' else f""))
+        return kept, headers
+
+    def __schedule__(self, pending, groups, headers=None):
+        # Queue of the groups to dispatch, in the worklist order or the most expensive first.
+        # The headers of the preflight are used when it ran
+        start = time.monotonic()
+        costly = self.scheduling == 'cost' and self.workers >= 2 and len(groups) >= 2
+        if headers is None and (costly or self.memory is not None):
+            self.__readHeaders__(pending)
+        if not costly:
+            return collections.deque(groups)
+        self.scheduler = caseScheduler(costModel(self.extractionParams), self.headers)
+        self.scheduler.extend(groups)
+        print(f"Cost estimates of {len(pending)} cases in {time.monotonic() - start:.1f} s, largest first")
+        return self.scheduler
+
+    def __readHeaders__(self, pending):
+        worklist = [volumes for volumes, key in pending]
+        for volumes, header in zip(worklist, caseHeaders(worklist, self.extractionParams, max(4, self.workers))):
+            if header is not None:
+                self.headers[tuple(volumes)] = header
+
+    def __nextGroup__(self, pending, reserved):
+        # Next group to dispatch. Under a memory budget, the first group when nothing runs,
+        # else the first group (the most expensive with the cost scheduling) whose estimated
+        # peak memory fits in what is left. Groups passed over too often stop the backfilling
+        # until they run, so a large case is not postponed forever. None when nothing fits
+        if self.memory is None or not reserved:
+            self.passedOver = 0
+            return pending.popleft()
+        # The idle workers keep their baseline, the new case takes the place of one of them
+        idle = max(0, self.workers - len(reserved) - 1)
+        free = self.memoryBudget / (1024 * 1024) - sum(reserved.values()) - idle * self.memory.resident(self.__imageCacheSize__() / (1024 * 1024))
+        first = pending.groups[-1] if isinstance(pending, caseScheduler) else pending[0]
+        if self.passedOver > 2 * self.workers:
+            fits = lambda group: group is first and self.__groupMemory__(group) <= free
+        else:
+            fits = lambda group: self.__groupMemory__(group) <= free
+        group = None
+        if isinstance(pending, caseScheduler):
+            group = pending.take(fits)
+        else:
+            for candidate in pending:
+                if fits(candidate):
+                    pending.remove(candidate)
+                    group = candidate
+                    break
+        if group is not None:
+            self.passedOver = 0 if group is first else self.passedOver + 1
+        return group
+
+    def __groupMemory__(self, group):
+        # The rows of a group run one after the other, its peak is the largest of the rows.
+        # Rows without header count as an equal share of the budget
+        share = self.memoryBudget / (1024 * 1024) / self.workers
+        estimates = [self.memory.estimate(self.headers.get(tuple(volumes))) for volumes, key in group]
+        return max(share if estimate is None else estimate for estimate in estimates)
+
+    def __runSerial__(self, pending):
+        initWorker(*self.__workerArgs__(1))
+        deferred = []
+        while (pending or deferred) and not self.stopping:
+            if not pending:
+                pending.extend(self.__reclaim__(deferred))
+                if not pending:
+                    time.sleep(self.__leasePoll__())
+                continue
+            for volumes, key in self.__claim__(pending.popleft(), deferred):
+                self.__printCase__(f"Processing ...", volumes)
+                self.__notify__('started', volumes, os.getpid())
+                isDone, dradiomics_documents, stats = processCase(volumes, self.extractionParams, self.features, self.perturbations)
+                self.__finished__(volumes, key, isDone, dradiomics_documents, stats)
+
+    def __workerArgs__(self, workers):
+        # initWorker arguments, the DICOM decode threads share the cores with the other workers
+        seriesCache = (self.seriesCacheDirectory, self.seriesCacheSize) if self.seriesCacheDirectory else None
+        preprocessedCache = (self.preprocessedCacheDirectory, self.preprocessedCacheSize) if self.preprocessedCacheDirectory else None
+        return (self.__imageCacheSize__(), self.memoryLimit, seriesCache, max(1, (os.cpu_count() or 1) // workers), preprocessedCache)
+
+    def __imageCacheSize__(self):
+        # Under a memory budget the decoded volume cache of a worker is capped to a quarter of
+        # its share of the budget, the cache stays resident between the cases
+        if self.memoryBudget:
+            return min(self.imageCacheSize, self.memoryBudget // (4 * self.workers))
+        return self.imageCacheSize
+
+    def __isolated__(self):
+        return self.timeout is not None or self.memoryLimit is not None or self.rssLimit is not None
+
+    def __runParallel__(self, pending, pollInterval=2.0):
+        # Each group of rows sharing a volume goes to one worker. Groups are dispatched as
+        # workers free up, so the leases of a shared worklist are only taken when a worker is
+        # about to run the case. A crashed or timed out worker is replaced by the pool, its
+        # case is retried or failed and the rest of its group dispatched again. In serve mode
+        # the source is polled for new rows every pollInterval until stop()
+        pool = workerPool(self.workers, initWorker, self.__workerArgs__(self.workers), self.timeout, self.rssLimit / (1024 * 1024) if self.rssLimit else None)
+        pool.start()
+        deferred = []
+        running = dict()
+        reserved = dict()
+        taskId = 0
+        nextPoll = 0.0
+        try:
+            while pending or running or deferred or (self.source is not None and not self.stopping):
+                if self.stopping:
+                    # The rows not dispatched are left for the next run
+                    pending.clear()
+                    deferred.clear()
+                elif self.source is not None and time.monotonic() >= nextPoll:
+                    self.__ingest__(pending)
+                    nextPoll = time.monotonic() + pollInterval
+                while pending and pool.idle():
+                    group = self.__nextGroup__(pending, reserved)
+                    if group is None:
+                        # Not enough memory left, a running case has to finish first
+                        break
+                    group = self.__claim__(group, deferred)
+                    if group:
+                        taskId += 1
+                        if self.memory is not None:
+                            reserved[taskId] = self.__groupMemory__(group)
+                        reduced = self.reducedParams is not None and any(tuple(volumes) in self.attempts for volumes, key in group)
+                        running[taskId] = (group, reduced)
+                        pool.submit(taskId, processCase, [volumes for volumes, key in group], (self.retryParams if reduced else self.extractionParams, self.features, self.perturbations))
+                if not pending and deferred:
+                    pending.extend(self.__reclaim__(deferred))
+                    if pending:
+                        continue
+                if not running:
+                    if deferred:
+                        time.sleep(self.__leasePoll__())
+                    elif self.source is not None and not pending and not self.stopping:
+                        time.sleep(max(0.0, min(pollInterval, nextPoll - time.monotonic())))
+                    continue
+
+                completed = False
+                for event in pool.poll(0.25):
+                    completed = self.__poolEvent__(event, running, pending) or completed
+                for finished in [taskId for taskId in reserved if taskId not in running]:
+                    reserved.pop(finished)
+                if completed and self.scheduler is not None:
+                    self.scheduler.refresh()
+        finally:
+            pool.close()
+            self.summary['workerRestarts'] = pool.restarts
+            if pool.restarts:
+                print(f"Worker processes replaced after a crash, timeout or memory limit: {pool.restarts}")
+            self.scheduler = None
+
+    def __poolEvent__(self, event, running, pending):
+        # Returns True when a case completed
+        status, taskId = event[0], event[1]
+        group, reduced = running[taskId]
+        if status == 'started':
+            volumes = group[event[2]][0]
+            self.__printCase__(f"Processing ...", volumes)
+            self.__notify__('started', volumes, event[3])
+        elif status == 'done':
+            volumes, key = group[event[2]]
+            isDone, dradiomics_documents, stats = event[3]
+            if reduced:
+                # Not the result of the params of the run, it is not cached
+                stats['reducedParams'] = True
+                key = None
+            self.__finished__(volumes, key, isDone, dradiomics_documents, stats)
+            return True
+        elif status == 'failed':
+            self.__aborted__(group[event[2]], event[3], pending)
+        elif status == 'idle':
+            running.pop(taskId)
+        elif status == 'aborted':
+            running.pop(taskId)
+            if event[2] is not None:
+                self.__aborted__(group[event[2]], event[3], pending)
+            rest = group[event[4]:]
+            if rest:
+                pending.extend([rest])
+        return False
+
+    def __aborted__(self, row, cause, pending):
+        volumes, key = row
+        attempts = self.attempts.get(tuple(volumes), 0) + 1
+        self.attempts[tuple(volumes)] = attempts
+        print(f"[Error] {volumes[0]}: {cause}")
+        if attempts <= self.retries:
+            print(f"Retry {attempts}/{self.retries} of {volumes[0]}" + (f" with the reduced params" if self.reducedParams is not None else f""))
+            pending.extend([ [row] ])
+            return
+        self.__finished__(volumes, key, False, [], {'error': cause, 'attempts': attempts})
+
+    def __claim__(self, group, deferred):
+        # Rows leased by another runner are deferred, they come back if that lease expires
+        if self.leases is None:
+            return group
+        claimed = []
+        for volumes, key in group:
+            leaseKey = caseKey(volumes, self.paramsHash)
+            if self.leases.isHeld(leaseKey):
+                claimed.append( (volumes, key) )
+            elif self.leases.isDone(leaseKey):
+                self.__skipped__(volumes)
+            elif self.leases.claim(leaseKey):
+                claimed.append( (volumes, key) )
+            else:
+                deferred.append( (volumes, key) )
+        return claimed
+
+    def __reclaim__(self, deferred):
+        # One pass over the deferred rows: done elsewhere, or claimed here if the lease expired
+        claimed = []
+        waiting = []
+        for volumes, key in deferred:
+            leaseKey = caseKey(volumes, self.paramsHash)
+            if self.leases.isDone(leaseKey):
+                self.__skipped__(volumes)
+            elif self.leases.claim(leaseKey):
+                claimed.append( (volumes, key) )
+            else:
+                waiting.append( (volumes, key) )
+        deferred[:] = waiting
+        return self.__groupByVolume__(claimed)
+
+    def __leasePoll__(self):
+        return min(5.0, self.leaseTime / 10.0)
+
+    def __finished__(self, volumes, key, isDone, dradiomics_documents, stats):
+        self.summary['volumeDecodes'] += stats.get('volumeDecodes', 0)
+        self.summary['volumeDecodesSaved'] += stats.get('volumeHits', 0)
+        self.summary['preprocessedHits'] += stats.get('preprocessedHits', 0)
+        self.summary['preprocessedMisses'] += stats.get('preprocessedMisses', 0)
+        self.metrics.put(volumes, isDone, stats)
+        if isDone and self.scheduler is not None:
+            self.scheduler.observe(volumes, stats)
+        if isDone and self.memory is not None and stats.get('peakRSS') is not None:
+            self.memory.observe(self.headers.get(tuple(volumes)), stats['peakRSS'])
+        if self.leases is not None and self.leases.isLost(caseKey(volumes, self.paramsHash)):
+            # The lease expired while the case ran and another runner took it over, the
+            # results are left to it
+            self.leases.release(caseKey(volumes, self.paramsHash))
+            self.__skipped__(volumes)
+            return
+        self.__saveDocuments__(volumes, isDone, dradiomics_documents, key)
+        if not isDone:
+            self.failures.put(volumes, stats.get('error', f"extraction failed"), stats.get('attempts', self.attempts.get(tuple(volumes), 0) + 1))
+        if self.leases is not None:
+            self.__completeLease__(volumes, isDone)
+        self.__completed__('done' if isDone else 'failed', volumes, stats.get('worker'))
+
+    def __completeLease__(self, volumes, isDone):
+        # With the database the completion marker waits for the writer to flush the documents
+        # of the case, the lease is released without marker when they could not be saved
+        leases = self.leases
+        leaseKey = caseKey(volumes, self.paramsHash)
+        if not isDone or self.writer is None:
+            leases.complete(leaseKey, 'done' if isDone else 'failed')
+            return
+        self.writer.notify(volumes[0], lambda written: leases.complete(leaseKey) if written else leases.release(leaseKey))
+
+    def __skipped__(self, volumes):
+        print(f"Done by another runner, ID:  {volumes[0]}")
+        self.summary['skipped'] += 1
+        self.__completed__('skipped', volumes)
+
+    def __storedCases__(self, rows):
+        # IDs of the rows with every document already in the database: one per label, params
+        # set and variant ("all" labels: at least one)
+        sets = len(paramsSets(self.extractionParams))
+        variants = len(variantNames(self.perturbations)) if self.perturbations else 1
+        expected = dict()
+        for volumes in rows:
+            try:
+                labels = parseLabels(volumes[3]) if len(volumes) > 3 else None
+            except ValueError:
+                labels = None
+            count = (len(labels) if isinstance(labels, list) else 1) * sets * variants
+            expected[str(volumes[0])] = max(expected.get(str(volumes[0]), 0), count)
+        try:
+            return self.writer.stored(list(expected), expected)
+        except Exception as e:
+            print(f"[Error] while looking for the cases already in the database: {e}")
+            return set()
+
+    def __stored__(self, volumes):
+        print(f"Already in the database, ID:  {volumes[0]}")
+        self.summary['stored'] += 1
+        self.__completed__('skipped', volumes)
+
+    def __completed__(self, status, volumes, worker=None):
+        self.item += 1
+        if self.source is not None and status != 'missing':
+            # Files of a missing row may still come, it is not recorded
+            arrival = self.source.completed(volumes, status)
+            if arrival is not None:
+                latency = time.time() - arrival
+                print(f"Case {volumes[0]} {status} {latency:.1f} s after its arrival")
+                self.summary['latencyMax'] = max(self.summary.get('latencyMax', 0.0), latency)
+        self.__notify__(status, volumes, worker)
+
+    def __notify__(self, status, volumes, worker=None):
+        event = {'status': status, 'volumes': volumes, 'item': self.item, 'items': self.summary['items'], 'worker': worker}
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"[Error] in progress listener: {e}")
+
+    def __filesExist__(self, volumes):
+        return os.path.exists(volumes[1]) and os.path.exists(volumes[2])
+
+    def __printCase__(self, status, volumes):
+        print(status)
+        print(f"ID:  {volumes[0]}")
+        print(f"Volume:    {volumes[1]}")
+        print(f"Segment:   {volumes[2]}")
+
+    def __missing__(self, volumes):
+        self.__printCase__(f"[Error] No such file:", volumes)
+        self.summary['missing'] += 1
+        self.failures.put(volumes, f"No such file", 0)
+        self.__completed__('missing', volumes)
+
+    def __invalid__(self, volumes, errors):
+        self.summary['invalid'] += 1
+        self.failures.put(volumes, f"preflight: {'; '.join(errors)}", 0)
+        self.__completed__('invalid', volumes)
+
+    def __cached__(self, volumes, key):
+        if self.cache is None:
+            return None
+        documents = self.cache.get(key)
+        if not documents:
+            return None
+        print(f"Cached result for ID:  {volumes[0]}")
+        dradiomics_documents = []
+        for document in documents:
+            dradiomics_document = dict(document)
+            dradiomics_document['_ID_'] = str(volumes[0])
+            dradiomics_documents.append(dradiomics_document)
+        return dradiomics_documents
+
+    def __saveDocuments__(self, volumes, isDone, dradiomics_documents, key=None):
+        if not isDone:
+            self.summary['failed'] += 1
+            return
+        self.summary['done'] += 1
+        if self.cache is not None and key is not None:
+            self.cache.put(key, dradiomics_documents)
+
+        for dradiomics_document in dradiomics_documents:
+            if self.matrix is not None:
+                try:
+                    self.matrix[dradiomics_document.get('_PARAMS_')].put(dradiomics_document)
+                    if self.source is not None:
+                        # Serve mode, the rows are written as they come
+                        self.matrix[dradiomics_document.get('_PARAMS_')].flush()
+                except Exception as e:
+                    print(f"[Error] while trying to save radiomics result in the feature matrix {volumes[0]}: {e}")
+            else:
+                name = documentName(dradiomics_document)
+                try:
+                    with open(os.path.join(self.outputDirectory, f'{name}.json'), 'w') as fp:
+                        json.dump(dradiomics_document, fp)
+                except Exception as e:
+                    print(f"[Error] while trying to save radiomics result in the file {name}.json: {e}")
+
+            if self.writer is not None:
+                self.writer.put(dradiomics_document)
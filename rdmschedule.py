@@ -0,0 +1,194 @@
+'''
+Radiomics case scheduling
+
+Estimates the cost of every case before dispatch from cheap information: the voxel count
+of the volume header, the bounding boxes of the requested labels in the mask and the
+number of images derived by the enabled image types. Groups of rows are dispatched most
+expensive first, so the large cases do not end the run on a single busy worker, and the
+cost model is refitted from the observed timings as the cases complete. The peak memory of
+the cases is estimated the same way for the admission under a memory budget, refitted from
+the observed peak resident memory
+
+'''
+
+from rdmengine import paramsSets
+from rdmpreflight import preflight
+
+
+def derivedImages(rdm_params):
+    # Number of images the enabled image types derive from the volume, over every params set:
+    # (all the derived images, the ones filtering the whole volume)
+    images = 0
+    filtered = 0
+    for name, params in paramsSets(rdm_params):
+        for imageType, customKwargs in (params.get('imageType') or {'Original': {}}).items():
+            customKwargs = customKwargs or dict()
+            count = 1
+            if imageType == 'Wavelet':
+                count = 7 * int(customKwargs.get('level', params.get('setting', dict()).get('level', 1)) or 1) + 1
+            elif imageType == 'LoG':
+                count = max(1, len(customKwargs.get('sigma', params.get('setting', dict()).get('sigma', [])) or []))
+            elif imageType == 'LBP3D':
+                count = 1 + int(customKwargs.get('lbp3DLevels', 2))
+            images += count
+            if imageType != 'Original':
+                filtered += count
+    return images, filtered
+
+
+def heldImages(rdm_params):
+    # Full size images the largest image type holds at once while filtering, over every
+    # params set: every sub-band of the wavelet levels, the LoG smoothing and its result
+    held = 0
+    for name, params in paramsSets(rdm_params):
+        for imageType, customKwargs in (params.get('imageType') or {'Original': {}}).items():
+            customKwargs = customKwargs or dict()
+            count = 0
+            if imageType == 'Wavelet':
+                count = 8 * int(customKwargs.get('level', params.get('setting', dict()).get('level', 1)) or 1)
+            elif imageType == 'LoG':
+                count = 2
+            elif imageType == 'LBP3D':
+                count = 1 + int(customKwargs.get('lbp3DLevels', 2))
+            elif imageType != 'Original':
+                count = 1
+            held = max(held, count)
+    return held
+
+
+def caseHeaders(worklist, rdm_params, workers=4):
+    # Voxels of the volume header, voxels of the bounding boxes of the requested labels: the
+    # headers of the preflight checks, None where the files can not be read
+    return [header for errors, warnings, header in preflight(worklist, rdm_params, workers)]
+
+
+class costModel():
+    # seconds = w . (prior * x), x = (1, labels, voxels, voxels x filtered images,
+    # ROI voxels x derived images). The weights start at 1 (the prior) and are refitted by
+    # ridge regression towards the prior from the timings of the completed cases
+    prior = (0.5, 0.2, 5e-8, 1e-7, 2e-6)
+
+    def __init__(self, rdm_params, regularization=4.0):
+        self.images, self.filtered = derivedImages(rdm_params)
+        self.regularization = regularization
+        size = len(self.prior)
+        self.weights = [1.0] * size
+        self.ZtZ = [[0.0] * size for index in range(size)]
+        self.Zty = [0.0] * size
+        self.observed = 0
+
+    def features(self, header):
+        if header is None:
+            return None
+        x = (1.0, header['labels'], header['voxels'], header['voxels'] * self.filtered, header['roiVoxels'] * self.images)
+        return [prior * value for prior, value in zip(self.prior, x)]
+
+    def estimate(self, header):
+        z = self.features(header)
+        if z is None:
+            return None
+        return sum(weight * value for weight, value in zip(self.weights, z))
+
+    def observe(self, header, seconds):
+        z = self.features(header)
+        if z is None or seconds is None:
+            return
+        for i in range(len(z)):
+            self.Zty[i] += z[i] * seconds
+            for j in range(len(z)):
+                self.ZtZ[i][j] += z[i] * z[j]
+        self.observed += 1
+        self.__fit__()
+
+    def __fit__(self):
+        import numpy
+        size = len(self.prior)
+        A = numpy.array(self.ZtZ) + self.regularization * numpy.eye(size)
+        b = numpy.array(self.Zty) + self.regularization * numpy.ones(size)
+        try:
+            weights = numpy.linalg.solve(A, b)
+        except numpy.linalg.LinAlgError:
+            return
+        # Every term costs something, a negative weight would invert the order of the cases
+        self.weights = [max(0.05, float(weight)) for weight in weights]
+
+
+class memoryModel(costModel):
+    # Peak resident memory of a case in MB = w . (prior * x), x = (1, voxels x full size
+    # copies, ROI voxels x derived images): the worker with its libraries, the volume, the mask
+    # and the float copies of the preprocessing with the images the largest image type holds
+    # at once, and the ROI crops and matrices of the feature classes. Refitted from the peak
+    # resident memory of the completed cases, the estimates have a safety margin
+    prior = (300.0, 8.0 / (1024 * 1024), 64.0 / (1024 * 1024))
+
+    def __init__(self, rdm_params, regularization=4.0, margin=1.25):
+        costModel.__init__(self, rdm_params, regularization)
+        self.copies = 3 + heldImages(rdm_params)
+        self.margin = margin
+
+    def features(self, header):
+        if header is None:
+            return None
+        x = (1.0, header['voxels'] * self.copies, header['roiVoxels'] * self.images)
+        return [prior * value for prior, value in zip(self.prior, x)]
+
+    def estimate(self, header):
+        estimate = costModel.estimate(self, header)
+        return None if estimate is None else estimate * self.margin
+
+    def resident(self, cacheMB=0.0):
+        # MB an idle worker keeps between the cases: the constant term (interpreter, libraries,
+        # extractors, DICOM state) and its decoded volume cache when full
+        return self.weights[0] * self.prior[0] + cacheMB
+
+
+class caseScheduler():
+    # Pending groups of rows, the most expensive first. Groups whose rows have no header
+    # (unreadable files) are estimated as the average group
+    def __init__(self, model, headers):
+        self.model = model
+        self.headers = headers
+        self.groups = []
+
+    def extend(self, groups):
+        self.groups.extend(groups)
+        self.__sort__()
+
+    def popleft(self):
+        return self.groups.pop()
+
+    def clear(self):
+        self.groups.clear()
+
+    def take(self, fits):
+        # The most expensive group for which fits(group) is true, None when there is none
+        for index in range(len(self.groups) - 1, -1, -1):
+            if fits(self.groups[index]):
+                return self.groups.pop(index)
+        return None
+
+    def observe(self, volumes, stats):
+        if stats.get('wall') is not None:
+            self.model.observe(self.headers.get(tuple(volumes)), stats['wall'])
+
+    def refresh(self):
+        # The estimates change with the weights, the order is updated between dispatches
+        self.__sort__()
+
+    def __estimates__(self, group):
+        return [self.model.estimate(self.headers.get(tuple(volumes))) for volumes, key in group]
+
+    def __sort__(self):
+        costs = [self.__estimates__(group) for group in self.groups]
+        known = [cost for estimates in costs for cost in estimates if cost is not None]
+        average = sum(known) / len(known) if known else 1.0
+        totals = [sum(average if cost is None else cost for cost in estimates) for estimates in costs]
+        # Ascending, popleft() takes the last (most expensive) group
+        order = sorted(range(len(self.groups)), key=totals.__getitem__)
+        self.groups = [self.groups[index] for index in order]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __bool__(self):
+        return len(self.groups) > 0
@@ -0,0 +1,386 @@
+'''
+Radiomics result sinks
+
+Destinations for the formatted radiomics documents other than the per case json file.
+
+mongoWriter: buffered background writer for MongoDB, documents are queued by the
+extraction loop and flushed in bulk by a separate thread. The documents carry the hash of
+the params (_PARAMS_HASH_) and are upserted on a unique index of (_ID_, params hash, tags):
+a rerun replaces the documents instead of duplicating them, and the cases already stored
+are found on the index
+
+featureMatrixWriter: single columnar feature matrix (csv or parquet) written incrementally,
+one row per document with the features as float columns, the diagnostics are kept apart
+in a json lines file
+
+'''
+
+import os
+import csv
+import json
+import math
+import time
+import queue
+import collections
+import threading
+
+
+# Tag fields that identify a document together with _ID_ (e.g. the label of a multi-label case,
+# the params set when several params sets are extracted in one pass, the mask variant of the
+# perturbation mode)
+documentTags = ['_LABEL_', '_PARAMS_', '_PERTURBATION_']
+
+
+def documentKey(document):
+    # A missing tag is null, it matches the documents without the tag only
+    key = {'_ID_': document['_ID_']}
+    for tag in documentTags:
+        key[tag] = document.get(tag)
+    return key
+
+
+def documentName(document):
+    # File name of the document without extension: {ID}, {ID}_label{n}, {ID}_{params set}
+    # or {ID}_label{n}_{params set}, followed by _{variant} in the perturbation mode
+    name = str(document['_ID_'])
+    if '_LABEL_' in document:
+        name += f"_label{document['_LABEL_']}"
+    if '_PARAMS_' in document:
+        name += f"_{document['_PARAMS_']}"
+    if '_PERTURBATION_' in document:
+        name += f"_{document['_PERTURBATION_']}"
+    return name
+
+
+class mongoWriter():
+    def __init__(self, connstr, database, collection, batchSize=100, flushInterval=2.0, queueSize=1000, retries=5, paramsHash=None):
+        self.databaseConnectionString = connstr
+        self.database = database
+        self.collection = collection
+        self.paramsHash = paramsHash
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.retries = retries
+
+        self.queue = queue.Queue(maxsize=queueSize)
+        self.thread = None
+        self.client = None
+
+        self.written = 0
+        self.failed = []
+        self.writeTime = 0.0
+
+    def start(self):
+        import pymongo
+        self.client = pymongo.MongoClient(self.databaseConnectionString)
+        self.__index__()
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+        self.thread.start()
+
+    def put(self, document):
+        # Blocks only when the queue is full, i.e. when the database can not keep up
+        document = dict(document)
+        if self.paramsHash is not None:
+            document['_PARAMS_HASH_'] = self.paramsHash
+        self.queue.put(document)
+
+    def notify(self, ID, callback):
+        # callback(written) once the documents put before are flushed, written is False when
+        # a document of ID could not be saved
+        self.queue.put( (str(ID), callback) )
+
+    def stored(self, IDs, expected=None):
+        # IDs whose documents of the params are already in the collection, at least
+        # expected[ID] of them (labels x params sets x variants). Looked up on the index by
+        # chunks of IDs, only _ID_ is read
+        IDs = list(dict.fromkeys(str(ID) for ID in IDs))
+        found = collections.Counter()
+        for index in range(0, len(IDs), 1000):
+            query = {'_ID_': {'$in': IDs[index:index + 1000]}}
+            if self.paramsHash is not None:
+                query['_PARAMS_HASH_'] = self.paramsHash
+            for document in self.client[self.database][self.collection].find(query, {'_ID_': 1, '_id': 0}):
+                found[document['_ID_']] += 1
+        expected = expected or dict()
+        return set(ID for ID, count in found.items() if count >= expected.get(ID, 1))
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.client is not None:
+            try:
+                self.client.close()
+            except:
+                pass
+            self.client = None
+
+    def summary(self):
+        throughput = self.written / self.writeTime if self.writeTime > 0 else 0.0
+        return {'written': self.written, 'failed': len(self.failed), 'failedIDs': [doc.get('_ID_') for doc in self.failed], 'writeTime': self.writeTime, 'throughput': throughput}
+
+    def __index__(self):
+        # Created once, an existing index is left as is. Documents of runs before the index
+        # may be duplicated, the collection then stays without the unique index
+        import pymongo
+        from pymongo.errors import OperationFailure
+        keys = [('_ID_', pymongo.ASCENDING), ('_PARAMS_HASH_', pymongo.ASCENDING)] + [(tag, pymongo.ASCENDING) for tag in documentTags]
+        try:
+            self.client[self.database][self.collection].create_index(keys, unique=True, name='rdmxtractor_case')
+        except OperationFailure as e:
+            print(f"[Error] while creating the unique index of the collection {self.collection}, duplicated documents? {e}")
+
+    def __run__(self):
+        batch = []
+        callbacks = []
+        deadline = time.monotonic() + self.flushInterval
+        running = True
+        while running:
+            try:
+                document = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                if document is None:
+                    running = False
+                elif isinstance(document, tuple):
+                    callbacks.append(document)
+                else:
+                    batch.append(document)
+            except queue.Empty:
+                pass
+
+            if len(batch) >= self.batchSize or time.monotonic() >= deadline or not running:
+                if batch:
+                    self.__flush__(batch)
+                    batch = []
+                if callbacks:
+                    self.__notify__(callbacks)
+                    callbacks = []
+                deadline = time.monotonic() + self.flushInterval
+
+    def __notify__(self, callbacks):
+        failedIDs = set(str(doc.get('_ID_')) for doc in self.failed)
+        for ID, callback in callbacks:
+            try:
+                callback(ID not in failedIDs)
+            except Exception as e:
+                print(f"[Error] after saving {ID} in the database: {e}")
+
+    def __flush__(self, batch):
+        import pymongo
+        from pymongo.errors import AutoReconnect, ConnectionFailure, NetworkTimeout, BulkWriteError
+
+        # Upserts keyed on the unique index, a retried batch or a rerun does not duplicate the
+        # documents already written
+        requests = [pymongo.ReplaceOne(self.__key__(doc), doc, upsert=True) for doc in batch]
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                self.client[self.database][self.collection].bulk_write(requests, ordered=False)
+                self.written += len(batch)
+                break
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                failedIndex = set(error['index'] for error in errors)
+                for index in failedIndex:
+                    print(f"[Error] while trying to save radiomics result in the database {batch[index].get('_ID_')}")
+                    self.failed.append(batch[index])
+                self.written += len(batch) - len(failedIndex)
+                break
+            except (AutoReconnect, ConnectionFailure, NetworkTimeout) as e:
+                attempt += 1
+                if attempt > self.retries:
+                    print(f"[Error] while trying to save {len(batch)} radiomics results in the database: {e}")
+                    self.failed.extend(batch)
+                    break
+                time.sleep(min(30.0, 0.5 * 2 ** attempt))
+            except Exception as e:
+                print(f"[Error] while trying to save {len(batch)} radiomics results in the database: {e}")
+                self.failed.extend(batch)
+                break
+        self.writeTime += time.monotonic() - start
+
+    def __key__(self, document):
+        key = documentKey(document)
+        key['_PARAMS_HASH_'] = document.get('_PARAMS_HASH_')
+        return key
+
+
+def isFeature(name):
+    return not (name.startswith('_') or name.startswith('diagnostics_'))
+
+
+def isTag(name):
+    return name.startswith('_') and name.endswith('_')
+
+
+class featureMatrixWriter():
+    # append (serve mode): the rows of the previous starts are kept, the csv matrix and the
+    # diagnostics are appended to, a parquet file can not be and gets the start time in its name
+    def __init__(self, directory, outputFormat='csv', rowGroupSize=256, suffix=f"", append=False):
+        if outputFormat not in ('csv', 'parquet'):
+            raise ValueError(f"Unknown feature matrix format: {outputFormat}")
+        self.directory = directory
+        self.outputFormat = outputFormat
+        self.rowGroupSize = rowGroupSize
+        self.append = append
+
+        self.diagnosticsFile = os.path.join(directory, f"diagnostics{suffix}.jsonl")
+        if append and outputFormat == 'parquet':
+            suffix += time.strftime('-%Y%m%d-%H%M%S')
+        self.featureFile = os.path.join(directory, f"features{suffix}.{outputFormat}")
+
+        self.tags = None
+        self.features = None
+        self.rows = []
+        self.written = 0
+        self.ignored = set()
+
+        self.fp = None
+        self.csvwriter = None
+        self.parquetWriter = None
+        if outputFormat == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("The parquet output needs pyarrow: pip install pyarrow")
+        self.diagnostics = open(self.diagnosticsFile, 'a' if append else 'w')
+
+    def put(self, document):
+        if self.features is None:
+            # The columns are fixed by the first document, every row has the same layout
+            self.tags = [name for name in document if isTag(name)]
+            self.features = [name for name in document if isFeature(name)]
+            self.featureSet = set(self.features)
+            self.__open__()
+
+        for name in document:
+            if isFeature(name) and name not in self.featureSet and name not in self.ignored:
+                print(f"[Error] feature {name} of {document.get('_ID_')} is not in the feature matrix columns, ignored")
+                self.ignored.add(name)
+
+        self.rows.append( ([str(document.get(name, '')) for name in self.tags], self.__row__(document)) )
+
+        diagnostics = {name: value for name, value in document.items() if not isFeature(name)}
+        self.diagnostics.write(json.dumps(diagnostics))
+        self.diagnostics.write('\n')
+
+        if len(self.rows) >= self.rowGroupSize:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.outputFormat == 'csv':
+            for tags, values in self.rows:
+                self.csvwriter.writerow(tags + [repr(value) for value in values.tolist()])
+            self.fp.flush()
+        else:
+            import numpy
+            import pyarrow
+            matrix = numpy.vstack([row[1] for row in self.rows])
+            columns = [pyarrow.array([row[0][index] for row in self.rows], type=pyarrow.string()) for index in range(len(self.tags))]
+            columns += [pyarrow.array(matrix[:, index], type=pyarrow.float64()) for index in range(len(self.features))]
+            self.parquetWriter.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+        self.diagnostics.flush()
+        self.written += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        if self.parquetWriter is not None:
+            self.parquetWriter.close()
+            self.parquetWriter = None
+        self.diagnostics.close()
+
+    def __row__(self, document):
+        # Documents of the engine only hold floats in the feature columns, they are converted
+        # in one pass. Missing or non numeric values go through the slow path and become NaN
+        import numpy
+        try:
+            return numpy.fromiter(map(document.get, self.features), dtype=numpy.float64, count=len(self.features))
+        except (TypeError, ValueError):
+            return numpy.array([self.__toFloat__(document.get(name)) for name in self.features], dtype=numpy.float64)
+
+    def __toFloat__(self, value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return math.nan
+
+    def __open__(self):
+        if self.outputFormat == 'csv':
+            header = self.tags + self.features
+            if self.append and self.__appendable__(header):
+                self.fp = open(self.featureFile, 'a', newline='')
+                self.csvwriter = csv.writer(self.fp)
+                return
+            self.fp = open(self.featureFile, 'w', newline='')
+            self.csvwriter = csv.writer(self.fp)
+            self.csvwriter.writerow(header)
+        else:
+            import pyarrow
+            import pyarrow.parquet
+            fields = [pyarrow.field(name, pyarrow.string()) for name in self.tags]
+            fields += [pyarrow.field(name, pyarrow.float64()) for name in self.features]
+            self.schema = pyarrow.schema(fields)
+            self.parquetWriter = pyarrow.parquet.ParquetWriter(self.featureFile, self.schema)
+
+    def __appendable__(self, header):
+        # True when the existing matrix has the same columns, the rows are then appended. A
+        # matrix with other columns (other params) is kept and the rows go to a new file
+        try:
+            with open(self.featureFile, newline='') as fp:
+                existing = next(csv.reader(fp), None)
+        except FileNotFoundError:
+            return False
+        if existing is None:
+            return False
+        if existing != header:
+            name, extension = os.path.splitext(self.featureFile)
+            self.featureFile = f"{name}{time.strftime('-%Y%m%d-%H%M%S')}{extension}"
+            print(f"[Warning] the columns of the existing feature matrix differ, the rows are written to {self.featureFile}")
+            return False
+        # A row cut by a crash is dropped, its case was not recorded as completed
+        with open(self.featureFile, 'rb+') as fp:
+            content = fp.read()
+            if not content.endswith(b'\n'):
+                fp.truncate(content.rindex(b'\n') + 1)
+        return True
+
+
+def loadFeatureMatrix(featureFile):
+    # Returns the row tags (e.g. _ID_), the feature names and the float matrix in one read
+    import numpy
+    if featureFile.endswith('.parquet'):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(featureFile)
+        names = table.column_names
+        tagNames = [name for name in names if isTag(name)]
+        featureNames = [name for name in names if not isTag(name)]
+        tags = {name: table.column(name).to_pylist() for name in tagNames}
+        matrix = numpy.column_stack([table.column(name).to_numpy() for name in featureNames]) if featureNames else numpy.empty((table.num_rows, 0))
+        return tags, featureNames, matrix
+
+    with open(featureFile, newline='') as fp:
+        csvreader = csv.reader(fp)
+        header = next(csvreader)
+        tagNames = [name for name in header if isTag(name)]
+        featureNames = header[len(tagNames):]
+        tags = {name: [] for name in tagNames}
+        blocks = []
+        block = []
+        for row in csvreader:
+            for index, name in enumerate(tagNames):
+                tags[name].append(row[index])
+            block.append(row[len(tagNames):])
+            if len(block) >= 1024:
+                blocks.append(numpy.array(block, dtype=numpy.float64))
+                block = []
+        if block or not blocks:
+            blocks.append(numpy.array(block, dtype=numpy.float64).reshape(len(block), len(featureNames)))
+    return tags, featureNames, numpy.vstack(blocks)
@@ -0,0 +1,179 @@
+'''
+Radiomics case sources for the serve mode
+
+The cases of a long running runner (radiomicsRunner.serve) come from a source polled for
+new rows as they land:
+
+inboxWatcher: an inbox directory where the segmentation pipeline drops {ID}_volume.{ext}
+and {ID}_mask.{ext} (the volume can be a DICOM series directory {ID}_volume, the mask a
+DICOM-SEG or RTSTRUCT file). A case is queued once both are there and have not changed for
+a few seconds, i.e. they are not being copied anymore
+
+worklistWatcher: a worklist CSV (same format as the "Import List" button) the pipeline
+appends rows to. Complete lines only are read, rows whose files are not there yet or have
+changed within the last seconds wait, up to a timeout after which they are reported
+missing. Rows without ID, volume and segment are reported invalid
+
+The completed cases are appended to a state file, a restarted service skips them. A case
+whose files are replaced (new modification time) runs again
+
+'''
+
+import os
+import re
+import csv
+import json
+import time
+import hashlib
+
+
+casePattern = re.compile(r'^(?P<id>.+)_(?P<kind>volume|mask)(\.[^/]*)?$')
+
+
+def lastModified(path):
+    # Latest modification time of a file, or of the files of a directory (DICOM series)
+    stat = os.stat(path)
+    latest = stat.st_mtime
+    if os.path.isdir(path):
+        for entry in os.scandir(path):
+            if entry.is_file():
+                latest = max(latest, entry.stat().st_mtime)
+    return latest
+
+
+def arrivalKey(volumes):
+    # Same row with the same files -> same key, a replaced file gives another key
+    sha = hashlib.sha1('\x1f'.join(str(value) for value in volumes).encode('utf-8'))
+    for path in volumes[1:3]:
+        stat = os.stat(path)
+        sha.update(f"\x1f{stat.st_size}:{lastModified(path)}".encode('utf-8'))
+    return sha.hexdigest()
+
+
+class watchSource():
+    # Cases already queued, and the completed ones persisted in the state file (json lines)
+    def __init__(self, stateFile):
+        self.stateFile = stateFile
+        self.seen = set()
+        self.arrivals = dict()
+        self.keys = dict()
+        self.rejected = []
+        if stateFile and os.path.exists(stateFile):
+            with open(stateFile, 'r') as fp:
+                for line in fp:
+                    try:
+                        self.seen.add(json.loads(line)['key'])
+                    except (ValueError, KeyError):
+                        # Last line cut by a crash
+                        continue
+            print(f"Watch state {stateFile}: {len(self.seen)} cases already completed")
+
+    def queue(self, volumes, arrival):
+        # True when the row is new, it is then queued
+        try:
+            key = arrivalKey(volumes)
+        except OSError:
+            return False
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        self.keys[tuple(volumes)] = key
+        self.arrivals[tuple(volumes)] = arrival
+        return True
+
+    def rejectedRows(self):
+        # Rows that can not be queued, with the cause, reported invalid by the runner
+        rows, self.rejected = self.rejected, []
+        return rows
+
+    def completed(self, volumes, status):
+        # Returns the arrival time of the case
+        key = self.keys.pop(tuple(volumes), None)
+        arrival = self.arrivals.pop(tuple(volumes), None)
+        if key is not None and self.stateFile:
+            with open(self.stateFile, 'a') as fp:
+                fp.write(json.dumps({'key': key, '_ID_': volumes[0], 'status': status, 'time': time.time()}))
+                fp.write('\n')
+        return arrival
+
+
+class inboxWatcher(watchSource):
+    def __init__(self, directory, stateFile=None, settle=2.0):
+        watchSource.__init__(self, stateFile)
+        self.directory = directory
+        self.settle = settle
+
+    def poll(self):
+        cases = dict()
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or entry.name.endswith(('.tmp', '.part')):
+                continue
+            match = casePattern.match(entry.name)
+            if match is not None:
+                cases.setdefault(match.group('id'), dict())[match.group('kind')] = entry.path
+
+        rows = []
+        now = time.time()
+        for ID in sorted(cases):
+            if 'volume' not in cases[ID] or 'mask' not in cases[ID]:
+                continue
+            volumes = (ID, cases[ID]['volume'], cases[ID]['mask'])
+            try:
+                arrival = max(lastModified(volumes[1]), lastModified(volumes[2]))
+            except OSError:
+                continue
+            if now - arrival < self.settle:
+                # Still being written
+                continue
+            if self.queue(volumes, arrival):
+                rows.append(volumes)
+        return rows
+
+
+class worklistWatcher(watchSource):
+    def __init__(self, listFile, stateFile=None, settle=2.0, waitTimeout=3600.0):
+        watchSource.__init__(self, stateFile)
+        self.listFile = listFile
+        self.settle = settle
+        self.waitTimeout = waitTimeout
+        self.offset = 0
+        # (row, time it was read)
+        self.waiting = []
+
+    def poll(self):
+        # Rows of the lines appended since the last poll, and the rows waiting for their files
+        lines = []
+        if os.path.getsize(self.listFile) < self.offset:
+            # Truncated or replaced, read again from the start (completed rows are skipped)
+            self.offset = 0
+        with open(self.listFile, 'rb') as fp:
+            fp.seek(self.offset)
+            data = fp.read()
+        end = data.rfind(b'\n') + 1
+        if end > 0:
+            self.offset += end
+            lines = data[:end].decode('utf-8').splitlines()
+
+        now = time.time()
+        candidates = self.waiting + [(tuple(row), now) for row in csv.reader(lines) if len(row) > 0]
+        self.waiting = []
+        rows = []
+        for volumes, since in candidates:
+            if len(volumes) < 3:
+                self.rejected.append( (volumes + ('',) * (3 - len(volumes)), f"row with {len(volumes)} column(s), ID, volume and segment are required") )
+                continue
+            try:
+                settled = now - max(lastModified(volumes[1]), lastModified(volumes[2])) >= self.settle
+            except OSError:
+                settled = False
+            if not settled:
+                if now - since < self.waitTimeout:
+                    self.waiting.append( (volumes, since) )
+                    continue
+                if not (os.path.exists(volumes[1]) and os.path.exists(volumes[2])):
+                    # The files never came, the runner reports the row missing
+                    rows.append(volumes)
+                    continue
+            if self.queue(volumes, since):
+                rows.append(volumes)
+        return rows
@@ -0,0 +1,31 @@
+import os
+
+from rdmcache import diskCache
+
+
+def write(cache, key, size):
+    path = cache.path(key, '.bin')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fp:
+        fp.write(b'\0' * size)
+    cache.added(path)
+    return path
+
+
+def test_shared_directory_quota(tmp_path):
+    # Two workers each with their own cache on the directory: the quota is the one of the
+    # directory, not the one of each worker
+    workers = [diskCache(str(tmp_path), 10000, shared=True) for index in range(2)]
+    paths = [write(workers[index % 2], f"{index:04d}", 1000) for index in range(16)]
+    size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    assert size <= 10000
+    # The least recently used entries are evicted first
+    assert os.path.exists(paths[-1]) and not os.path.exists(paths[0])
+
+
+def test_process_quota(tmp_path):
+    cache = diskCache(str(tmp_path), 10000)
+    paths = [write(cache, f"{index:04d}", 1000) for index in range(16)]
+    assert cache.size == sum(os.path.getsize(path) for path in paths if os.path.exists(path)) <= 10000
+    # Reopened, the size is the one of the directory
+    assert diskCache(str(tmp_path), 10000).size == cache.size
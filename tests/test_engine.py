@@ -0,0 +1,149 @@
+import json
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+sitk = pytest.importorskip('SimpleITK')
+pytest.importorskip('radiomics')
+
+from radiomics.featureextractor import RadiomicsFeatureExtractor
+
+from rdmengine import executeSets, getExtractor
+from rdmmetrics import stageTimer
+
+
+params = {
+    'setting': {'binWidth': 25.0, 'label': 1},
+    'imageType': {'Original': {}, 'LoG': {'sigma': [1.0, 2.0]}, 'Square': {}},
+    'featureClass': {'firstorder': None, 'glcm': None, 'glszm': None, 'shape': None},
+}
+
+
+def phantom():
+    rng = numpy.random.default_rng(0)
+    volume = rng.normal(100.0, 20.0, (24, 32, 32)).astype(numpy.float32)
+    maskArray = numpy.zeros(volume.shape, dtype=numpy.uint8)
+    maskArray[6:18, 8:24, 10:22] = 1
+    maskArray[8:12, 12:16, 12:16] = 2
+    image = sitk.GetImageFromArray(volume)
+    image.SetSpacing((0.8, 0.8, 2.0))
+    mask = sitk.GetImageFromArray(maskArray)
+    mask.CopyInformation(image)
+    return image, mask
+
+
+def reference(rdm_params, image, mask, label):
+    rmics = RadiomicsFeatureExtractor()
+    rmics.enableAllFeatures()
+    rmics.loadJSONParams(json.dumps(rdm_params))
+    return rmics.execute(image, mask, label)
+
+
+def assertSameFeatures(result, expected):
+    assert set(result) == set(expected)
+    for name, value in expected.items():
+        if not name.startswith('diagnostics_'):
+            assert numpy.allclose(float(result[name]), float(value), equal_nan=True), name
+
+
+@pytest.mark.parametrize('label', [1, 2])
+def test_executeSets_matches_execute(label):
+    image, mask = phantom()
+    rmics, defaultLabel = getExtractor(params)
+    result, = executeSets([rmics], image, mask, [label], stageTimer())
+    assertSameFeatures(result, reference(params, image, mask, label))
+
+
+def test_executeSets_shared_preprocessing_matches_execute():
+    # Params sets differing by a feature setting share the preprocessing and the filters
+    other = json.loads(json.dumps(params))
+    other['setting']['binWidth'] = 10.0
+    image, mask = phantom()
+    extractors = [getExtractor(params)[0], getExtractor(other)[0]]
+    timer = stageTimer()
+    results = executeSets(extractors, image, mask, [1, 1], timer)
+    assertSameFeatures(results[0], reference(params, image, mask, 1))
+    assertSameFeatures(results[1], reference(other, image, mask, 1))
+    assert 'Original/glcm' in timer.result()['stages']
+
+
+def test_extractPerturbations_matches_each_variant(tmp_path):
+    # The filtered images memoized for the variants give the features of a plain extraction
+    # of every variant mask
+    from rdmengine import extractPerturbations
+    from rdmperturb import maskVariants, variantImage
+    image, mask = phantom()
+    volumeFile = str(tmp_path / 'volume.nrrd')
+    maskFile = str(tmp_path / 'mask.nrrd')
+    sitk.WriteImage(image, volumeFile)
+    sitk.WriteImage(mask, maskFile)
+    spec = {'dilate': [1], 'translate': [[1, 0, 0]]}
+    isDone, results = extractPerturbations(volumeFile, maskFile, [(None, params)], spec, [1])
+    assert isDone and [variant for name, label, variant, result in results] == ['original', 'dilate1', 'translatep1p0p0']
+
+    maskArray = sitk.GetArrayFromImage(mask)
+    variants, start = maskVariants(maskArray, 1, spec)
+    for (name, label, variantName, result), (expectedName, variant) in zip(results, variants):
+        assert variantName == expectedName
+        reference = RadiomicsFeatureExtractor()
+        reference.enableAllFeatures()
+        reference.loadJSONParams(json.dumps(params))
+        assertSameFeatures(result, reference.execute(image, variantImage(mask, maskArray, variant, start, 1), 1))
+
+
+def test_preprocessed_cache_cold_and_warm(tmp_path):
+    # The features of the cached preprocessed and filtered images are the features of the
+    # extraction that filled the cache
+    from rdmengine import setPreprocessedCache
+    import rdmengine
+    cached = json.loads(json.dumps(params))
+    cached['imageType']['Wavelet'] = {}
+    image, mask = phantom()
+    source = (str(tmp_path / 'volume.nrrd'), str(tmp_path / 'mask.nrrd'))
+    sitk.WriteImage(image, source[0])
+    sitk.WriteImage(mask, source[1])
+    rmics, defaultLabel = getExtractor(cached)
+    setPreprocessedCache(str(tmp_path / 'cache'))
+    try:
+        cold, = executeSets([rmics], image, mask, [1], stageTimer(), source)
+        assert rdmengine._preprocessedCache.hits == 0
+        warm, = executeSets([rmics], image, mask, [1], stageTimer(), source)
+        # The preprocessed image (Original), LoG, Square and Wavelet entries
+        assert rdmengine._preprocessedCache.hits == 4
+    finally:
+        setPreprocessedCache(None)
+    assert list(warm) == list(cold)
+    for name, value in cold.items():
+        if name.startswith('diagnostics_'):
+            assert str(warm[name]) == str(value), name
+        else:
+            assert float(warm[name]) == float(value), name
+    assertSameFeatures(cold, reference(cached, image, mask, 1))
+
+
+def baselineFormat(result, id_):
+    # formatResult of the first version of app.py, the reference of the document layout
+    predoc = dict()
+    predoc['_ID_'] = str(id_)
+    for key, value in result.items():
+        if type(value) == str or type(value) == tuple:
+            predoc[key] = str(value)
+        elif type(value) == dict:
+            predoc[key] = value
+        elif type(value) == numpy.float64:
+            predoc[key] = float(value)
+        elif type(value) == numpy.ndarray:
+            predoc[key] = float(value.tolist())
+    return predoc
+
+
+def test_formatResult_matches_the_baseline_layout():
+    from rdmengine import formatResult
+    image, mask = phantom()
+    result = reference(params, image, mask, 1)
+    isDone, document = formatResult(result, 12)
+    expected = baselineFormat(result, 12)
+    assert isDone
+    assert list(document) == list(expected)
+    assert document == expected
+    assert all(type(value) is type(expected[name]) for name, value in document.items())
@@ -0,0 +1,58 @@
+import os
+import time
+
+from rdmlease import leaseQueue, caseKey
+
+
+def expire(queue, key):
+    past = time.time() - 2 * queue.leaseTime
+    os.utime(queue.__leasePath__(key), (past, past))
+
+
+def test_claim_and_complete(tmp_path):
+    first = leaseQueue(str(tmp_path), 60.0, owner='a:1')
+    second = leaseQueue(str(tmp_path), 60.0, owner='b:2')
+    key = caseKey(('1', 'v.nrrd', 'm.nrrd'), 'params')
+    assert key != caseKey(('1', 'v.nrrd', 'm.nrrd'), 'other')
+    assert first.claim(key) and first.isHeld(key)
+    assert not second.claim(key)
+    first.complete(key)
+    assert second.isDone(key) and not second.claim(key)
+    assert not os.path.exists(first.__leasePath__(key))
+
+
+def test_lost_lease_is_left_to_the_new_owner(tmp_path):
+    first = leaseQueue(str(tmp_path), 60.0, owner='a:1')
+    second = leaseQueue(str(tmp_path), 60.0, owner='b:2')
+    key = caseKey(('1', 'v.nrrd', 'm.nrrd'))
+    assert first.claim(key)
+    # The first runner stalls, its lease expires and the second one reclaims it
+    expire(first, key)
+    assert second.claim(key) and second.reclaimed == 1
+    assert first.isLost(key) and not first.isHeld(key)
+    # The first runner neither marks the case done nor removes the lease of the second one
+    first.complete(key)
+    assert not first.isDone(key) and not first.isLost(key)
+    assert os.path.exists(second.__leasePath__(key)) and second.isHeld(key) and not second.isLost(key)
+    second.complete(key)
+    assert first.isDone(key)
+
+
+def test_heartbeat_stops_renewing_a_lost_lease(tmp_path):
+    first = leaseQueue(str(tmp_path), 0.3, owner='a:1')
+    second = leaseQueue(str(tmp_path), 0.3, owner='b:2')
+    key = caseKey(('1', 'v.nrrd', 'm.nrrd'))
+    assert first.claim(key)
+    expire(first, key)
+    assert second.claim(key)
+    expire(second, key)
+    first.start()
+    try:
+        deadline = time.monotonic() + 5.0
+        while key not in first.lost and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        first.stop()
+    assert key in first.lost and not first.isHeld(key)
+    # The lease of the second runner was not renewed by the first one
+    assert time.time() - os.stat(second.__leasePath__(key)).st_mtime > second.leaseTime
@@ -0,0 +1,110 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from rdmperturb import variantNames, margin, shifted, dilate, erode, randomized, maskVariants, variantRegion
+
+
+def cube(shape=(10, 12, 14), low=(3, 4, 5), high=(6, 8, 10), label=1):
+    maskArray = numpy.zeros(shape, dtype=numpy.uint8)
+    maskArray[low[0]:high[0], low[1]:high[1], low[2]:high[2]] = label
+    return maskArray
+
+
+def test_variantNames():
+    spec = {'dilate': [1], 'erode': [2], 'translate': [[1, 0, -2]], 'randomize': {'count': 2}}
+    assert variantNames(spec) == ['original', 'dilate1', 'erode2', 'translatep1p0m2', 'randomize1', 'randomize2']
+    with pytest.raises(ValueError):
+        variantNames({'shrink': [1]})
+    with pytest.raises(ValueError):
+        variantNames({'translate': [[1, 0]]})
+    with pytest.raises(ValueError):
+        variantNames({'dilate': [1, 1]})
+
+
+def test_margin():
+    assert margin({}) == 0
+    assert margin({'dilate': [1, 3], 'erode': [5]}) == 3
+    assert margin({'translate': [[0, -4, 1]]}) == 4
+    assert margin({'randomize': {'amplitude': 1.0}}) == 5
+
+
+def test_translation_axis_order():
+    # Translations are (x, y, z), the arrays (z, y, x)
+    maskArray = cube()
+    variants, start = maskVariants(maskArray, 1, {'translate': [[2, 0, 0], [0, 0, -1]]})
+    names = dict(variants)
+    full = numpy.zeros(maskArray.shape, dtype=bool)
+    box = tuple(slice(begin, begin + length) for begin, length in zip(start, names['original'].shape))
+    full[box] = names['translatep2p0p0']
+    assert numpy.array_equal(full, numpy.roll(maskArray == 1, 2, axis=2))
+    full[box] = names['translatep0p0m1']
+    assert numpy.array_equal(full, numpy.roll(maskArray == 1, -1, axis=0))
+
+
+def test_shifted_fill():
+    array = numpy.ones((3, 3, 3), dtype=bool)
+    result = shifted(array, (0, 0, 1))
+    assert not result[:, :, 0].any() and result[:, :, 1:].all()
+    assert not shifted(array, (0, 5, 0)).any()
+
+
+def test_dilate_erode():
+    roi = cube() == 1
+    dilated = dilate(roi, 1)
+    assert dilated[2, 5, 6] and dilated[3, 3, 6] and not dilated[2, 3, 6]
+    eroded = erode(roi, 1)
+    assert eroded.sum() == 1 * 2 * 3
+    assert numpy.array_equal(erode(dilated, 1), roi)
+
+
+def test_erode_at_the_border():
+    # Outside the array is background, a ROI touching the border is eroded from it
+    roi = numpy.zeros((6, 6, 6), dtype=bool)
+    roi[0:4, 0:4, 0:4] = True
+    eroded = erode(roi, 1)
+    assert not eroded[0].any() and not eroded[:, 0].any() and not eroded[:, :, 0].any()
+    assert eroded[1:3, 1:3, 1:3].all() and eroded.sum() == 8
+
+
+def test_flat_masks_stay_in_their_slice():
+    roi = numpy.zeros((1, 8, 8), dtype=bool)
+    roi[0, 3:5, 3:5] = True
+    assert dilate(roi, 1).sum() == 4 + 4 * 2
+
+
+def test_randomized_is_seed_stable():
+    roi = cube((16, 16, 16), (5, 5, 5), (11, 11, 11)) == 1
+    first = randomized(roi, 2, sigma=2.0, amplitude=1.0, seed=3)
+    again = randomized(roi, 2, sigma=2.0, amplitude=1.0, seed=3)
+    other = randomized(roi, 2, sigma=2.0, amplitude=1.0, seed=4)
+    assert all(numpy.array_equal(a, b) for a, b in zip(first, again))
+    assert not numpy.array_equal(first[0], first[1])
+    assert not numpy.array_equal(first[0], other[0])
+    # Only the contour moves, within the smoothing band (2 box filters of 5 voxels): no
+    # island or hole away from it
+    for variant in first:
+        assert not numpy.array_equal(variant, roi)
+        assert not variant[:, :, :1].any() and not variant[:, :, 15:].any()
+        assert not variant[:1].any() and not variant[:, :1].any()
+        assert not variant[15:].any() and not variant[:, 15:].any()
+        assert variant[8, 8, 8]
+
+
+def test_maskVariants_box():
+    maskArray = cube(label=2)
+    variants, start = maskVariants(maskArray, 2, {'dilate': [2]})
+    assert start == (1, 2, 3)
+    assert [name for name, variant in variants] == ['original', 'dilate2']
+    assert variants[0][1].shape == (7, 8, 9) and variants[0][1].sum() == (maskArray == 2).sum()
+    with pytest.raises(ValueError):
+        maskVariants(maskArray, 1, {})
+
+
+def test_variantRegion_in_SimpleITK_order():
+    maskArray = cube()
+    variants, start = maskVariants(maskArray, 1, {'dilate': [1]})
+    index, size = variantRegion(variants, start)
+    # (x, y, z): the dilated cube z 2..6, y 3..8, x 4..10
+    assert index == [4, 3, 2]
+    assert size == [7, 6, 5]
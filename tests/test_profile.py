@@ -0,0 +1,68 @@
+import pytest
+
+from rdmprofile import parseFeatureName, minimalParams
+
+
+params = {
+    'setting': {'binWidth': 25, 'symmetricalGLCM': True},
+    'featureClass': {'firstorder': None, 'glcm': None, 'glszm': None, 'shape': None},
+    'imageType': {'Original': {}, 'LoG': {'sigma': [1.0, 2.0, 3.0, 5.0]}, 'Wavelet': {'start_level': 0}},
+}
+
+
+@pytest.mark.parametrize('name, parsed', [
+    ('original_firstorder_Mean', ('Original', 'firstorder', 'Mean', None)),
+    ('original_shape_Maximum3DDiameter', (None, 'shape', 'Maximum3DDiameter', None)),
+    ('log-sigma-3-0-mm-3D_glszm_ZoneEntropy', ('LoG', 'glszm', 'ZoneEntropy', 3.0)),
+    ('log-sigma-0-5-mm-3D_glcm_Idm', ('LoG', 'glcm', 'Idm', 0.5)),
+    ('wavelet-LLH_glcm_Contrast', ('Wavelet', 'glcm', 'Contrast', None)),
+    ('lbp-2D_firstorder_Mean', ('LBP2D', 'firstorder', 'Mean', None)),
+    ('lbp-3D-m1_firstorder_Mean', ('LBP3D', 'firstorder', 'Mean', None)),
+])
+def test_parseFeatureName(name, parsed):
+    assert parseFeatureName(name) == parsed
+
+
+@pytest.mark.parametrize('name', ['original_Mean', 'original_texture_Mean', 'wavelet-LLH_shape_Sphericity', 'log-3D_glcm_Idm', 'gabor_glcm_Idm'])
+def test_parseFeatureName_errors(name):
+    with pytest.raises(ValueError):
+        parseFeatureName(name)
+
+
+def test_minimalParams():
+    features = ['original_shape_VoxelVolume', 'log-sigma-3-0-mm-3D_glszm_ZoneEntropy', 'log-sigma-1-0-mm-3D_firstorder_Mean', 'original_firstorder_Mean']
+    minimal, warnings = minimalParams(params, features)
+    assert warnings == []
+    assert minimal['imageType'] == {'LoG': {'sigma': [1.0, 3.0]}, 'Original': {}}
+    assert minimal['featureClass'] == {'shape': ['VoxelVolume'], 'glszm': ['ZoneEntropy'], 'firstorder': ['Mean']}
+    assert minimal['setting'] == params['setting']
+    # The params are not modified
+    assert params['imageType']['LoG']['sigma'] == [1.0, 2.0, 3.0, 5.0]
+
+
+def test_minimalParams_not_enabled():
+    features = ['square_firstorder_Mean', 'original_ngtdm_Busyness', 'original_glcm_Idm']
+    minimal, warnings = minimalParams(params, features)
+    assert set(minimal['imageType']) == {'Square', 'Original'}
+    assert set(minimal['featureClass']) == {'firstorder', 'ngtdm', 'glcm'}
+    assert len(warnings) == 2
+
+    minimal, warnings = minimalParams(params, features, restrict=True)
+    assert minimal['imageType'] == {'Original': {}}
+    assert minimal['featureClass'] == {'glcm': ['Idm']}
+    assert warnings == []
+
+
+def test_minimalParams_errors():
+    with pytest.raises(ValueError) as e:
+        minimalParams(params, ['original_firstorder_Mean', 'original_Mean', 'gabor_glcm_Idm'])
+    assert 'original_Mean' in str(e.value) and 'gabor_glcm_Idm' in str(e.value)
+
+
+def test_minimalParams_sets():
+    other = dict(params, setting={'binWidth': 10})
+    other['featureClass'] = {'firstorder': None}
+    sets, warnings = minimalParams([('fine', other), ('coarse', params)], ['original_glcm_Idm'])
+    assert [name for name, minimal in sets] == ['fine', 'coarse']
+    assert sets[0][1]['setting'] == {'binWidth': 10} and sets[1][1]['featureClass'] == {'glcm': ['Idm']}
+    assert warnings == ['fine: feature class glcm is not enabled in the params']
@@ -0,0 +1,88 @@
+import pytest
+
+from rdmschedule import derivedImages, costModel, memoryModel, caseScheduler
+
+
+params = {
+    'setting': {'binWidth': 25},
+    'imageType': {'Original': {}, 'Wavelet': {}, 'LoG': {'sigma': [1.0, 3.0]}},
+}
+
+
+def header(voxels, roiVoxels, labels=1):
+    return {'voxels': voxels, 'roiVoxels': roiVoxels, 'labels': labels}
+
+
+def test_derivedImages():
+    assert derivedImages(params) == (11, 10)
+    assert derivedImages([('a', params), ('b', {'imageType': {'Original': {}}})]) == (12, 10)
+
+
+def test_costModel_prior_order():
+    model = costModel(params)
+    assert model.estimate(None) is None
+    small, large, roi = header(64 ** 3, 1000), header(512 * 512 * 300, 1000), header(512 * 512 * 300, 10 ** 6)
+    assert model.estimate(small) < model.estimate(large) < model.estimate(roi)
+    # Without observations the estimate is the prior
+    assert model.estimate(small) == pytest.approx(sum(prior * value for prior, value in zip(costModel.prior, (1.0, 1, 64 ** 3, 64 ** 3 * 10, 1000 * 11))))
+
+
+def test_costModel_observe():
+    pytest.importorskip('numpy')
+    model = costModel(params)
+    cases = [header(voxels, voxels // 100) for voxels in (64 ** 3, 128 ** 3, 256 ** 3, 256 * 256 * 128)]
+    # Cases three times slower than the prior: the estimates move towards the timings
+    seconds = [3.0 * model.estimate(case) for case in cases]
+    before = [abs(model.estimate(case) - time) for case, time in zip(cases, seconds)]
+    for repeat in range(5):
+        for case, time in zip(cases, seconds):
+            model.observe(case, time)
+    model.observe(None, 1.0)
+    model.observe(cases[0], None)
+    assert model.observed == 20
+    assert all(weight >= 0.05 for weight in model.weights)
+    assert all(abs(model.estimate(case) - time) < error for case, time, error in zip(cases, seconds, before))
+
+
+def test_memoryModel():
+    model = memoryModel(params)
+    assert model.copies == 3 + 8
+    case = header(512 * 512 * 300, 10 ** 5)
+    assert model.estimate(case) == pytest.approx(1.25 * costModel.estimate(model, case))
+    assert model.resident() == 300.0
+    assert model.resident(200.0) == 500.0
+
+
+def group(*names):
+    return [((name, f"{name}.nrrd", f"{name}_mask.nrrd"), name) for name in names]
+
+
+def test_caseScheduler_order():
+    model = costModel(params)
+    headers = {('small', 'small.nrrd', 'small_mask.nrrd'): header(64 ** 3, 1000),
+               ('large', 'large.nrrd', 'large_mask.nrrd'): header(512 * 512 * 300, 10 ** 5),
+               ('medium', 'medium.nrrd', 'medium_mask.nrrd'): header(256 ** 3, 10 ** 4)}
+    scheduler = caseScheduler(model, headers)
+    scheduler.extend([group('small'), group('medium'), group('large'), group('unreadable')])
+    assert len(scheduler) == 4
+    order = [scheduler.popleft()[0][1] for index in range(4)]
+    # The unreadable case is estimated as the average, between the large and the medium cases
+    assert order == ['large', 'unreadable', 'medium', 'small']
+    assert not scheduler
+
+    # Two small cases in one group cost more than one small case
+    scheduler.extend([group('small'), group('small', 'small')])
+    assert len(scheduler.popleft()) == 2
+
+
+def test_caseScheduler_take_clear():
+    model = costModel(params)
+    headers = {('small', 'small.nrrd', 'small_mask.nrrd'): header(64 ** 3, 1000),
+               ('large', 'large.nrrd', 'large_mask.nrrd'): header(512 * 512 * 300, 10 ** 5)}
+    scheduler = caseScheduler(model, headers)
+    scheduler.extend([group('small'), group('large')])
+    assert scheduler.take(lambda entries: False) is None
+    assert scheduler.take(lambda entries: entries[0][1] != 'large')[0][1] == 'small'
+    assert len(scheduler) == 1
+    scheduler.clear()
+    assert not scheduler and scheduler.take(lambda entries: True) is None
@@ -0,0 +1,71 @@
+import collections
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from rdmengine import featureSchema, formatResult, getSchema
+
+
+def result(mean=1.5):
+    return collections.OrderedDict([
+        ('diagnostics_Versions_PyRadiomics', 'v3.1.0'),
+        ('diagnostics_Image-original_Spacing', (0.8, 0.8, 2.0)),
+        ('diagnostics_Configuration_Settings', {'binWidth': 25.0}),
+        ('diagnostics_Image-original_Mean', numpy.float64(12.5)),
+        ('diagnostics_Mask-original_VoxelNum', 140),
+        ('original_shape_VoxelVolume', numpy.array(179.2)),
+        ('original_firstorder_Mean', numpy.float64(mean)),
+        ('original_glcm_Contrast', numpy.array(0.25)),
+        ('original_glcm_Idm', 0.5),
+        ('diagnostics_Mask-original_BoundingBox', (1, 2, 3, 4, 5, 6)),
+    ])
+
+
+def test_format_layout_and_conversions():
+    schema = featureSchema(result())
+    document, row, diagnostics = schema.format(result(), 7)
+    # In the order of the result
+    assert list(document) == ['_ID_', 'diagnostics_Versions_PyRadiomics', 'diagnostics_Image-original_Spacing', 'diagnostics_Configuration_Settings', 'diagnostics_Image-original_Mean', 'original_shape_VoxelVolume', 'original_firstorder_Mean', 'original_glcm_Contrast', 'diagnostics_Mask-original_BoundingBox']
+    assert document['_ID_'] == '7'
+    assert document['diagnostics_Image-original_Spacing'] == '(0.8, 0.8, 2.0)'
+    assert document['diagnostics_Configuration_Settings'] == {'binWidth': 25.0}
+    assert type(document['diagnostics_Image-original_Mean']) is float
+    # The voxel counts of the diagnostics and python floats are not stored
+    assert 'diagnostics_Mask-original_VoxelNum' not in document
+    assert 'original_glcm_Idm' not in document
+    assert all(type(document[name]) is float for name in schema.features)
+    assert row.dtype == numpy.float64 and row.tolist() == [179.2, 1.5, 0.25]
+    assert set(diagnostics) == set(name for name, convert in schema.diagnostics)
+
+
+def test_schema_reused_for_the_same_keys():
+    schema = featureSchema(result())
+    assert schema.matches(result(2.5))
+    other = result()
+    other['original_glcm_Idmn'] = numpy.float64(0.5)
+    assert not schema.matches(other)
+    assert schema.format(result(2.5), 'a')[0]['original_firstorder_Mean'] == 2.5
+
+
+def test_keep_filters_the_features_only():
+    schema = featureSchema(result(), frozenset(['original_firstorder_Mean']))
+    document, row, diagnostics = schema.format(result(), 'a')
+    assert schema.features == ['original_firstorder_Mean']
+    assert 'original_glcm_Contrast' not in document
+    assert 'diagnostics_Versions_PyRadiomics' in document
+
+
+def test_getSchema_warns_about_missing_features(capsys):
+    schema = getSchema({'setting': {}}, result(), ('original_firstorder_Mean', 'original_glcm_Idn'))
+    assert schema.features == ['original_firstorder_Mean']
+    assert 'original_glcm_Idn' in capsys.readouterr().out
+    assert getSchema({'setting': {}}, result(3.0), ('original_firstorder_Mean', 'original_glcm_Idn')) is schema
+
+
+def test_formatResult_builds_a_schema_for_other_keys():
+    schema = featureSchema(result())
+    other = result()
+    del other['original_glcm_Contrast']
+    isDone, document = formatResult(other, 'b', schema)
+    assert isDone and 'original_glcm_Contrast' not in document and document['original_firstorder_Mean'] == 1.5
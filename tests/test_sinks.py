@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from rdmsinks import documentKey, documentName, mongoWriter, featureMatrixWriter, loadFeatureMatrix
+
+
+class fakeCollection():
+    # find() of pymongo for the queries of mongoWriter.stored: equality and $in
+    def __init__(self, documents):
+        self.documents = documents
+        self.queries = []
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        for document in self.documents:
+            if all(document.get(name) in value['$in'] if isinstance(value, dict) else document.get(name) == value for name, value in query.items()):
+                yield {'_ID_': document['_ID_']}
+
+
+def writer(documents, paramsHash='abc'):
+    sink = mongoWriter('mongodb://localhost', 'db', 'radiomics', paramsHash=paramsHash)
+    collection = fakeCollection(documents)
+    sink.client = {'db': {'radiomics': collection}}
+    return sink, collection
+
+
+def test_documentKey():
+    assert documentKey({'_ID_': 'a', 'original_firstorder_Mean': 1.0}) == {'_ID_': 'a', '_LABEL_': None, '_PARAMS_': None, '_PERTURBATION_': None}
+    assert documentKey({'_ID_': 'a', '_LABEL_': 2, '_PARAMS_': 'fine'}) == {'_ID_': 'a', '_LABEL_': 2, '_PARAMS_': 'fine', '_PERTURBATION_': None}
+    assert documentName({'_ID_': 'a', '_LABEL_': 2, '_PARAMS_': 'fine', '_PERTURBATION_': 'dilate1'}) == 'a_label2_fine_dilate1'
+
+
+def test_key_and_put_carry_the_params_hash():
+    sink, collection = writer([])
+    sink.put({'_ID_': 'a', '_LABEL_': 1})
+    document = sink.queue.get_nowait()
+    assert document['_PARAMS_HASH_'] == 'abc'
+    assert sink.__key__(document) == {'_ID_': 'a', '_LABEL_': 1, '_PARAMS_': None, '_PERTURBATION_': None, '_PARAMS_HASH_': 'abc'}
+
+
+def test_stored():
+    documents = [
+        {'_ID_': '1', '_PARAMS_HASH_': 'abc'},
+        {'_ID_': '2', '_PARAMS_HASH_': 'abc', '_LABEL_': 1},
+        {'_ID_': '2', '_PARAMS_HASH_': 'abc', '_LABEL_': 2},
+        {'_ID_': '3', '_PARAMS_HASH_': 'abc', '_LABEL_': 1},
+        {'_ID_': '4', '_PARAMS_HASH_': 'other'},
+    ]
+    sink, collection = writer(documents)
+    # IDs are compared as strings, 3 has one of its two labels, 4 other params
+    assert sink.stored([1, '2', '3', '4', '5'], {'2': 2, '3': 2}) == {'1', '2'}
+    assert all(query['_PARAMS_HASH_'] == 'abc' for query in collection.queries)
+
+    sink, collection = writer(documents, paramsHash=None)
+    assert sink.stored(['1', '4']) == {'1', '4'}
+    assert '_PARAMS_HASH_' not in collection.queries[0]
+
+
+def test_stored_by_chunks():
+    sink, collection = writer([{'_ID_': str(ID), '_PARAMS_HASH_': 'abc'} for ID in range(0, 2500, 2)])
+    assert sink.stored(range(2500)) == set(str(ID) for ID in range(0, 2500, 2))
+    assert [len(query['_ID_']['$in']) for query in collection.queries] == [1000, 1000, 500]
+
+
+def test_notify_after_the_flush():
+    sink, collection = writer([])
+    results = []
+    sink.failed = [{'_ID_': 'b'}]
+    sink.__notify__([('a', results.append), ('b', results.append)])
+    assert results == [True, False]
+
+
+def matrixRows(directory, append, IDs, features=('original_firstorder_Mean', 'original_glcm_Idm')):
+    matrix = featureMatrixWriter(str(directory), 'csv', append=append)
+    for ID in IDs:
+        document = {'_ID_': ID, 'diagnostics_Versions_PyRadiomics': 'v3.1.0'}
+        document.update((name, float(index) + len(ID)) for index, name in enumerate(features))
+        matrix.put(document)
+        matrix.flush()
+    matrix.close()
+    return matrix
+
+
+def test_matrix_restart_keeps_the_rows(tmp_path):
+    pytest.importorskip('numpy')
+    matrixRows(tmp_path, True, ['a', 'b'])
+    matrix = matrixRows(tmp_path, True, ['ccc'])
+    tags, features, values = loadFeatureMatrix(matrix.featureFile)
+    assert tags['_ID_'] == ['a', 'b', 'ccc']
+    assert features == ['original_firstorder_Mean', 'original_glcm_Idm']
+    assert values.tolist() == [[1.0, 2.0], [1.0, 2.0], [3.0, 4.0]]
+    with open(matrix.diagnosticsFile) as fp:
+        assert [json.loads(line)['_ID_'] for line in fp] == ['a', 'b', 'ccc']
+
+    # A row cut by a crash is dropped
+    with open(matrix.featureFile, 'a') as fp:
+        fp.write('dd,5.0')
+    matrix = matrixRows(tmp_path, True, ['e'])
+    assert loadFeatureMatrix(matrix.featureFile)[0]['_ID_'] == ['a', 'b', 'ccc', 'e']
+
+    # Without append (a worklist run) the matrix is written again
+    matrix = matrixRows(tmp_path, False, ['f'])
+    assert loadFeatureMatrix(matrix.featureFile)[0]['_ID_'] == ['f']
+
+
+def test_matrix_restart_with_other_columns(tmp_path):
+    pytest.importorskip('numpy')
+    first = matrixRows(tmp_path, True, ['a'])
+    second = matrixRows(tmp_path, True, ['b'], features=('original_firstorder_Median',))
+    assert second.featureFile != first.featureFile
+    assert loadFeatureMatrix(first.featureFile)[0]['_ID_'] == ['a']
+    assert loadFeatureMatrix(second.featureFile)[1] == ['original_firstorder_Median']